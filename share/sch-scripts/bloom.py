@@ -0,0 +1,60 @@
+# This file is part of sch-scripts, https://sch-scripts.gitlab.io
+# Copyright 2009-2022 the sch-scripts team, see AUTHORS
+# SPDX-License-Identifier: GPL-3.0-or-later
+"""
+A Bloom filter, to send a compact set of names over the network.
+"""
+import base64
+import hashlib
+import math
+
+
+class BloomFilter:
+    """A set of strings that may answer that a missing string is in it, with
+    a probability of about error_rate, but never that an added string isn't.
+
+    The positions of the bits are derived from blake2b, not from hash(), so
+    that filters can be exchanged between processes.
+    """
+
+    def __init__(self, bits, hashes, data=None):
+        self.bits = bits
+        self.hashes = hashes
+        if data is None:
+            data = bytearray((bits + 7) // 8)
+        self.data = bytearray(data)
+
+    @classmethod
+    def for_items(cls, items, error_rate=0.01):
+        """Return a filter sized for items, with all of them added."""
+        items = list(items)
+        n = max(len(items), 1)
+        bits = max(64, int(math.ceil(-n * math.log(error_rate)
+                                     / math.log(2) ** 2)))
+        hashes = max(1, int(round(bits / n * math.log(2))))
+        bloom = cls(bits, hashes)
+        for item in items:
+            bloom.add(item)
+        return bloom
+
+    def _positions(self, item):
+        digest = hashlib.blake2b(item.encode('utf-8'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i*h2) % self.bits for i in range(self.hashes)]
+
+    def add(self, item):
+        for pos in self._positions(item):
+            self.data[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, item):
+        return all(self.data[pos >> 3] & (1 << (pos & 7))
+                   for pos in self._positions(item))
+
+    def encode(self):
+        """Return the filter data as a base64 string."""
+        return base64.b64encode(bytes(self.data)).decode('ascii')
+
+    @classmethod
+    def decode(cls, bits, hashes, data):
+        return cls(bits, hashes, base64.b64decode(data))
@@ -7,6 +7,8 @@ Common functions.
 import datetime
 import subprocess
 
+import executor
+
 
 def date():
     return datetime.date.today()
@@ -28,25 +30,28 @@ def grep(word, file_path):
 def run_command(cmd, poll=False):
     # Runs a command and returns either True, on successful
     # completion, or the whole stdout and stderr of the command, on error.
-    # If poll is set return only the process
+    # If poll is set return only the process.
+    # See executor.py for timeouts, async execution and the full results.
 
     # Popen doesn't like integers like uid or gid in the command line.
     cmdline = [str(s) for s in cmd]
 
-    p = subprocess.Popen(cmdline, stdout=subprocess.PIPE,
-                         stderr=subprocess.PIPE)
-    if not poll:
-        res = p.wait()
-        if res == 0:
-            return True, p.stdout.read().decode('utf-8')
-        else:
-            print("Σφάλμα κατά την εκτέλεση εντολής:")
-            print(" $ %s" % ' '.join(cmdline))
-            print(p.stdout.read().decode('utf-8'))
-            err = p.stderr.read().decode('utf-8')
-            print(err)
-            if err == '':
-                err = '\n'
-            return False, err
-    else:
-        return p
+    if poll:
+        return subprocess.Popen(cmdline, stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE)
+    result = executor.executor.run(cmdline)
+    if result.ok:
+        return True, result.stdout
+    print_error(result)
+    err = result.stderr
+    if err == '':
+        err = '\n'
+    return False, err
+
+
+def print_error(result):
+    """Print the output of an executor.Result that failed."""
+    print("Σφάλμα κατά την εκτέλεση εντολής:")
+    print(" $ %s" % ' '.join(result.cmd))
+    print(result.stdout)
+    print(result.stderr)
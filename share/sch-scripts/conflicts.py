@@ -0,0 +1,274 @@
+# This file is part of sch-scripts, https://sch-scripts.gitlab.io
+# Copyright 2009-2022 the sch-scripts team, see AUTHORS
+# SPDX-License-Identifier: GPL-3.0-or-later
+"""
+Conflict detection for the users that are about to be imported.
+"""
+import os
+
+import libuser
+
+# Listing a parent directory is cheaper than stat'ing more entries than this
+SCANDIR_THRESHOLD = 16
+
+
+class ConflictDetector:
+    """Keeps the problems of each new user, indexed by the values that can
+    conflict, so that after an edit only the edited user and the users that
+    share its old or new values need to be checked again.
+
+    The problems are {cell: problem} dicts, where cell is the column in
+    libuser.CSV_USER_FIELDS and problem is one of:
+      'char' : Illegal inputted characters/regexp mismatch
+      'dup' : duplicate (only about the new users)
+      'con' : conflict (like duplicate but for existing/system users)
+      'hijack' : special case where the home exists, is not used by a
+                 system user, but its uid:gid pair is different from the
+                 new user's one.
+      'mismatch <value>' : the GID or the primary group doesn't match the
+                           system group; value is the one it should be.
+    Only the first user of a duplicated value isn't marked as 'dup'.
+    """
+
+    def __init__(self, system):
+        self.system = system
+        self.problems = {}
+        self.errors = set()
+        # The users in the order they were added, to tell which is the first
+        # one of duplicated values
+        self.order = {}
+        self.counter = 0
+        # The (name, uid, directory) of each user, as they were indexed
+        self.keys = {}
+        self.indexes = (libuser.Index(), libuser.Index(), libuser.Index())
+        self.stats = {}
+        self.refresh()
+
+    def refresh(self):
+        """Take the values needed from the system again."""
+        self.shells = set(self.system.get_valid_shells())
+        self.sys_gids = set(u.gid for u in self.system.users.values())
+        self.stats = {}
+
+    def add(self, users):
+        """Add and check new users; return them."""
+        users = list(users)
+        for u in users:
+            self.order[u] = self.counter
+            self.counter += 1
+            self._index(u)
+        # The users that were added earlier can't be duplicates of these
+        self.stat_homes(u.directory for u in users)
+        for u in users:
+            self._check(u)
+        return users
+
+    def remove(self, users):
+        """Forget users; return the remaining users that were checked again
+        because they had duplicate values with them."""
+        affected = set()
+        for u in users:
+            affected.update(self._dependants(u))
+            self._unindex(u)
+            del self.order[u]
+            self.problems.pop(u, None)
+            self.errors.discard(u)
+        affected.difference_update(users)
+        for u in affected:
+            self._check(u)
+        return affected
+
+    def update(self, user):
+        """Check again an edited user and the users that shared or now share
+        its values; return them."""
+        affected = self._dependants(user)
+        old_directory = self.keys[user][2]
+        self._unindex(user)
+        self._index(user)
+        affected.update(self._dependants(user))
+        if user.directory != old_directory:
+            self.stats.pop(user.directory, None)
+            self.stat_homes([user.directory])
+        for u in affected:
+            self._check(u)
+        return affected
+
+    def check_all(self):
+        """Reindex and check all the users again, after a system change or
+        after many users were changed; return them."""
+        self.refresh()
+        for index in self.indexes:
+            index.clear()
+        users = sorted(self.order, key=self.order.get)
+        for u in users:
+            self._index(u)
+        self.stat_homes(u.directory for u in users)
+        for u in users:
+            self._check(u)
+        return users
+
+    def stat_homes(self, directories):
+        """Cache the stat results of the existing home directories, or None
+        for the missing ones. For many homes in the same parent directory,
+        the parent is listed once and only the existing homes are stat'ed.
+        """
+        parents = {}
+        for directory in directories:
+            if directory and directory not in self.stats:
+                parent, base = os.path.split(os.path.normpath(directory))
+                parents.setdefault(parent, []).append((directory, base))
+        for parent, homes in parents.items():
+            if len(homes) < SCANDIR_THRESHOLD:
+                for directory, base in homes:
+                    self.stats[directory] = self._stat(directory)
+                continue
+            try:
+                with os.scandir(parent) as it:
+                    entries = dict((e.name, e) for e in it)
+            except OSError:
+                entries = {}
+            for directory, base in homes:
+                entry = entries.get(base)
+                st = None
+                if entry is not None:
+                    try:
+                        if entry.is_dir():
+                            st = entry.stat()
+                    except OSError:
+                        pass
+                self.stats[directory] = st
+
+    def _stat(self, directory):
+        try:
+            if os.path.isdir(directory):
+                return os.stat(directory)
+        except OSError:
+            pass
+        return None
+
+    def _index(self, user):
+        self.keys[user] = (user.name, user.uid, user.directory)
+        for index, value in zip(self.indexes, self.keys[user]):
+            index.add(value, user)
+
+    def _unindex(self, user):
+        for index, value in zip(self.indexes, self.keys.pop(user)):
+            index.discard(value, user)
+
+    def _dependants(self, user):
+        """Return user and the users that share one of its indexed values."""
+        users = set([user])
+        for index, value in zip(self.indexes, self.keys[user]):
+            other = index.get(value)
+            if type(other) is list:
+                users.update(other)
+            elif other is not None:
+                users.add(other)
+        return users
+
+    def _is_dup(self, index, value, user):
+        """Return True if a user that was added before user has value."""
+        other = index.get(value)
+        if other is None or other is user:
+            return False
+        if type(other) is not list:
+            other = [other]
+        order = self.order[user]
+        return any(self.order[o] < order for o in other if o is not user)
+
+    def _check(self, u):
+        system = self.system
+        problems = {}
+
+        # Illegal input checking
+        if not system.name_is_valid(u.name):
+            problems[0] = 'char'
+        if not system.uid_is_valid(u.uid):
+            problems[1] = 'char'
+        if not system.gid_is_valid(u.gid):
+            problems[2] = 'char'
+        if not system.name_is_valid(u.primary_group):
+            problems[3] = 'char'
+        gecos = [u.rname, u.office, u.wphone, u.hphone, u.other]
+        for n, field in enumerate(gecos, 4):
+            if not system.gecos_is_valid(field):
+                problems[n] = 'char'
+        # Not checking homedir validity
+        if u.shell not in self.shells:
+            problems[10] = 'char'
+        for group in u.groups:
+            if not system.name_is_valid(group):
+                problems[11] = 'char'
+                break
+        chage = [u.lstchg, u.min, u.max, u.warn, u.inact, u.expire]
+        for n, attr in enumerate(chage, 12):
+            if attr > 2147483647 or attr < -1:
+                problems[n] = 'char'
+
+        # Duplicate checking (New users)
+        names, uids, dirs = self.indexes
+        if self._is_dup(names, u.name, u):
+            problems[0] = 'dup'
+        if self._is_dup(uids, u.uid, u):
+            problems[1] = 'dup'
+        # We don't care for > 1 users having the same primary group
+        if self._is_dup(dirs, u.directory, u):
+            problems[9] = 'dup'
+
+        # Conflict checking (Existing system users)
+        if u.name in system.users:
+            problems[0] = 'con'
+        if system.get_user_by_uid(u.uid) is not None:
+            problems[1] = 'con'
+        # Check if the given GID belongs to the given group name
+        if u.primary_group in system.groups:
+            should_be = system.groups[u.primary_group].gid
+            if u.gid != should_be:
+                problems[2] = 'mismatch %s' % should_be
+        elif u.gid in self.sys_gids:
+            group = system.get_group_by_gid(u.gid)
+            should_be = group.name if group is not None else None
+            if should_be != u.primary_group:
+                problems[3] = 'mismatch %s' % should_be
+        if system.get_user_by_home(u.directory) is not None:
+            problems[9] = 'con'
+        else:
+            # Special case, we want to use existing home dirs if they are
+            # not already used; see if their uid:gid are different
+            dir_stat = self.stats.get(u.directory)
+            if dir_stat is not None:
+                if u.uid != dir_stat.st_uid:
+                    problems[1] = problems[9] = 'hijack'
+                if u.gid != dir_stat.st_gid:
+                    problems[2] = problems[9] = 'hijack'
+
+        self.problems[u] = problems
+        if problems:
+            self.errors.add(u)
+        else:
+            self.errors.discard(u)
+
+
+if __name__ == '__main__':
+    # Benchmark: check N new users against the system users, then edit one
+    import time
+
+    for n in [1000, 10000]:
+        users = [libuser.User(name='bench%d' % i, uid=50000+i, gid=50000+i,
+                              directory='/home/bench%d' % i, shell='/bin/bash',
+                              lstchg=0, min=0, max=99999, warn=7, inact=-1,
+                              expire=-1, groups=['bench%d' % i])
+                 for i in range(n)]
+        start = time.time()
+        detector = ConflictDetector(libuser.system)
+        detector.add(users)
+        added = time.time() - start
+        start = time.time()
+        detector.check_all()
+        checked = time.time() - start
+        start = time.time()
+        users[n//2].uid = users[0].uid
+        affected = detector.update(users[n//2])
+        updated = time.time() - start
+        print("%6d users: add %.3fs, check_all %.3fs, update %.5fs "
+              "(%d checked)" % (n, added, checked, updated, len(affected)))
@@ -4,14 +4,13 @@
 """
 Create users dialog.
 """
-import datetime
 import gi
 gi.require_version('Gtk', '3.0')
 from gi.repository import Gtk
+from twisted.internet import reactor, threads
 
 import config
-import libuser
-import shared_folders
+import provisioning
 
 class NewUsersDialog:
     def __init__(self, system, sf):
@@ -103,100 +102,56 @@ class NewUsersDialog:
             get_value_as_int()
         self.groups_tmpl = self.glade.get_object('groups_template_entry').\
             get_text()
-        button_close = self.glade.get_object('button_close')
 
         progress_dialog = self.glade.get_object('progress_dialog')
         progress_dialog.set_transient_for(self.dialog)
         progress_dialog.show()
-        progressbar = self.glade.get_object('users_progressbar')
-        total_users = self.computers * len(self.classes)
-        total_groups = len(self.classes)
-        users_created = 0
-        groups_created = 0
-        set_gids = []
-        set_uids = []
-        while Gtk.events_pending():
-            Gtk.main_iteration()
-
-        # Create groups for all the listed classes
-        if self.classes != ['']:
-            for classn in self.classes:
-                while Gtk.events_pending():
-                    Gtk.main_iteration()
-                if classn not in self.system.groups:
-                    tmp_gid = self.system.get_free_gid(exclude=set_gids)
-                    set_gids.append(tmp_gid)
-                    cmd_error = self.system.add_group(libuser.Group(classn, tmp_gid, {}))
-                    progressbar.set_text('Δημιουργία ομάδας %d από %d'
-                        % (groups_created+1, total_groups))
-                    #TODO expect returned value from add_group
-                    if False and cmd_error != "":
-                        self.glade.get_object('error_label').set_text(cmd_error)
-                        self.glade.get_object('error_hbox').show()
-                        button_close.set_sensitive(True)
-                        return
-                    groups_created += 1
-                    progressbar.set_fraction(float(groups_created) / float(total_groups))
-                else:
-                    tmp_gid=self.system.groups[classn].gid
-
-                # Add teachers to group
-                if self.glade.get_object('teachers_checkbutton').get_active():
-                    for user in self.system.users.values():
-                        if 'teachers' in user.groups and classn not in user.groups:
-                            user.groups.append(classn)
-                            self.system.update_user(user.name, user)
-
-            # Create shared folders
-            if self.glade.get_object('shared_checkbutton').get_active():
-                for classn in self.classes:
-                    while Gtk.events_pending():
-                        Gtk.main_iteration()
-                    self.sf.add([classn])
-
-
-        # And finally, create the users
-        cmd_error = str()
-        for classn in self.classes:
-            for compn in range(1, self.computers+1):
-                while Gtk.events_pending():
-                    Gtk.main_iteration()
-                progressbar.set_text('Δημιουργία χρήστη %d από %d...'
-                    %(users_created+1, total_users))
+        self.progressbar = self.glade.get_object('users_progressbar')
+
+        # Plan all the groups, users and IDs up front, then create them all
+        # together in a worker thread
+        self.accounts = provisioning.ClassAccounts(self.system,
+            [c for c in self.classes if c], self.computers,
+            self.username_tmpl, self.name_tmpl, self.password_tmpl,
+            self.groups_tmpl,
+            self.glade.get_object('teachers_checkbutton').get_active())
+        errors = self.accounts.plan()
+        if errors:
+            self.show_errors(errors)
+            return
 
-                ev = lambda x: x.replace('{c}', classn.strip()).replace('{i}',
-                                str(compn)).replace('{0i}', '%02d'%compn)
-                epoch = datetime.datetime.utcfromtimestamp(0)
-                uname = ev(self.username_tmpl)
-                tmp_uid = self.system.get_free_uid(exclude=set_uids)
-                set_uids.append(tmp_uid)
-                tmp_gid = self.system.get_free_gid(exclude=set_gids)
-                tmp_password=ev(self.password_tmpl)
-                # Create the UPG
-                g = libuser.Group(uname, tmp_gid)
-                self.system.add_group(g)
-                u=libuser.User(name=uname, uid=tmp_uid,
-                    gid=tmp_gid, rname=ev(self.name_tmpl),
-                    directory=('/home/'+ev(self.username_tmpl)),
-                    lstchg = (datetime.datetime.today() - epoch).days,
-                    groups=[classn],
-                    password=self.system.encrypt(tmp_password))
-                self.system.add_user(u)
-                self.system.load()
-                users_created += 1
-                progressbar.set_fraction(float(users_created) / float(total_users))
-
-        #TODO expect returned value from add_user
-        if False and cmd_error != "":
-            self.glade.get_object('error_label').set_text(cmd_error.strip())
-            self.glade.get_object('error_hbox').show()
-            button_close.set_sensitive(True)
+        progress = lambda *args: reactor.callFromThread(self.on_progress, *args)
+        d = threads.deferToThread(self.accounts.apply, progress)
+        d.addCallback(self.on_applied)
+        d.addErrback(lambda failure: self.show_errors([str(failure.value)]))
+
+    def on_progress(self, message, done, total):
+        self.progressbar.set_text(message)
+        if total:
+            self.progressbar.set_fraction(float(done) / float(total))
+
+    def on_applied(self, errors):
+        if errors:
+            self.show_errors(errors)
             return
+        self.system.reload()
+
+        # Create shared folders
+        classes = [c for c in self.classes if c]
+        if classes and self.glade.get_object('shared_checkbutton').get_active():
+            self.sf.add(classes)
 
         # Display a success message and make the Close button sensitive
         #TODO self.glade.get_object('success_hbox').show()
-        progressbar.set_text("Η διαδικασία ολοκληρώθηκε.")
-        button_close.set_sensitive(True)
+        self.progressbar.set_fraction(1)
+        self.progressbar.set_text("Η διαδικασία ολοκληρώθηκε.")
+        self.glade.get_object('button_close').set_sensitive(True)
+
+    def show_errors(self, errors):
+        self.progressbar.set_text("Η διαδικασία απέτυχε.")
+        self.glade.get_object('error_label').set_text('\n'.join(errors))
+        self.glade.get_object('error_hbox').show()
+        self.glade.get_object('button_close').set_sensitive(True)
 
     def on_progress_button_close_clicked(self, widget):
         self.dialog.destroy()
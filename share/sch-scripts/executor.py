@@ -0,0 +1,182 @@
+# This file is part of sch-scripts, https://sch-scripts.gitlab.io
+# Copyright 2009-2022 the sch-scripts team, see AUTHORS
+# SPDX-License-Identifier: GPL-3.0-or-later
+"""
+Run external commands, either blocking or from a pool of threads with the
+results delivered to the twisted reactor.
+"""
+import concurrent.futures
+import os
+import subprocess
+import threading
+import time
+
+from twisted.internet import threads
+from twisted.python import threadpool
+
+import profiling
+
+
+class Result:
+    """The outcome of a command."""
+
+    def __init__(self, cmd, returncode, stdout, stderr, duration,
+                 timed_out=False):
+        self.cmd = cmd
+        self.returncode = returncode
+        self.stdout = stdout
+        self.stderr = stderr
+        self.duration = duration
+        self.timed_out = timed_out
+
+    @property
+    def ok(self):
+        return self.returncode == 0 and not self.timed_out
+
+    def __repr__(self):
+        return "<Result %r: %s in %.2fs>" % (
+            ' '.join(self.cmd), 'timeout' if self.timed_out
+            else self.returncode, self.duration)
+
+
+class Executor:
+    """Runs commands without blocking on full pipes.
+
+    run() waits for the command in the calling thread. run_async() runs it
+    in one of max_workers threads and returns a Deferred that fires in the
+    reactor thread with the Result, so GUI code can update widgets from its
+    callbacks. The on_stdout/on_stderr callbacks receive the output line by
+    line while the command runs.
+    """
+
+    def __init__(self, max_workers=4):
+        self.max_workers = max_workers
+        self.pool = None
+
+    def run(self, cmd, timeout=None, input=None, on_stdout=None,
+            on_stderr=None):
+        # Popen doesn't like integers like uid or gid in the command line.
+        cmd = [str(s) for s in cmd]
+        start = time.monotonic()
+        try:
+            p = subprocess.Popen(
+                cmd, stdin=subprocess.PIPE if input is not None
+                else subprocess.DEVNULL, stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE)
+        except OSError as e:
+            result = Result(cmd, 127, '', '%s\n' % e,
+                            time.monotonic() - start)
+            profiling.record('command.%s' % os.path.basename(cmd[0]),
+                             result.duration, False, cmd=cmd, error=str(e))
+            return result
+        if input is not None:
+            input = input.encode('utf-8')
+        timed_out = False
+        if on_stdout is None and on_stderr is None:
+            try:
+                out, err = p.communicate(input, timeout)
+            except subprocess.TimeoutExpired:
+                p.kill()
+                out, err = p.communicate()
+                timed_out = True
+        else:
+            out, err, timed_out = self._stream(p, timeout, input,
+                                               on_stdout, on_stderr)
+        result = Result(cmd, p.returncode, out.decode('utf-8', 'replace'),
+                        err.decode('utf-8', 'replace'),
+                        time.monotonic() - start, timed_out)
+        profiling.record('command.%s' % os.path.basename(cmd[0]),
+                         result.duration, result.ok, cmd=cmd,
+                         returncode=result.returncode, timed_out=timed_out)
+        return result
+
+    def _stream(self, p, timeout, input, on_stdout, on_stderr):
+        """Read both pipes in threads, passing each line to the callbacks."""
+        output = {p.stdout: [], p.stderr: []}
+
+        def reader(pipe, callback):
+            for line in iter(pipe.readline, b''):
+                output[pipe].append(line)
+                if callback:
+                    callback(line.decode('utf-8', 'replace'))
+            pipe.close()
+
+        readers = [threading.Thread(target=reader, args=args, daemon=True)
+                   for args in [(p.stdout, on_stdout), (p.stderr, on_stderr)]]
+        for t in readers:
+            t.start()
+        if input is not None:
+            try:
+                p.stdin.write(input)
+            except BrokenPipeError:
+                pass
+            p.stdin.close()
+        timed_out = False
+        try:
+            p.wait(timeout)
+        except subprocess.TimeoutExpired:
+            p.kill()
+            p.wait()
+            timed_out = True
+        for t in readers:
+            t.join()
+        return (b''.join(output[p.stdout]), b''.join(output[p.stderr]),
+                timed_out)
+
+    def run_many(self, cmds, timeout=None, max_workers=None):
+        """Run cmds concurrently, at most max_workers at a time, and return
+        their Results in the same order."""
+        cmds = list(cmds)
+        if len(cmds) < 2:
+            return [self.run(cmd, timeout) for cmd in cmds]
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers or self.max_workers) as pool:
+            return list(pool.map(lambda cmd: self.run(cmd, timeout), cmds))
+
+    def run_async(self, cmd, timeout=None, input=None, on_stdout=None,
+                  on_stderr=None):
+        """Return a Deferred that fires with the Result of cmd."""
+        # Imported here to not install the default reactor before the GUI
+        # installs gtk3reactor
+        from twisted.internet import reactor
+        if self.pool is None:
+            self.pool = threadpool.ThreadPool(0, self.max_workers,
+                                              'executor')
+            self.pool.start()
+            reactor.addSystemEventTrigger('during', 'shutdown',
+                                          self.pool.stop)
+        return threads.deferToThreadPool(
+            reactor, self.pool, self.run, cmd, timeout, input,
+            self._in_reactor(reactor, on_stdout),
+            self._in_reactor(reactor, on_stderr))
+
+    def _in_reactor(self, reactor, callback):
+        """Wrap callback to be called in the reactor thread."""
+        if callback is None:
+            return None
+        return lambda line: reactor.callFromThread(callback, line)
+
+
+executor = Executor()
+
+
+if __name__ == '__main__':
+    # Benchmark: mount 80 shared folders with a stub bindfs that takes as
+    # long as a FUSE daemon to start, serially and with run_many
+    import shutil
+    import tempfile
+
+    tmp = tempfile.mkdtemp()
+    try:
+        bindfs = os.path.join(tmp, 'bindfs')
+        with open(bindfs, 'w') as f:
+            f.write('#!/bin/sh\nsleep 0.1\n')
+        os.chmod(bindfs, 0o755)
+        cmds = [[bindfs, os.path.join(tmp, 'group%d' % i)] for i in range(80)]
+        for workers in [1, 4, 8, 16]:
+            start = time.monotonic()
+            results = executor.run_many(cmds, max_workers=workers)
+            assert all(r.ok for r in results)
+            print("%2d workers: %.2fs" % (workers, time.monotonic() - start))
+    finally:
+        shutil.rmtree(tmp)
@@ -6,6 +6,7 @@ Export users dialog.
 """
 import os
 from gi.repository import Gtk
+import config
 import parsers
 import common
 
@@ -31,9 +32,12 @@ class ExportDialog:
         resp = chooser.run()
         if resp == Gtk.ResponseType.OK:
             filename = chooser.get_filename()
-            if filename[-4:] != '.csv':
+            if not filename.endswith(('.csv', '.csv.gz', '.csv.xz')):
                 filename += '.csv'
-            self.csv.write(filename, system, users)
+            # Export the columns that are shown in the main window
+            columns = parsers.visible_columns(
+                config.parser.get('GUI', 'visible_user_columns'))
+            self.csv.write(filename, system, users, columns)
             os.chown(filename, int(os.environ['SUDO_UID']), int(os.environ['SUDO_GID']))
 
         chooser.destroy()
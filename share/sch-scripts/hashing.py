@@ -0,0 +1,183 @@
+# This file is part of sch-scripts, https://sch-scripts.gitlab.io
+# Copyright 2009-2022 the sch-scripts team, see AUTHORS
+# SPDX-License-Identifier: GPL-3.0-or-later
+"""
+Password hashing, with a process pool for hashing many passwords at once.
+"""
+import concurrent.futures
+import crypt
+import multiprocessing
+import os
+import pickle
+import secrets
+import subprocess
+import sys
+import threading
+
+SHA512 = 'sha512'
+YESCRYPT = 'yescrypt'
+# The crypt(3) salt alphabet
+SALT_CHARS = './0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz'
+# The default yescrypt parameters of libxcrypt, like in `mkpasswd -m yescrypt`
+YESCRYPT_PARAMS = 'j9T'
+
+
+def _yescrypt_salt():
+    return '$y$%s$%s$' % (YESCRYPT_PARAMS,
+                          ''.join(secrets.choice(SALT_CHARS) for i in range(22)))
+
+
+def _has_yescrypt():
+    result = crypt.crypt('', _yescrypt_salt())
+    return result is not None and result.startswith('$y$')
+
+HAS_YESCRYPT = _has_yescrypt()
+
+
+def salt(method=SHA512, rounds=None):
+    """Return a new crypt(3) setting string for method.
+    rounds is only used by SHA-512, the default is 5000.
+    """
+    if method == YESCRYPT:
+        if not HAS_YESCRYPT:
+            raise ValueError("yescrypt isn't supported by the system crypt")
+        return _yescrypt_salt()
+    elif method == SHA512:
+        return crypt.mksalt(crypt.METHOD_SHA512, rounds=rounds)
+    raise ValueError("Unknown hashing method '%s'" % method)
+
+
+def hash_password(plainpw, method=SHA512, rounds=None):
+    """Hash a single password in the current process."""
+    return crypt.crypt(plainpw, salt(method, rounds))
+
+
+def _hash_batch(plainpws, method, rounds):
+    return [hash_password(p, method, rounds) for p in plainpws]
+
+
+def _serve(workers):
+    """Run the pool, when this module is run as a script by Hasher: hash
+    the (parts, method, rounds) batches that are pickled to stdin and pickle
+    back (index, hashes) to stdout as each part completes."""
+    # The workers mustn't inherit the pipes to Hasher, or they would keep
+    # them open if this process died: move them off the standard streams,
+    # which all children inherit, and use spawn, which closes the rest
+    stdin = os.fdopen(os.dup(0), 'rb')
+    stdout = os.fdopen(os.dup(1), 'wb')
+    devnull = os.open(os.devnull, os.O_RDWR)
+    os.dup2(devnull, 0)
+    os.dup2(devnull, 1)
+    ctx = multiprocessing.get_context('spawn')
+    with concurrent.futures.ProcessPoolExecutor(workers,
+                                                mp_context=ctx) as pool:
+        while True:
+            try:
+                parts, method, rounds = pickle.load(stdin)
+            except EOFError:
+                break
+            futures = {pool.submit(_hash_batch, part, method, rounds): i
+                       for i, part in enumerate(parts)}
+            for future in concurrent.futures.as_completed(futures):
+                pickle.dump((futures[future], future.result()), stdout)
+                stdout.flush()
+
+
+class Hasher:
+    """Hash batches of passwords in a pool of worker processes.
+
+    The pool runs in a separate process that is this module run as a script,
+    so the workers import only this module, not the caller's __main__ with
+    Gtk, the reactor and D-Bus, and don't inherit the caller's threads and
+    file descriptors. It is started on the first batch that is large enough
+    and is reused until close() is called. Batches smaller than `threshold`
+    are hashed in the current process, since starting the workers costs more.
+    """
+
+    def __init__(self, workers=None, threshold=8):
+        self.workers = workers or os.cpu_count() or 1
+        self.threshold = threshold
+        self.pool = None
+        # One batch at a time goes through the pipes
+        self.lock = threading.Lock()
+
+    def _get_pool(self):
+        if self.pool is None:
+            self.pool = subprocess.Popen(
+                [sys.executable, os.path.abspath(__file__),
+                 str(self.workers)],
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                close_fds=True)
+        return self.pool
+
+    def hash(self, plainpws, progress=None, method=SHA512, rounds=None):
+        """Return the hashes of the plainpws list, in the same order.
+
+        progress(done, total) is called from the calling thread after each
+        completed part of the batch, so a GTK caller can update a progress
+        bar and run the pending events from it.
+        """
+        plainpws = list(plainpws)
+        total = len(plainpws)
+        # Validate the method before starting any workers
+        salt(method, rounds)
+        if total < self.threshold or self.workers == 1:
+            return self._hash_serial(plainpws, progress, method, rounds)
+
+        # Several small parts per worker, for a smoother progress
+        size = max(1, min(64, total // (self.workers * 4)))
+        parts = [plainpws[i:i+size] for i in range(0, total, size)]
+        results = [None] * len(parts)
+        with self.lock:
+            try:
+                pool = self._get_pool()
+                pickle.dump((parts, method, rounds), pool.stdin)
+                pool.stdin.flush()
+                done = 0
+                for i in range(len(parts)):
+                    index, hashes = pickle.load(pool.stdout)
+                    results[index] = hashes
+                    done += len(hashes)
+                    if progress:
+                        progress(done, total)
+            except (OSError, EOFError, pickle.UnpicklingError):
+                # No pool (e.g. too many open files) or it died
+                self._kill()
+                return self._hash_serial(plainpws, progress, method, rounds)
+        return [h for part in results for h in part]
+
+    def _hash_serial(self, plainpws, progress, method, rounds):
+        hashes = []
+        for plainpw in plainpws:
+            hashes.append(hash_password(plainpw, method, rounds))
+            if progress:
+                progress(len(hashes), len(plainpws))
+        return hashes
+
+    def close(self):
+        """Stop the pool; it exits when its stdin is closed."""
+        if self.pool is not None:
+            try:
+                self.pool.stdin.close()
+            except OSError:
+                pass
+            self.pool.wait()
+            self.pool.stdout.close()
+            self.pool = None
+
+    def _kill(self):
+        if self.pool is not None:
+            self.pool.kill()
+            for f in [self.pool.stdin, self.pool.stdout]:
+                try:
+                    f.close()
+                except OSError:
+                    pass
+            self.pool.wait()
+            self.pool = None
+
+
+hasher = Hasher()
+
+if __name__ == '__main__':
+    _serve(int(sys.argv[1]))
@@ -8,24 +8,40 @@ Import users dialog.
 import gi
 gi.require_version('Gtk', '3.0')
 gi.require_version('Gdk', '3.0')
-from gi.repository import Gtk, Gdk
+from gi.repository import Gtk, Gdk, GLib
+from twisted.internet import reactor, threads
 import os
 import re
 import sys
 
-import common
+import conflicts
 import dialogs
 import libuser
 import user_form
 
 # NOTE: User.plainpw overrides the User.password if it's set
 class ImportDialog:
-    def __init__(self, new_set):
+    def __init__(self, new_set, chunks=None, warnings=None, ids=None):
+        """new_set holds the users parsed so far. If chunks is given, it's
+        an iterator like parsers.CSV.iter_parse that keeps adding users to
+        new_set, and the rest of the rows are shown while it's consumed.
+        warnings is the list where the parser adds the skipped rows; they
+        are shown when all the rows are. ids is the (UIDs, GIDs) sets of
+        all the rows, so that the free IDs given to the users of the first
+        chunks aren't used by the rows that come later.
+        """
         self.set = new_set
-        # Remove the system users from the set
-        for u in list(self.set.users.values()):
-            if u.uid is not None and u.is_system_user():
-                self.set.remove_user(u)
+        self.chunks = chunks
+        self.warnings = warnings
+        self.idle_id = None
+        self.conflicts = conflicts.ConflictDetector(libuser.system)
+        # The row of each user in self.list
+        self.iters = {}
+        # The IDs given to the new users, to not give them again
+        if ids is not None:
+            self.new_uids, self.new_gids = set(ids[0]), set(ids[1])
+        else:
+            self.new_uids, self.new_gids = None, set()
 
         gladefile = "ui/import_dialog.ui"
         self.builder = Gtk.Builder()
@@ -46,9 +62,17 @@ class ImportDialog:
         self.menu = self.builder.get_object("menu")
 
         self.states = {'ok' : Gtk.STOCK_OK, 'error' : Gtk.STOCK_DIALOG_WARNING}
+        self.title = self.dialog.get_title()
         self.dialog.show_all()
         self.TreeView()
-        self.FillTree(self.set)
+        self.FillTree(list(self.set.users.values()))
+        if self.chunks is None:
+            self.FillDone()
+        else:
+            # Apply and auto resolve need all the users to be parsed
+            self.apply.set_sensitive(False)
+            self.resolve.set_sensitive(False)
+            self.idle_id = GLib.idle_add(self.FillNextChunk)
 
     def TreeView(self):
         """Make the liststore, the first 20 cells refers to users values,
@@ -86,9 +110,14 @@ class ImportDialog:
             self.tree.append_column(col)
         self.tree.get_column(19).set_visible(False)
 
-    def FillTree(self, new_set):
+    def FillTree(self, new_users):
         """Fill the preview popup dialog with new users."""
-        for u in new_set.users.values():
+        users = []
+        for u in new_users:
+            # Remove the system users from the set
+            if u.uid is not None and u.is_system_user():
+                self.set.remove_user(u)
+                continue
             self.AutoComplete(u)
             data = [u.name, u.uid, u.gid, u.primary_group, u.rname, u.office,
                     u.wphone, u.hphone, u.other, u.directory, u.shell,
@@ -100,10 +129,41 @@ class ImportDialog:
             for i in range(20):
                 data.append('') # cell's problem or ''
             data.append(self.states['ok']) # row's status
-            row = self.list[self.list.append(data)]
-            self.SetRowFromObject(row)
+            self.iters[u] = self.list.append(data)
+            self.SetRowFromObject(self.list[self.iters[u]])
+            users.append(u)
+        self.ShowConflicts(self.conflicts.add(users))
+
+    def FillNextChunk(self):
+        """Idle callback that shows the next chunk of the parsed users."""
+        try:
+            users = next(self.chunks)
+        except StopIteration:
+            self.idle_id = None
+            self.FillDone()
+            return False
+        self.FillTree(users)
+        self.dialog.set_title("%s (%d)" % (self.title, len(self.list)))
+        return True
+
+    def FillDone(self):
+        self.dialog.set_title(self.title)
+        self.resolve.set_sensitive(True)
         self.DetectConflicts()
         self.CheckIdenticalUsers()
+        if self.warnings:
+            text = "Παραλείφθηκαν οι παρακάτω γραμμές:\n\n%s" % \
+                '\n'.join(self.warnings[:20])
+            if len(self.warnings) > 20:
+                text += "\n...και άλλες %d." % (len(self.warnings) - 20)
+            dialogs.WarningDialog(text, "Προειδοποίηση").showup()
+
+    def StopFill(self):
+        if self.idle_id is not None:
+            GLib.source_remove(self.idle_id)
+            self.idle_id = None
+        if self.chunks is not None:
+            self.chunks.close()
 
     def SetRowFromObject(self, row):
         u = self.set.users[row[0]]
@@ -114,9 +174,11 @@ class ImportDialog:
         for i in range(len(data)):
             row[i] = data[i]
 
-    def CheckIdenticalUsers(self, other=libuser.system):
+    def CheckIdenticalUsers(self, other=None):
         """Check if there are users in the list that are identical to
         a user in the system and ask for removal."""
+        if other is None:
+            other = libuser.system
         attrs = ['name', 'uid', 'gid', 'primary_group', 'rname', 'office',
                  'wphone', 'hphone', 'other', 'directory', 'shell', 'min',
                  'max', 'warn', 'inact', 'expire', 'password']
@@ -129,7 +191,7 @@ class ImportDialog:
                 u_old = other.users[name]
                 same = True
                 for attr in attrs:
-                    if u_new.__dict__[attr] != u_old.__dict__[attr]:
+                    if getattr(u_new, attr) != getattr(u_old, attr):
                         same = False
                         break
                 if set(u_new.groups+[u_new.primary_group]) != set(u_old.groups):
@@ -144,63 +206,13 @@ class ImportDialog:
         msg = msg % (len(identical), ', '.join(self.list[iter_][0] for iter_ in identical))
         resp = dialogs.AskDialog(msg, "Βρέθηκαν πανομοιότυποι χρήστες").showup()
         if resp == Gtk.ResponseType.YES:
-            for iter_ in identical:
-                self.RemoveRow(iter_)
-            self.DetectConflicts()
+            self.RemoveRows(identical)
 
 
-    def AutoComplete(self, user): # TODO: Maybe move me to libuser?
+    def AutoComplete(self, user):
         """Fills the missing information of user, where possible."""
-        #TODO: Complete the username from real name, this can't be done now
-        # since we are using a dict to store users with username as a key
-        #  - Needs design change -
-
-        if user.directory in [None, '']:
-            user.directory = os.path.join(libuser.HOME_PREFIX, user.name)
-        if user.uid in [None, '']:
-            set_uids = [user.uid for u in self.set.users.values()]
-            user.uid = libuser.system.get_free_uid(exclude=set_uids)
-
-        set_gids = [u.gid for u in self.set.users.values()]
-        sys_gids = {g.gid : g for g in self.set.groups.values()}
-        if user.gid in [None, '']:
-            if user.primary_group in [None, '']:
-                user.primary_group = user.name
-            if user.name in libuser.system.groups:
-                user.gid = libuser.system.groups[user.name].gid
-            else:
-                user.gid = libuser.system.get_free_gid(exclude=set_gids)
-        else:
-            if user.primary_group in [None, '']:
-                if user.gid in sys_gids:
-                    user.primary_group = sys_gids[user.gid].name
-                else:
-                    user.primary_group = user.name
-        if user.primary_group in [None, '']:
-            allgroups = self.set.groups.values()[:]
-            allgroups.extend(libuser.system.groups.values())
-            for gr_obj in allgroups:
-                if gr_obj.gid == user.gid:
-                    user.primary_group = gr_obj.name
-                    break
-        if user.shell in [None, '']:
-            user.shell = '/bin/bash'
-        if user.min in [None, '']:
-            user.min = 0
-        if user.max in [None, '']:
-            user.max = 99999
-        if user.warn in [None, '']:
-            user.warn = 7
-        if user.lstchg in [None, '']:
-            user.lstchg = common.days_since_epoch()
-        if user.inact in [None, '']:
-            user.inact = -1
-        if user.expire in [None, '']:
-            user.expire = -1
-        if user.password in [None, '']:
-            user.password = '!'
-        if user.plainpw is None:
-            user.plainpw = ''
+        libuser.system.autocomplete_user(user, self.set, self.new_gids,
+                                         self.new_uids)
 
     def SetRowProps(self, row, col, prob, color=None, state=None):
         row[col+40] = prob
@@ -228,147 +240,36 @@ class ImportDialog:
                 row[60] = self.states['error']
 
     def DetectConflicts(self):
-        """Detects and marks the conflicts in the treeview based on the user
-        object.
+        """Detects and marks the conflicts of all the users in the treeview.
 
         Here we don't check for conflicts with secondary groups as they are
         easily resolvable.
         """
-        # All the system users
-        sys_users = {'uids' : [], 'gids' : [], 'dirs' : []}
-        sys_users['uids'] = [user.uid for user in libuser.system.users.values()]
-        sys_users['gids'] = [user.gid for user in libuser.system.users.values()]
-        sys_users['dirs'] = [user.directory for user in libuser.system.users.values()]
-        # All the users in the new Set
-        new_users = {'uids' : [], 'gids' : [], 'dirs' : []}
-        new_users['uids'] = [user.uid for user in self.set.users.values()]
-        new_users['gids'] = [user.gid for user in self.set.users.values()]
-        new_users['dirs'] = [user.directory for user in self.set.users.values()]
+        self.ShowConflicts(self.conflicts.check_all())
+
+    def ShowConflicts(self, users):
+        """Mark in the treeview the conflicts that were found for users."""
+        # FIXME: Possibly not an issue, but problems with system users
+        # will override problems with new users.
+        # Illegal input problems will *not* be overriden.
+        columns = list(range(20, 61))
+        for u in users:
+            if u not in self.iters:
+                continue
+            problems = self.conflicts.problems[u]
+            colors = ['red' if cell in problems else 'black'
+                      for cell in range(20)]
+            probs = [problems.get(cell, '') for cell in range(20)]
+            state = self.states['error' if problems else 'ok']
+            self.list.set(self.iters[u], columns, colors + probs + [state])
 
-        passed_users = {'names' : [], 'uids' : [], 'gids' : [], 'dirs' : []}
-        errors_found = False
-        for row in self.list:
-            u = self.set.users[row[0]]
-            # Clear the currently marked conflicts, if any
-            for cell in range(0, 20):
-                self.SetRowProps(row, cell, '')
-
-            # FIXME: Possibly not an issue, but problems with system users
-            # will override problems with new users.
-            # Illegal input problems will *not* be overriden.
-
-            # 'char' : Illegal inputted characters/regexp mismatch
-            # 'dup' : duplicate (only about the new users)
-            # 'con' : conflict (like duplicate but for existing/system users)
-            # 'hijack' : special case where the home exists, is not used by a
-            #            system user, but its uid:gid pair is different from the
-            #            new user's one.
-
-
-            # Illegal input checking #FIXME: This should be in a separate function
-                                     #and (for later): executed only once, since
-                                     #the edit dialog won't allow illegal input
-            def invalidate(n):
-                self.SetRowProps(row, n, 'char')
-            if not libuser.system.name_is_valid(u.name):
-                invalidate(0)
-            if not libuser.system.uid_is_valid(u.uid):
-                invalidate(1)
-            if not libuser.system.gid_is_valid(u.gid):
-                invalidate(2)
-            if not libuser.system.name_is_valid(u.primary_group):
-                invalidate(3)
-            if not libuser.system.gecos_is_valid(u.rname):
-                invalidate(4)
-            if not libuser.system.gecos_is_valid(u.office):
-                invalidate(5)
-            if not libuser.system.gecos_is_valid(u.wphone):
-                invalidate(6)
-            if not libuser.system.gecos_is_valid(u.hphone):
-                invalidate(7)
-            if not libuser.system.gecos_is_valid(u.other):
-                invalidate(8)
-            # Not checking homedir validity
-            if not libuser.system.shell_is_valid(u.shell):
-                invalidate(10)
-            for group in u.groups:
-                if not libuser.system.name_is_valid(group):
-                    invalidate(11)
-                    break
-            chage = [u.lstchg, u.min, u.max, u.warn, u.inact, u.expire]
-            for n, attr in enumerate(chage, 12):
-                if attr > 2147483647 or attr < -1:
-                    invalidate(n)
-
-            # Duplicate checking (New users)
-            if u.name in passed_users['names']:
-                self.SetRowProps(row, 0, 'dup')
-            if u.uid in passed_users['uids']:
-                self.SetRowProps(row, 1, 'dup')
-            #if u.gid in passed_users['gids']: # We don't care for > 1 users having the same primary group
-            #    self.SetRowProps(row, 2, 'dup')
-            if u.directory in passed_users['dirs']:
-                self.SetRowProps(row, 9, 'dup')
-
-            # Conflict checking (Existing system users)
-            if u.name in libuser.system.users:
-                self.SetRowProps(row, 0, 'con')
-            if u.uid in sys_users['uids']:
-                self.SetRowProps(row, 1, 'con')
-            # Check if the given GID belongs to the given group name
-            if u.primary_group in libuser.system.groups:
-                should_be = libuser.system.groups[u.primary_group].gid
-                if u.gid != should_be:
-                    self.SetRowProps(row, 2, 'mismatch %s' % should_be)
-            else:
-                if u.gid in sys_users['gids']:
-                    should_be = None
-                    for g in libuser.system.groups.values():
-                        if u.gid == g.gid:
-                            should_be = g.name
-                            break
-                    if should_be != u.primary_group:
-                        self.SetRowProps(row, 3, 'mismatch %s' % should_be)
-            #if u.gid in sys_users['gids']: # We don't care for > 1 users having the same primary group
-            #    self.SetRowProps(row, 2, 'con')
-            if u.directory in sys_users['dirs']:
-                self.SetRowProps(row, 9, 'con')
-            else:
-                # Special case, we want to use existing home dirs if they are not already used.
-                if os.path.isdir(u.directory) and u.directory not in sys_users['dirs']:
-                    # See if the home and the uid:gid of the user are different
-                    #print "Homedir for user %s exists in the FS." % u.name # XXX: Debug
-                    dir_stat = os.stat(u.directory)
-                    if u.uid != int(dir_stat.st_uid):
-                        self.SetRowProps(row, 1, 'hijack')
-                        self.SetRowProps(row, 9, 'hijack')
-                    if u.gid != dir_stat.st_gid:
-                        self.SetRowProps(row, 2, 'hijack')
-                        self.SetRowProps(row, 9, 'hijack')
-                    #print "\tUser: - %s:%s -" % (u.uid, u.gid) # XXX: Debug
-                    #print "\tDir : - %s:%s -" % (dir_stat.st_uid, dir_stat.st_gid) # XXX: Debug
-
-            passed_users['names'].append(u.name)
-            passed_users['uids'].append(u.uid)
-            passed_users['gids'].append(u.gid)
-            passed_users['dirs'].append(u.directory)
-
-            if row[60] == self.states['error']:
-                errors_found = True
-
-        self.apply.set_sensitive(not errors_found)
+        self.apply.set_sensitive(not self.conflicts.errors
+                                 and self.idle_id is None)
 
     def ResolveConflicts(self, widget=None):
-        # All the system users
-        sys_users = {'uids' : [], 'gids' : [], 'dirs' : []}
-        sys_users['uids'] = [user.uid for user in libuser.system.users.values()]
-        sys_users['gids'] = [user.gid for user in libuser.system.users.values()]
-        sys_users['dirs'] = [user.directory for user in libuser.system.users.values()]
         # All the users in the new Set
-        new_users = {'uids' : [], 'gids' : [], 'dirs' : []}
-        new_users['uids'] = [user.uid for user in self.set.users.values()]
-        new_users['gids'] = [user.gid for user in self.set.users.values()]
-        new_users['dirs'] = [user.directory for user in self.set.users.values()]
+        new_users = {'uids' : set(user.uid for user in self.set.users.values()),
+                     'gids' : set(user.gid for user in self.set.users.values())}
 
         log = []
         def log_msg(item, user, a, b):
@@ -392,28 +293,28 @@ class ImportDialog:
 
             if row[1+ofs] in ['dup', 'con']:
                 new_uid = libuser.system.get_free_uid(exclude=new_users['uids'])
-                new_users['uids'].append(new_uid)
+                new_users['uids'].add(new_uid)
                 log_uid(u.name, u.uid, new_uid)
                 u.uid = new_uid
                 self.SetRowProps(row, 1, '')
 
             elif row[1+ofs] == 'hijack':
                 dir_uid = os.stat(u.directory).st_uid
-                new_users['uids'].append(dir_uid)
+                new_users['uids'].add(dir_uid)
                 log_uid(u.name, u.uid, dir_uid)
                 u.uid = dir_uid
                 self.SetRowProps(row, 1, '')
 
             #if row[2+ofs] in ['dup', 'con']:
             #    new_gid = libuser.system.get_free_gid(exclude=new_users['gids'])
-            #    new_users['gids'].append(new_gid)
+            #    new_users['gids'].add(new_gid)
             #    log_gid(u.name, u.gid, new_gid)
             #    u.uid = new_uid
             #    self.SetRowProps(row, 2, '')
 
             if 'mismatch' in row[2+ofs]:
                 new_gid = int(row[2+ofs].split()[1])
-                new_users['gids'].append(new_gid)
+                new_users['gids'].add(new_gid)
                 log_gid(u.name, u.gid, new_gid)
                 if u.primary_group in self.set.groups:
                     self.set.groups[u.primary_group].gid = new_gid
@@ -422,7 +323,7 @@ class ImportDialog:
 
             if row[2+ofs] == 'hijack':
                 dir_gid = os.stat(u.directory).st_gid
-                new_users['gids'].append(dir_gid)
+                new_users['gids'].add(dir_gid)
                 log_gid(u.name, u.gid, dir_gid)
                 u.gid = dir_gid
                 self.SetRowProps(row, 2, '')
@@ -437,7 +338,7 @@ class ImportDialog:
                     self.set.groups[new_gname] = libuser.Group(new_gname, u.gid)
                     self.set.groups[new_gname].members[u.name] = u
                 if u.primary_group in self.set.groups:
-                    if self.set.groups[u.primary_group].members.keys() == [u.name]:
+                    if list(self.set.groups[u.primary_group].members) == [u.name]:
                         del self.set.groups[u.primary_group]
                     else:
                         del self.set.groups[u.primary_group].members[u.name]
@@ -464,49 +365,54 @@ class ImportDialog:
     def Apply(self, widget):
         text = "Να δημιουργηθούν οι νέοι χρήστες;"
         response = dialogs.AskDialog(text, "Confirm").showup()
-        if response == Gtk.ResponseType.YES:
-            new_groups = {}
-            new_gids = [u.gid for u in self.set.users.values()]
-            sys_gids = [g.gid for g in libuser.system.groups.values()]
-            for u in self.set.users.values():
-                if u.primary_group not in libuser.system.groups:
-                   if u.primary_group not in new_groups:
-                        g_obj = libuser.Group(u.primary_group, u.gid)
-                        new_groups[u.primary_group] = g_obj
-                   new_groups[u.primary_group].members[u.name] = u
-
-            for u in self.set.users.values():
-                for g in u.groups:
-                    if g not in libuser.system.groups:
-                        if g not in new_groups:
-                            g_obj = libuser.Group(g)
-                            if g in self.set.groups:
-                                g_obj.gid = self.set.groups[g].gid
-                            if g_obj.gid in new_gids+sys_gids or g_obj.gid is None:
-                                g_obj.gid = libuser.system.get_free_gid(exclude=new_gids)
-                                new_gids.append(g_obj.gid)
-                            new_groups[g] = g_obj
-                        new_groups[g].members[u.name] = u
-
-            for gr in new_groups.values():
-                gr_tmp = libuser.Group(gr.name, gr.gid)
-                libuser.system.add_group(gr_tmp)
-            for u in self.set.users.values():
-                libuser.system.add_user(u)
-            for gr in new_groups.values():
-                for u in gr.members.values():
-                    libuser.system.add_user_to_groups(u, [gr])
-
-        else:
+        if response != Gtk.ResponseType.YES:
             return False
-
+        self.StopFill()
+        # Write all the accounts in a single transaction in a worker thread,
+        # instead of running useradd etc for each user in the GUI thread.
+        # The memberships are written from the users' groups.
+        users = list(self.set.users.values())
+        groups = [libuser.Group(gr.name, gr.gid) for gr in
+                  libuser.system.groups_to_create(self.set).values()]
+        self.dialog.set_sensitive(False)
+        progress = lambda done, total: reactor.callFromThread(
+            self.ApplyProgress, done, total)
+        d = threads.deferToThread(libuser.system.add_users, users, groups,
+                                  progress=progress)
+        d.addCallback(self.Applied)
+        d.addErrback(self.ApplyFailed)
+
+    def ApplyProgress(self, done, total):
+        self.dialog.set_title("%s (%d/%d)" % (self.title, done, total))
+
+    def Applied(self, results):
+        libuser.system.reload()
+        failed = ["Ομάδα %s: %s" % (name, error) for name, (ok, error)
+                  in results['groups'].items() if not ok]
+        failed_users = ["%s: %s" % (name, error) for name, (ok, error)
+                        in results['users'].items() if not ok]
+        failed += failed_users
+        text = "Δημιουργήθηκαν %d από τους %d χρήστες." % (
+            len(results['users']) - len(failed_users), len(results['users']))
+        if failed:
+            text += "\n\nΑπέτυχαν τα παρακάτω:\n%s" % '\n'.join(failed[:20])
+            if len(failed) > 20:
+                text += "\n...και άλλα %d." % (len(failed) - 20)
+            dialogs.WarningDialog(text, "Εισαγωγή χρηστών").showup()
+        else:
+            dialogs.InfoDialog(text, "Εισαγωγή χρηστών").showup()
         self.dialog.destroy()
 
+    def ApplyFailed(self, failure):
+        dialogs.ErrorDialog(str(failure.value), "Σφάλμα").showup()
+        self.dialog.destroy()
 
     def Cancel(self, widget):
+        self.StopFill()
         self.dialog.destroy()
 
     def Exit(self, widget, event):
+        self.StopFill()
         self.dialog.destroy()
 
     def Tooltip(self, widget, x, y, keyboard_tip, tooltip):
@@ -563,31 +469,25 @@ class ImportDialog:
     def on_delete_users_activate(self, widget):
         selection = self.tree.get_selection()
         model, paths = selection.get_selected_rows()
-        iters = [model.get_iter(path) for path in paths]
-        for i in iters:
-            self.RemoveRow(i)
-        self.DetectConflicts()
+        self.RemoveRows([model.get_iter(path) for path in paths])
 
     def EditedText(self, cell, path, new_text, model, col):
         username = model[path][0]
         u = self.set.users[username]
         int_columns = [1,2,12,13,14,15,16,17]
-        attrs = ['name', 'uid', 'gid', 'primary_group', 'rname', 'office',
-                 'wphone', 'hphone', 'other', 'directory', 'shell', 'groups',
-                 'lstchg', 'min', 'max', 'warn', 'inact', 'expire', 'password',
-                 'plainpw']
+        attrs = libuser.User.FIELDS
         if col in int_columns:
             try:
-                u.__dict__[attrs[col]] = int(new_text)
+                setattr(u, attrs[col], int(new_text))
             except ValueError:
                 return
         else:
             if col == 0:
                 if new_text in self.set.users:
                     return
+                # This also renames the key in self.set.users
                 u.name = new_text
                 u.directory = '/home/%s' % new_text
-                self.set.users[new_text] = self.set.users.pop(username)
                 model[path][0] = u.name
             elif col == 11:
                 u.groups = new_text.strip().split(',')
@@ -596,23 +496,26 @@ class ImportDialog:
                 u.plainpw = new_text
                 u.password = libuser.system.encrypt(u.plainpw)
             else:
-                u.__dict__[attrs[col]] = new_text
+                setattr(u, attrs[col], new_text)
         self.SetRowFromObject(model[path])
-        self.DetectConflicts()
+        self.ShowConflicts(self.conflicts.update(u))
 
     def Delete(self, treeview, event):
         if Gdk.keyval_name(event.keyval) == "Delete":
             selection = treeview.get_selection()
             model, paths = selection.get_selected_rows()
-            iters = [model.get_iter(path) for path in paths]
-            for i in iters:
-                self.RemoveRow(i)
-            self.DetectConflicts()
-
-    def RemoveRow(self, iter_):
-        username = self.list[iter_][0]
-        self.list.remove(iter_)
-        self.set.remove_user(self.set.users[username])
+            self.RemoveRows([model.get_iter(path) for path in paths])
+
+    def RemoveRows(self, iters):
+        users = []
+        for iter_ in iters:
+            u = self.set.users[self.list[iter_][0]]
+            self.list.remove(iter_)
+            del self.iters[u]
+            self.set.remove_user(u)
+            users.append(u)
+        # Only the users that had duplicate values with them need checking
+        self.ShowConflicts(self.conflicts.remove(users))
 
 if __name__ == "__main__":
     interface = ImportDialog()
@@ -13,11 +13,13 @@ import dialogs
 import dbus
 import common
 import parsers
+import profiling
 
 ## Define global variables
 
 IP_REG = "^(([0-9]|[1-9][0-9]|1[0-9]{2}|2[0-4][0-9]|25[0-5])\.){3}([1-9]|[1-9][0-9]|1[0-9]{2}|2[0-4][0-9]|25[0-4])$"
-BUS = dbus.SystemBus()
+# The system bus is connected on first use, see get_bus()
+BUS = None
 DBUS_SERVICE_NAME = 'org.freedesktop.NetworkManager'
 MSG_PC_CONFLICT_IP = 'Η διεύθυνση {0} χρησιμοποιείται ήδη από άλλον υπολογιστή. Παρακάλω δώστε μια διαφορετική.'
 MSG_ROUTE_CONFLICT_IP = 'Η διεύθυνση {0} χρησιμοποιείται ήδη σαν προεπιλεγμένη διαδρομή. Παρακάλω δώστε μια διαφορετική.'
@@ -81,6 +83,16 @@ def subnet_to_bits(subnet):
     return sum([bin(int(x)).count('1') for x in subnet.split('.')])
 
 
+def get_bus():
+    """
+    Connect to the system bus, once
+    """
+    global BUS
+    if BUS is None:
+        BUS = dbus.SystemBus()
+    return BUS
+
+
 ## Define Network Manager classes
 
 class Network_Manager_DBus(object):
@@ -88,7 +100,7 @@ class Network_Manager_DBus(object):
         """
         Return NetworkManager DBus
         """
-        self.proxy = BUS.get_object(DBUS_SERVICE_NAME, object_path)
+        self.proxy = get_bus().get_object(DBUS_SERVICE_NAME, object_path)
         self.interface = dbus.Interface(self.proxy, interface_name)
         try:
             self.properties = self.interface.get_dbus_method('GetAll', dbus_interface='org.freedesktop.DBus.Properties')(interface_name)
@@ -245,6 +257,14 @@ class Connection_Settings(Network_Manager_DBus):
 
 ## Define Information class
 
+# Time the D-Bus calls to NetworkManager, see profiling.py
+Network_Manager_DBus.__init__ = profiling.timed('dbus.GetAll')(
+    Network_Manager_DBus.__init__)
+profiling.instrument(Network_Manager, ['get_devices'], 'dbus')
+profiling.instrument(Settings, ['get_list_connections'], 'dbus')
+profiling.instrument(Connection_Settings, ['get_settings'], 'dbus')
+
+
 class Info:
     def __init__(self, ip=None, mask=None, route=None, dnss=None):
         self.ip, self.mask, self.route, self.dnss = ip, mask, route, dnss
@@ -894,3 +914,6 @@ class Ip_Dialog:
 
         GObject.idle_add(self.create_update_connections, interest_interfaces, prefered_hostname, dnsmasq_via_carrier,
                          dnsmasq_via_autoconnect)
+
+profiling.instrument(Ip_Dialog, ['initialize_interfaces',
+                                 'create_update_connections'], 'ip_dialog')
@@ -6,9 +6,13 @@
 Transliterate and transcript according to iso843:
 https://www.sete.gr/files/Media/Egkyklioi/040707Latin-Greek.pdf
 """
+import functools
 import re
 import unicodedata
 
+# The transcripted or transliterated strings that are remembered
+CACHE_SIZE = 4096
+
 
 _mapping_letters = {
 'α' : 'a', 'ά' : 'á', 'β' : 'v', 'γ' : 'g', 'δ' : 'd', 'ε' : 'e',
@@ -46,26 +50,42 @@ _reg6 = '('+_re_reg5.lower()+'|'+_re_reg5.upper()+')('+_re_reg6.lower()+'|'+_re_
 
 _reg7 = '('+_re_reg7.lower()+'|'+_re_reg7.upper()+')('+_re_reg8.lower()+'|'+_re_reg8.upper()+')'
 
+_re1, _re2, _re3, _re4, _re5, _re6, _re7 = (
+    re.compile(r) for r in [_reg1, _reg2, _reg3, _reg4, _reg5, _reg6, _reg7])
 
-def transcript(string, accents=True):
-    string = re.sub(_reg1, replace_v, string)
-    string = re.sub(_reg2, replace_f, string)
-    string = re.sub(_reg3, replace_b, string)
-    string = re.sub(_reg5, replace_g, string)
-    string = re.sub(_reg7, replace_ou, string)
-
-    letters = []
-    for letter in string:
+
+class _Letters(dict):
+    """A str.translate table for the letter by letter mapping. Uppercase
+    letters map to the uppercase mapping of their lowercase letter; the
+    entries are filled in the first time each character is seen."""
+
+    def __missing__(self, code):
+        letter = chr(code)
         if letter in _mapping_letters:
-            letters.append(_mapping_letters[letter])
+            value = _mapping_letters[letter]
         elif letter.lower() in _mapping_letters:
-            letters.append(_mapping_letters[letter.lower()].upper())
+            value = _mapping_letters[letter.lower()].upper()
         else:
-            letters.append(letter)
+            value = letter
+        self[code] = value
+        return value
+
+_letters = _Letters()
 
-    string = ''.join(letters)
 
-    if re.match(_reg4, string):
+@functools.lru_cache(maxsize=CACHE_SIZE)
+def transcript(string, accents=True):
+    # The passes are applied one after the other, as each one sees the
+    # replacements of the previous ones
+    string = _re1.sub(replace_v, string)
+    string = _re2.sub(replace_f, string)
+    string = _re3.sub(replace_b, string)
+    string = _re5.sub(replace_g, string)
+    string = _re7.sub(replace_ou, string)
+
+    string = string.translate(_letters)
+
+    if _re4.match(string):
         string = string.replace(string[1], string[1].lower())
 
     if accents:
@@ -74,21 +94,13 @@ def transcript(string, accents=True):
         return strip_accents(string)
 
 
+@functools.lru_cache(maxsize=CACHE_SIZE)
 def transliterate(string, accents=True):
-    string = re.sub(_reg6, replace_ou, string)
+    string = _re6.sub(replace_ou, string)
 
-    letters = []
-    for letter in string:
-        if letter in _mapping_letters:
-            letters.append(_mapping_letters[letter])
-        elif letter.lower() in _mapping_letters:
-            letters.append(_mapping_letters[letter.lower()].upper())
-        else:
-            letters.append(letter)
+    string = string.translate(_letters)
 
-    string = ''.join(letters)
-
-    if re.match(_reg4, string):
+    if _re4.match(string):
         string = string.replace(string[1], string[1].lower())
 
     if accents:
@@ -97,6 +109,16 @@ def transliterate(string, accents=True):
         return strip_accents(string)
 
 
+def transcript_many(strings, accents=True):
+    """Return the transcriptions of a list of strings."""
+    return [transcript(s, accents) for s in strings]
+
+
+def transliterate_many(strings, accents=True):
+    """Return the transliterations of a list of strings."""
+    return [transliterate(s, accents) for s in strings]
+
+
 def replace_v(m):
     response = m.group(0)
     if m.group(2) == 'ύ' or m.group(2) == 'Ύ':
@@ -182,5 +204,79 @@ def replace_ou(m):
 
 
 def strip_accents(string):
+    if string.isascii():
+        return string
     return ''.join((c for c in unicodedata.normalize('NFD', string) if unicodedata.category(c) != 'Mn'))
 
+
+
+if __name__ == '__main__':
+    # Check that the compiled, cached passes give the same results as the
+    # original uncached ones over all the two and three letter combinations
+    # of the Greek letters and some names, with and without accents; then
+    # benchmark them, and transcript_many on a list of repeated names
+    import itertools
+    import time
+
+    def old_letters(string):
+        letters = []
+        for letter in string:
+            if letter in _mapping_letters:
+                letters.append(_mapping_letters[letter])
+            elif letter.lower() in _mapping_letters:
+                letters.append(_mapping_letters[letter.lower()].upper())
+            else:
+                letters.append(letter)
+        string = ''.join(letters)
+        if re.match(_reg4, string):
+            string = string.replace(string[1], string[1].lower())
+        return string
+
+    def old_strip_accents(string):
+        return ''.join((c for c in unicodedata.normalize('NFD', string) if unicodedata.category(c) != 'Mn'))
+
+    def old_transcript(string, accents=True):
+        string = re.sub(_reg1, replace_v, string)
+        string = re.sub(_reg2, replace_f, string)
+        string = re.sub(_reg3, replace_b, string)
+        string = re.sub(_reg5, replace_g, string)
+        string = re.sub(_reg7, replace_ou, string)
+        string = old_letters(string)
+        return string if accents else old_strip_accents(string)
+
+    def old_transliterate(string, accents=True):
+        string = re.sub(_reg6, replace_ou, string)
+        string = old_letters(string)
+        return string if accents else old_strip_accents(string)
+
+    letters = [l for l in _mapping_letters] + [l.upper() for l in _mapping_letters if len(l.upper()) == 1]
+    names = ['Γιώργος Παπαδόπουλος', 'Ευαγγελία Μπουρνάζου', 'Αύγουστος Χατζής',
+             'ΨΑΡΡΟΣ Θεόδωρος', 'Χριστίνα Ηλιού', 'Ναυσικά Ευθυμίου',
+             'Γκόγκος Μπάμπης', 'Ιωάννα Δ. Αγγέλου-Smith', '']
+    corpus = [''.join(c) for n in [2, 3] for c in itertools.product(letters, repeat=n)] + names
+    pairs = [(transcript, old_transcript), (transliterate, old_transliterate)]
+    for func, old in pairs:
+        for accents in [True, False]:
+            func.cache_clear()
+            different = [s for s in corpus if func(s, accents) != old(s, accents)]
+            assert not different, (func.__name__, accents, different[:10])
+    print("%d strings give the same results as before" % len(corpus))
+
+    for func, old in pairs:
+        for accents in [True, False]:
+            durations = []
+            for f in [old, func]:
+                if f is func:
+                    func.cache_clear()
+                start = time.time()
+                for s in corpus:
+                    f(s, accents)
+                durations.append(time.time() - start)
+            print("%s(accents=%s): %d strings in %.2fs, before %.2fs" % (
+                func.__name__, accents, len(corpus), durations[1], durations[0]))
+    names = names[:3] * 10000
+    transcript.cache_clear()
+    start = time.time()
+    transcript_many(names, False)
+    duration = time.time() - start
+    print("transcript_many: %d names in %.3fs" % (len(names), duration))
@@ -5,17 +5,20 @@
 """
 User handling classes and functions.
 """
+from twisted.internet import defer
 from twisted.internet import inotify
 from twisted.python import filepath
-import crypt
 import grp
 import os
 import pwd
-import random
 import re
 import spwd
 import common
+import executor
+import hashing
 import iso843
+import profiling
+import shadow
 
 FIRST_SYSTEM_UID = 0
 LAST_SYSTEM_UID = 999
@@ -30,6 +33,8 @@ FIRST_GID = 1000
 LAST_GID = 29999
 NAME_REGEX = "^[a-z][-a-z0-9_]*$"
 HOME_PREFIX = "/home"
+# Seconds to wait for useradd, which also copies /etc/skel
+COMMAND_TIMEOUT = 120
 
 USER_FIELDS = ['Όνομα χρήστη', 'UID', 'Κύρια ομάδα', 'Ονοματεπώνυμο',
                'Γραφείο', 'Τηλ. γραφείου', 'Τηλ. οικίας', 'Άλλο', 'Κατάλογος',
@@ -46,12 +51,60 @@ CSV_USER_FIELDS.insert(3, 'Όνομα κύριας ομάδας')
 CSV_USER_FIELDS.extend(['Κρυπτογραφημένος κωδικός', 'Κωδικός'])
 
 
+class Indexed:
+    """An attribute that keeps the indexes of the Sets it's in up to date."""
+
+    def __set_name__(self, owner, name):
+        self.name = name
+        self.private = '_' + name
+
+    def __get__(self, obj, objtype=None):
+        if obj is None:
+            return self
+        return getattr(obj, self.private)
+
+    def __set__(self, obj, value):
+        if obj._tables:
+            old = getattr(obj, self.private)
+            if old != value:
+                for table in obj._tables:
+                    table.check(obj, self.name, value)
+                for table in obj._tables:
+                    table.reindex(obj, self.name, old, value)
+        setattr(obj, self.private, value)
+
+
 class User:
+    """A user account.
+
+    Users are kept in __slots__ as there may be tens of thousands of them.
+    The primary_group name, unless explicitly set, is resolved lazily from
+    the gid, from the groups of the Sets that contain the user, and then
+    from NSS only for the users of libuser.system; it's '' if not found.
+    """
+    # All the fields, in CSV_USER_FIELDS order
+    FIELDS = ('name', 'uid', 'gid', 'primary_group', 'rname', 'office',
+              'wphone', 'hphone', 'other', 'directory', 'shell', 'groups',
+              'lstchg', 'min', 'max', 'warn', 'inact', 'expire', 'password',
+              'plainpw')
+    INT_FIELDS = ('uid', 'gid', 'lstchg', 'min', 'max', 'warn', 'inact',
+                  'expire')
+    __slots__ = ('_tables', '_name', '_uid', '_directory', '_primary_group',
+                 '_resolved', 'gid', 'rname', 'office', 'wphone', 'hphone',
+                 'other', 'shell', 'groups', 'lstchg', 'min', 'max', 'warn',
+                 'inact', 'expire', 'password', 'plainpw')
+    name = Indexed()
+    uid = Indexed()
+    directory = Indexed()
+
     def __init__(self, name=None, uid=None, gid=None, rname="", office="",
                  wphone="", hphone="", other="", directory=None,
                  shell="/bin/bash", groups=None, lstchg=None, min=0, max=99999,
                  warn=7, inact=-1, expire=-1, password="*", plainpw=None):
 
+        # The Tables this user is in, see Indexed
+        self._tables = ()
+        self._primary_group = self._resolved = None
         self.name, self.uid, self.gid, self.rname, self.office, self.wphone, \
             self.hphone, self.other, self.directory, self.shell, self.groups, \
             self.lstchg, self.min, self.max, self.warn, self.inact, \
@@ -66,16 +119,50 @@ class User:
         if self.groups is None:
             self.groups = []
 
-        if self.gid is not None:
-            try:
-                self.primary_group = grp.getgrgid(self.gid).gr_name
-            except Exception:
-                self.primary_group = ''
-        else:
-            self.primary_group = None
-
     def __str__(self):
-        return str(self.__dict__)
+        return str(dict((field, getattr(self, field)) for field in self.FIELDS))
+
+    @property
+    def primary_group(self):
+        if self._primary_group is not None:
+            return self._primary_group
+        if self.gid is None:
+            return None
+        nss = False
+        for table in self._tables:
+            if table.groups is not None:
+                group = table.groups.indexes['gid'].first(self.gid)
+                if group is not None:
+                    return group.name
+            nss = nss or table.nss
+        # Only the users of libuser.system may be resolved from NSS, as
+        # the gids of e.g. imported users may name other groups locally
+        if not nss:
+            return ''
+        if self._resolved is not None and self._resolved[0] == self.gid:
+            return self._resolved[1]
+        try:
+            name = grp.getgrgid(self.gid).gr_name
+        except Exception:
+            name = ''
+        self._resolved = (self.gid, name)
+        return name
+
+    @primary_group.setter
+    def primary_group(self, value):
+        self._primary_group = value
+
+    def set_field(self, field, value):
+        """Set one of the FIELDS from a string, converting it to int
+        where needed; invalid numbers are set to None."""
+        if field not in self.FIELDS:
+            raise KeyError(field)
+        if field in self.INT_FIELDS and value is not None:
+            try:
+                value = int(value)
+            except ValueError:
+                value = None
+        setattr(self, field, value)
 
     def is_system_user(self):
         return not (self.uid >= FIRST_UID and self.uid <= LAST_UID)
@@ -92,7 +179,12 @@ class User:
 
 
 class Group:
+    __slots__ = ('_tables', '_name', '_gid', 'members', 'password')
+    name = Indexed()
+    gid = Indexed()
+
     def __init__(self, name=None, gid=None, members=None, password=""):
+        self._tables = ()
         self.name, self.gid, self.members, self.password = \
             name, gid, members, password
 
@@ -109,14 +201,212 @@ class Group:
             and len(self.members) == 1
 
 
-# TODO: Change implementation, don't use dicts since they have to be updated
-#       when the user/group_object.name changes. python sets would be good.
+class Index(dict):
+    """Maps attribute values to the objects that have them.
+
+    Most values are unique, so a single object is stored directly and only
+    duplicates are stored in lists, to save memory.
+    """
+
+    def add(self, value, obj):
+        if value is None:
+            return
+        other = self.get(value)
+        if other is None:
+            self[value] = obj
+        elif type(other) is list:
+            other.append(obj)
+        elif other is not obj:
+            self[value] = [other, obj]
+
+    def discard(self, value, obj):
+        other = self.get(value)
+        if other is obj:
+            del self[value]
+        elif type(other) is list:
+            other = [o for o in other if o is not obj]
+            self[value] = other[0] if len(other) == 1 else other
+
+    def first(self, value):
+        """Return one of the objects that have value, or None."""
+        other = self.get(value)
+        if type(other) is list:
+            return other[0]
+        return other
+
+
+class IdPool(Index):
+    """An Index of UIDs or GIDs that also finds free IDs quickly.
+
+    The IDs below SIZE are mirrored in a bitmap, so that searching for the
+    first free one is done by bytearray.find instead of a Python loop.
+    """
+    SIZE = 65536
+
+    def __init__(self):
+        super(IdPool, self).__init__()
+        self.bitmap = bytearray(self.SIZE)
+
+    def add(self, value, obj):
+        super(IdPool, self).add(value, obj)
+        if isinstance(value, int) and 0 <= value < self.SIZE:
+            self.bitmap[value] = 1
+
+    def discard(self, value, obj):
+        super(IdPool, self).discard(value, obj)
+        if isinstance(value, int) and 0 <= value < self.SIZE \
+                and value not in self:
+            self.bitmap[value] = 0
+
+    def find_free(self, start, end, reverse=False, ignore=None,
+                  exclude=None):
+        """Return the first ID between start and end that isn't used or
+        excluded, or ignore if that comes first; None if there's none.
+        exclude can also be an Index, e.g. the IDs of another Set."""
+        if not exclude:
+            exclude = ()
+        elif not isinstance(exclude, (set, frozenset, dict)):
+            exclude = set(exclude)
+        if reverse:
+            found = self._find_free_reverse(start, end, exclude)
+        else:
+            found = self._find_free(start, end, exclude)
+        if ignore is not None and start <= ignore <= end and (
+                found is None or (ignore > found if reverse
+                                  else ignore < found)):
+            found = ignore
+        return found
+
+    def _find_free(self, start, end, exclude):
+        i = start
+        while i <= end:
+            if 0 <= i < self.SIZE:
+                i = self.bitmap.find(0, i, min(end + 1, self.SIZE))
+                if i == -1:
+                    i = self.SIZE
+                    continue
+            elif i in self:
+                i += 1
+                continue
+            if i not in exclude:
+                return i
+            i += 1
+        return None
+
+    def _find_free_reverse(self, start, end, exclude):
+        i = end
+        while i >= start:
+            if 0 <= i < self.SIZE:
+                i = self.bitmap.rfind(0, max(start, 0), i + 1)
+                if i == -1:
+                    i = min(start, 0) - 1
+                    continue
+            elif i in self:
+                i -= 1
+                continue
+            if i not in exclude:
+                return i
+            i -= 1
+        return None
+
+
+class Table(dict):
+    """A dict of User or Group objects keyed by name, with indexes.
+
+    The indexes, and the name keys themselves, are updated when the
+    indexed attributes of the objects change.
+    """
+
+    def __init__(self, pools=(), indexes=(), items=None, groups=None,
+                 nss=False):
+        super(Table, self).__init__()
+        # For a Table of users, the Table of groups to resolve primary_group
+        # and whether to fall back to NSS for the gids that aren't there
+        self.groups = groups
+        self.nss = nss
+        self.indexes = dict((attr, IdPool()) for attr in pools)
+        self.indexes.update((attr, Index()) for attr in indexes)
+        if items:
+            self.update(items)
+
+    def __setitem__(self, name, obj):
+        if name in self:
+            self._unlink(dict.__getitem__(self, name))
+        dict.__setitem__(self, name, obj)
+        obj._tables += (self,)
+        for attr, index in self.indexes.items():
+            index.add(getattr(obj, attr), obj)
+
+    def __delitem__(self, name):
+        self._unlink(dict.pop(self, name))
+
+    def _unlink(self, obj):
+        obj._tables = tuple(t for t in obj._tables if t is not self)
+        for attr, index in self.indexes.items():
+            index.discard(getattr(obj, attr), obj)
+
+    def pop(self, name, *default):
+        if name not in self and default:
+            return default[0]
+        obj = dict.__getitem__(self, name)
+        del self[name]
+        return obj
+
+    def popitem(self):
+        name, obj = dict.popitem(self)
+        self._unlink(obj)
+        return name, obj
+
+    def clear(self):
+        while self:
+            self.popitem()
+
+    def setdefault(self, name, obj=None):
+        if name not in self:
+            self[name] = obj
+        return dict.__getitem__(self, name)
+
+    def update(self, *args, **kwargs):
+        for name, obj in dict(*args, **kwargs).items():
+            self[name] = obj
+
+    def extend(self, items):
+        """Add the objects of the items {name: obj} dict, which must all be
+        new, e.g. from a parser, building each index in a single pass."""
+        for name in items:
+            if name in self:
+                raise ValueError("'%s' exists" % name)
+        dict.update(self, items)
+        objs = list(items.values())
+        for obj in objs:
+            obj._tables += (self,)
+        for attr, index in self.indexes.items():
+            add = index.add
+            for obj in objs:
+                add(getattr(obj, attr), obj)
+
+    def check(self, obj, attr, value):
+        """Raise ValueError if obj can't be renamed to value."""
+        if attr == 'name' and value in self \
+                and dict.__getitem__(self, value) is not obj:
+            raise ValueError("'%s' exists" % value)
+
+    def reindex(self, obj, attr, old, new):
+        if attr == 'name':
+            if dict.get(self, old) is obj:
+                dict.__delitem__(self, old)
+            dict.__setitem__(self, new, obj)
+        elif attr in self.indexes:
+            self.indexes[attr].discard(old, obj)
+            self.indexes[attr].add(new, obj)
+
+
 class Set(object):
     """A set of User and Group objects."""
 
     def __init__(self, users=None, groups=None):
-        self.users = {} if users is None else users
-        self.groups = {} if groups is None else groups
+        self.groups = Table(['gid'], [], groups)
+        self.users = Table(['uid'], ['directory'], users, self.groups)
 
     def add_user(self, user):
         """Adds a new User object in the Set."""
@@ -172,45 +462,30 @@ class Set(object):
                     user_obj.groups.remove(group.name)
         del self.groups[group.name]
 
+    def get_user_by_uid(self, uid):
+        return self.users.indexes['uid'].first(uid)
+
+    def get_user_by_home(self, directory):
+        return self.users.indexes['directory'].first(directory)
+
+    def get_group_by_gid(self, gid):
+        return self.groups.indexes['gid'].first(gid)
+
     def uid_is_free(self, uid):
-        return uid not in [user.uid for user in self.users.values()]
+        return uid not in self.users.indexes['uid']
 
     def gid_is_free(self, gid):
-        return gid not in [group.gid for group in self.groups.values()]
+        return gid not in self.groups.indexes['gid']
 
     def get_free_uid(self, start=FIRST_UID, end=LAST_UID, reverse=False,
                      ignore=None, exclude=None):
-        used_uids = [user.uid for user in self.users.values()]
-        if exclude is not None:
-            used_uids.extend(exclude)
-        xr = range(start, end+1)
-        if reverse:
-            xr = reversed(xr)
-
-        uid = None
-
-        for i in xr:
-            if i == ignore or i not in used_uids:
-                uid = i
-                break
-        return uid
+        return self.users.indexes['uid'].find_free(start, end, reverse,
+                                                   ignore, exclude)
 
     def get_free_gid(self, start=FIRST_UID, end=LAST_UID, reverse=False,
                      ignore=None, exclude=None):
-        used_gids = [group.gid for group in self.groups.values()]
-        if exclude is not None:
-            used_gids.extend(exclude)
-        xr = range(start, end+1)
-        if reverse:
-            xr = reversed(xr)
-
-        gid = None
-
-        for i in xr:
-            if i == ignore or i not in used_gids:
-                gid = i
-                break
-        return gid
+        return self.groups.indexes['gid'].find_free(start, end, reverse,
+                                                    ignore, exclude)
 
 
 class Event:
@@ -225,28 +500,70 @@ class Event:
             subscriber(arg)
 
 
+class Changes:
+    """The users and groups that a System reload added, changed or removed.
+
+    This is what libuser_event subscribers receive, so that they only need
+    to update the affected objects.
+    """
+    def __init__(self):
+        self.added_users, self.changed_users, self.removed_users = [], [], []
+        self.added_groups, self.changed_groups, self.removed_groups = \
+            [], [], []
+        self._seen = set()
+
+    def user_changed(self, user):
+        """Mark user as changed, unless it's already marked or added."""
+        if id(user) not in self._seen:
+            self._seen.add(id(user))
+            self.changed_users.append(user)
+
+    def user_added(self, user):
+        self._seen.add(id(user))
+        self.added_users.append(user)
+
+    def user_removed(self, user):
+        if id(user) in self._seen:
+            self.added_users = [u for u in self.added_users if u is not user]
+            self.changed_users = [u for u in self.changed_users
+                                  if u is not user]
+        self.removed_users.append(user)
+
+    def __bool__(self):
+        return any([self.added_users, self.changed_users, self.removed_users,
+                    self.added_groups, self.changed_groups,
+                    self.removed_groups])
+
+
 class System(Set):
     def __init__(self):
         super(System, self).__init__()
+        self.users.nss = True
+        # The last loaded database records, to compute the differences
+        self._records = {'passwd': {}, 'shadow': {}, 'group': {}}
+        self._gid_names = {}
+        self._memberships = {}
+        self._primary = {}
         self.load()
         self.home_mode = None
         # These might be updated from shared_folders, if they're used
         self.teachers = 'teachers'
         self.share_groups = [self.teachers]
 
-        # INotifier for /etc/group and /etc/shadow
+        # INotifier for /etc/passwd, /etc/group and /etc/shadow.
+        # IN_ATTRIB catches the files being replaced by rename(2).
         self.system_event = Event()
         self.libuser_event = Event()
         self.system_event.connect(self.on_system_changed)
-        self.mask = inotify.IN_MODIFY
+        self.mask = inotify.IN_MODIFY | inotify.IN_ATTRIB
+        self.passwd_fp = filepath.FilePath('/etc/passwd')
         self.group_fp = filepath.FilePath('/etc/group')
         self.shadow_fp = filepath.FilePath('/etc/shadow')
         self.notifier = inotify.INotify()
         self.notifier.startReading()
-        self.notifier._addWatch(self.group_fp, self.mask,
-                                False, [self.on_fd_changed])
-        self.notifier._addWatch(self.shadow_fp, self.mask,
-                                False, [self.on_fd_changed])
+        for fp in [self.passwd_fp, self.group_fp, self.shadow_fp]:
+            self.notifier._addWatch(fp, self.mask,
+                                    False, [self.on_fd_changed])
 
     def add_group(self, group):
         common.run_command(['groupadd', '-g', str(group.gid), group.name])
@@ -267,6 +584,36 @@ class System(Set):
         common.run_command(['groupdel', group.name])
 
     def add_user(self, user, create_home=True):
+        """Run useradd and set the rest of the user fields.
+        Return the executor.Result of useradd."""
+        cmd = self._useradd(user, create_home)
+        result = executor.executor.run(cmd, timeout=COMMAND_TIMEOUT)
+        if not result.ok:
+            common.print_error(result)
+            return result
+        self.update_user(user.name, user)
+        return result
+
+    def add_user_async(self, user, create_home=True):
+        """Like add_user, but run useradd, and then the commands that set
+        the rest of the fields one after the other, in an executor thread,
+        so that copying /etc/skel doesn't block the GUI. Return a Deferred
+        that fires with the executor.Result of useradd."""
+        d = executor.executor.run_async(self._useradd(user, create_home),
+                                        timeout=COMMAND_TIMEOUT)
+        return d.addCallback(self._user_added_async, user)
+
+    def _user_added_async(self, result, user):
+        if not result.ok:
+            common.print_error(result)
+            return result
+        d = defer.succeed([])
+        for cmd in [self._usermod(user.name, user), self._chfn(user),
+                    self._chage(user)]:
+            d.addCallback(self._run_async, cmd)
+        return d.addCallback(lambda results: result)
+
+    def _useradd(self, user, create_home):
         cmd = ["useradd"]
         if create_home:
             cmd.extend(['-m', '-d', user.directory])
@@ -278,13 +625,163 @@ class System(Set):
                 cmd.extend(['-K', 'HOME_MODE=0755'])
         cmd.extend(['-g', str(user.gid)])
         cmd.append(user.name)
-        common.run_command(cmd)
-        self.update_user(user.name, user)
+        return cmd
+
+    def add_users(self, users, groups=None, create_home=True, progress=None):
+        """Create many users, and optionally their groups, in one go.
+
+        Instead of running useradd/usermod/chfn/chage for each user, all
+        the passwd/shadow/group/gshadow records are written in a single
+        locked transaction and the home directories are created afterwards.
+        Returns a {'users': {name: (success, error)}, 'groups': {name:
+        (success, error)}} dict; the users and groups that conflict with
+        the system are skipped without affecting the rest, except for the
+        users of the groups that failed. The group members are written
+        only from the groups of the users that were added.
+        progress(done, total) is called after each home directory.
+        """
+        results = {'users': {}, 'groups': {}}
+        user_results, group_results = results['users'], results['groups']
+        # The errors of the groups that failed, by name and by GID
+        failed, failed_gids = {}, {}
+        try:
+            with shadow.Transaction() as tr:
+                for group in groups or []:
+                    try:
+                        tr.add_group(Group(group.name, group.gid))
+                        group_results[group.name] = (True, '')
+                    except ValueError as e:
+                        group_results[group.name] = (False, str(e))
+                        failed[group.name] = failed_gids[group.gid] = \
+                            "Αποτυχία δημιουργίας της ομάδας %s: %s" % (
+                                group.name, e)
+                for user in users:
+                    error = failed_gids.get(user.gid)
+                    for group in [user.primary_group] + user.groups:
+                        if error is None:
+                            error = failed.get(group)
+                    if error is not None:
+                        user_results[user.name] = (False, error)
+                        continue
+                    try:
+                        tr.add_user(user)
+                        user_results[user.name] = (True, '')
+                    except ValueError as e:
+                        user_results[user.name] = (False, str(e))
+        except (shadow.LockError, OSError) as e:
+            for user in users:
+                user_results[user.name] = (False, str(e))
+            for group in groups or []:
+                group_results[group.name] = (False, str(e))
+            return results
+
+        if create_home:
+            for done, user in enumerate(users, 1):
+                if user_results[user.name][0]:
+                    try:
+                        shadow.create_home(user)
+                    except OSError as e:
+                        user_results[user.name] = (False, str(e))
+                if progress:
+                    progress(done, len(users))
+        return results
+
+    def groups_to_create(self, new_set):
+        """Return a {name: Group} dict of the primary and supplementary
+        groups of the new_set users that don't exist in the system, with
+        the new users as members and with free GIDs where needed."""
+        new_groups = {}
+        new_gids = set(u.gid for u in new_set.users.values())
+        sys_gids = set(g.gid for g in self.groups.values())
+        for u in new_set.users.values():
+            if u.primary_group not in self.groups:
+                if u.primary_group not in new_groups:
+                    g_obj = Group(u.primary_group, u.gid)
+                    new_groups[u.primary_group] = g_obj
+                new_groups[u.primary_group].members[u.name] = u
+
+        for u in new_set.users.values():
+            for g in u.groups:
+                if g not in self.groups:
+                    if g not in new_groups:
+                        g_obj = Group(g)
+                        if g in new_set.groups:
+                            g_obj.gid = new_set.groups[g].gid
+                        if g_obj.gid in new_gids or g_obj.gid in sys_gids \
+                                or g_obj.gid is None:
+                            g_obj.gid = self.get_free_gid(exclude=new_gids)
+                            new_gids.add(g_obj.gid)
+                        new_groups[g] = g_obj
+                    new_groups[g].members[u.name] = u
+        return new_groups
+
+    def autocomplete_user(self, user, new_set, new_gids, new_uids=None):
+        """Fill the missing information of a user that is about to be
+        imported from new_set, where possible. new_gids is the set of the
+        GIDs of the other new users, and it's updated. new_uids is the same
+        for the UIDs, for when new_set doesn't have all the new users yet;
+        by default the UIDs of new_set are used."""
+        if user.directory in [None, '']:
+            user.directory = os.path.join(HOME_PREFIX, user.name)
+        if user.uid in [None, '']:
+            if new_uids is None:
+                user.uid = self.get_free_uid(
+                    exclude=new_set.users.indexes['uid'])
+            else:
+                user.uid = self.get_free_uid(exclude=new_uids)
+                new_uids.add(user.uid)
+
+        if user.gid in [None, '']:
+            if user.primary_group in [None, '']:
+                user.primary_group = user.name
+            if user.name in self.groups:
+                user.gid = self.groups[user.name].gid
+            else:
+                user.gid = self.get_free_gid(exclude=new_gids)
+        else:
+            if user.primary_group in [None, '']:
+                group = new_set.get_group_by_gid(user.gid)
+                if group is None:
+                    group = self.get_group_by_gid(user.gid)
+                if group is not None:
+                    user.primary_group = group.name
+                else:
+                    user.primary_group = user.name
+        new_gids.add(user.gid)
+        if user.shell in [None, '']:
+            user.shell = '/bin/bash'
+        if user.min in [None, '']:
+            user.min = 0
+        if user.max in [None, '']:
+            user.max = 99999
+        if user.warn in [None, '']:
+            user.warn = 7
+        if user.lstchg in [None, '']:
+            user.lstchg = common.days_since_epoch()
+        if user.inact in [None, '']:
+            user.inact = -1
+        if user.expire in [None, '']:
+            user.expire = -1
+        if user.password in [None, '']:
+            user.password = '!'
+        if user.plainpw is None:
+            user.plainpw = ''
 
     def _strcnv(self, t):
         return [str(i) for i in t]
 
     def update_user(self, username, user):
+        common.run_command(self._usermod(username, user))
+        self.user_set_gecos(user)
+        self.user_set_pass_options(user)
+
+    def user_set_gecos(self, user):
+        common.run_command(self._chfn(user))
+
+    def user_set_pass_options(self, user):
+        common.run_command(self._chage(user))
+
+    def _usermod(self, username, user):
         # Main values
         cmd = ['usermod']
         cmd.extend(['-d', user.directory])
@@ -296,14 +793,9 @@ class System(Set):
         cmd.extend(['-s', user.shell])
         cmd.extend(['-u', user.uid])
         cmd.append(username)
+        return self._strcnv(cmd)
 
-        # Execute usermod
-        cmd = self._strcnv(cmd)
-        common.run_command(cmd)
-        self.user_set_gecos(user)
-        self.user_set_pass_options(user)
-
-    def user_set_gecos(self, user):
+    def _chfn(self, user):
         cmd = ['chfn']
         cmd.extend(['-f', user.rname])
         cmd.extend(['-r', user.office])
@@ -311,11 +803,9 @@ class System(Set):
         cmd.extend(['-h', user.hphone])
         cmd.extend(['-o', user.other])
         cmd.append(user.name)
-        # Execute chfn
-        cmd = self._strcnv(cmd)
-        common.run_command(cmd)
+        return self._strcnv(cmd)
 
-    def user_set_pass_options(self, user):
+    def _chage(self, user):
         cmd = ['chage']
         cmd.extend(['-d', user.lstchg])
         cmd.extend(['-E', user.expire])
@@ -324,16 +814,38 @@ class System(Set):
         cmd.extend(['-M', user.max])
         cmd.extend(['-W', user.warn])
         cmd.append(user.name)
-        # Execute chage
-        cmd = self._strcnv(cmd)
-        common.run_command(cmd)
+        return self._strcnv(cmd)
 
     def delete_user(self, user, remove_home=False):
+        common.run_command(self._userdel(user, remove_home))
+
+    def delete_users_async(self, users, remove_home=False):
+        """Run userdel for each user in an executor thread, so that
+        removing the homes doesn't block the GUI, one user after the other
+        as userdel locks the account files. Return a Deferred that fires
+        with the list of the executor.Results."""
+        d = defer.succeed([])
+        for user in users:
+            d.addCallback(self._run_async, self._userdel(user, remove_home))
+        return d
+
+    def _userdel(self, user, remove_home):
         cmd = ['userdel']
         if remove_home:
             cmd.append('-r')
         cmd.append(user.name)
-        common.run_command(cmd)
+        return cmd
+
+    def _run_async(self, results, cmd):
+        """Run cmd in an executor thread and append its Result to results;
+        for chaining the commands of a Deferred one after the other."""
+        def done(result):
+            if not result.ok:
+                common.print_error(result)
+            results.append(result)
+            return results
+
+        return executor.executor.run_async(cmd).addCallback(done)
 
     def add_user_to_groups(self, user, groups):
         groups = ','.join([gr.name for gr in groups])
@@ -356,50 +868,148 @@ class System(Set):
 
     # Generic operations
     def load(self):
-        pwds = pwd.getpwall()
-        spwds = spwd.getspall()
-        sn = {}
-        for s in spwds:
-            sn[s.sp_nam] = s
-
-        for p in pwds:
-            if p.pw_name in sn:
-                s = sn[p.pw_name]
-            else:
-                s = spwd.struct_spwd([None]*9)
+        """Fill the Set from the passwd, shadow and group databases.
 
-            gecos = p.pw_gecos.split(',', 4)
-            # Pad with empty strings so we have exactly 5 items
-            gecos += [''] * (5 - len(gecos))
-            rname, office, wphone, hphone, other = gecos
-            u = User(p.pw_name, p.pw_uid, p.pw_gid, rname, office, wphone,
-                     hphone, other, p.pw_dir, p.pw_shell,
-                     [grp.getgrgid(p.pw_gid).gr_name], s.sp_lstchg, s.sp_min,
-                     s.sp_max, s.sp_warn, s.sp_inact, s.sp_expire, s.sp_pwd)
-            self.users[u.name] = u
-
-        groups = grp.getgrall()
-        for group in groups:
-            g = Group(group.gr_name, group.gr_gid)
-            for member in group.gr_mem:
-                if member in self.users:
-                    ugroups = self.users[member].groups
-                    if group.gr_name not in ugroups:
-                        self.users[member].groups.append(group.gr_name)
-                    g.members[member] = self.users[member]
-
-            self.groups[group.gr_name] = g
-
-        for user in self.users.values():
-            primary_group = grp.getgrgid(user.gid).gr_name
-            if primary_group in self.groups:
-                self.groups[primary_group].members[user.name] = user
+        Calling it again only updates what changed since the last call.
+        """
+        changes = Changes()
+        self.sync_group(changes)
+        self.sync_passwd(changes)
+        self.sync_shadow(changes)
+        return changes
 
     def reload(self):
-        self.users = {}
-        self.groups = {}
-        self.load()
-        self.libuser_event.notify('event')
+        changes = self.load()
+        if changes:
+            self.libuser_event.notify(changes)
+
+    def sync_passwd(self, changes):
+        """Apply the differences of the passwd database to the Set."""
+        old = self._records['passwd']
+        new = dict((p.pw_name, tuple(p)) for p in pwd.getpwall())
+        touched = set()
+        groupnames = []
+        for name in [n for n in old if n not in new]:
+            touched.add(old[name][3])
+            groupnames.extend(self._memberships.get(name, []))
+            self._primary.get(old[name][3], set()).discard(name)
+            user = self.users.pop(name, None)
+            if user is not None:
+                self._records['shadow'].pop(name, None)
+                changes.user_removed(user)
+        for name, rec in new.items():
+            if old.get(name) == rec:
+                continue
+            user = self.users.get(name)
+            if user is None:
+                user = User(name)
+                self._set_shadow(user, (None,)*9)
+                self.users[name] = user
+                groupnames.extend(self._memberships.get(name, []))
+                changes.user_added(user)
+            else:
+                if name in old:
+                    self._primary.get(old[name][3], set()).discard(name)
+                    touched.add(old[name][3])
+                changes.user_changed(user)
+            gecos = rec[4].split(',', 4)
+            # Pad with empty strings so we have exactly 5 items
+            gecos += [''] * (5 - len(gecos))
+            user.rname, user.office, user.wphone, user.hphone, user.other = \
+                gecos
+            user.uid, user.gid, user.directory, user.shell = \
+                rec[2], rec[3], rec[5], rec[6]
+            self._primary.setdefault(user.gid, set()).add(name)
+            touched.add(user.gid)
+        self._records['passwd'] = new
+        groupnames.extend(self._gid_names.get(gid) for gid in touched)
+        self._relink(changes, set(groupnames), [
+            u.name for u in changes.added_users + changes.changed_users])
+
+    def sync_shadow(self, changes):
+        """Apply the differences of the shadow database to the Set."""
+        # Entries of users that aren't in passwd yet are left out, so that
+        # they show up as differences after the users get added
+        old = self._records['shadow']
+        new = dict((s.sp_namp, tuple(s)) for s in spwd.getspall()
+                   if s.sp_namp in self.users)
+        for name in set(old) | set(new):
+            rec = new.get(name, (None,)*9)
+            if old.get(name, (None,)*9) == rec or name not in self.users:
+                continue
+            user = self.users[name]
+            self._set_shadow(user, rec)
+            changes.user_changed(user)
+        self._records['shadow'] = new
+
+    def _set_shadow(self, user, rec):
+        user.password, user.lstchg, user.min, user.max, user.warn, \
+            user.inact, user.expire = rec[1:8]
+
+    def sync_group(self, changes):
+        """Apply the differences of the group database to the Set."""
+        old = self._records['group']
+        new = dict((g.gr_name, (g.gr_gid, tuple(g.gr_mem)))
+                   for g in grp.getgrall())
+        self._gid_names = {}
+        for name, rec in new.items():
+            self._gid_names.setdefault(rec[0], name)
+        affected = set()
+        for name in [n for n in old if n not in new]:
+            affected.update(old[name][1])
+            affected.update(self._primary.get(old[name][0], ()))
+            group = self.groups.pop(name, None)
+            if group is not None:
+                changes.removed_groups.append(group)
+        for name, rec in new.items():
+            if old.get(name) == rec:
+                continue
+            group = self.groups.get(name)
+            if group is None:
+                group = Group(name, rec[0])
+                self.groups[name] = group
+                changes.added_groups.append(group)
+            else:
+                affected.update(old[name][1])
+                affected.update(self._primary.get(old[name][0], ()))
+                group.gid = rec[0]
+                changes.changed_groups.append(group)
+            affected.update(rec[1])
+            affected.update(self._primary.get(rec[0], ()))
+        self._records['group'] = new
+        self._memberships = {}
+        for name, rec in new.items():
+            for member in rec[1]:
+                self._memberships.setdefault(member, []).append(name)
+        self._relink(changes, [g.name for g in changes.added_groups +
+                               changes.changed_groups], affected)
+
+    def _relink(self, changes, groupnames, usernames):
+        """Recompute the members of the specified groups and the groups
+        of the specified users, from the last loaded records."""
+        for name in groupnames:
+            if name not in self.groups:
+                continue
+            group = self.groups[name]
+            members = list(self._records['group'][name][1])
+            if self._gid_names.get(group.gid) == name:
+                members.extend(self._primary.get(group.gid, ()))
+            group.members = dict((m, self.users[m]) for m in members
+                                 if m in self.users)
+        for name in usernames:
+            if name not in self.users:
+                continue
+            user = self.users[name]
+            primary_group = self._gid_names.get(user.gid, '')
+            groups = [primary_group] if primary_group else []
+            for gname in self._memberships.get(name, []):
+                if gname not in groups:
+                    groups.append(gname)
+            if user.groups == groups and user.primary_group == primary_group:
+                continue
+            user.groups = groups
+            user.primary_group = primary_group
+            changes.user_changed(user)
 
     def get_valid_shells(self):
         try:
@@ -420,20 +1030,15 @@ class System(Set):
 
     def uid_is_free(self, uid):
         return self.uid_is_valid(uid) and \
-            uid not in [user.uid for user in self.users.values()]
+            super(System, self).uid_is_free(uid)
 
     def gid_is_free(self, gid):
         return self.gid_is_valid(gid) and \
-            gid not in [group.gid for group in self.groups.values()]
+            super(System, self).gid_is_free(gid)
 
     def get_free_uids(self, starting=FIRST_UID, ending=LAST_UID):
-        used_uids = [user.uid for user in self.users.values()]
-
-        free_uids = range(FIRST_UID, LAST_UID+1)
-        for uid in used_uids:
-            free_uids.remove(uid)
-
-        return free_uids
+        uids = self.users.indexes['uid']
+        return [uid for uid in range(starting, ending+1) if uid not in uids]
 
     def name_is_valid(self, name):
         return re.match(NAME_REGEX, name)
@@ -445,23 +1050,39 @@ class System(Set):
     def shell_is_valid(self, shell):
         return shell in self.get_valid_shells()
 
-    def encrypt(self, plainpw):
+    def encrypt(self, plainpw, method=hashing.SHA512, rounds=None):
         """
         Converts a plain text password to a sha-512 encrypted one.
         """
-        alphabet = \
-            '0123456789abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ'
-        salt = ''.join([random.choice(alphabet) for i in range(8)])
+        return hashing.hash_password(plainpw, method, rounds)
 
-        return crypt.crypt(plainpw, "$6$%s$" % salt)
+    def encrypt_many(self, plainpws, progress=None, method=hashing.SHA512,
+                     rounds=None):
+        """
+        Like encrypt, for a list of passwords; they're hashed in parallel.
+        progress(done, total) is called while hashing.
+        """
+        return hashing.hasher.hash(plainpws, progress, method, rounds)
 
     # Event functions
     def connect_event(self, func):
         self.libuser_event.connect(func)
 
     # Event callback
-    def on_system_changed(self, event):
-        self.reload()
+    def on_system_changed(self, path):
+        changes = Changes()
+        if path == self.passwd_fp.path:
+            self.sync_passwd(changes)
+            if changes.added_users:
+                self.sync_shadow(changes)
+        elif path == self.shadow_fp.path:
+            self.sync_shadow(changes)
+        elif path == self.group_fp.path:
+            self.sync_group(changes)
+        else:
+            changes = self.load()
+        if changes:
+            self.libuser_event.notify(changes)
 
     # INotifier callback
     def on_fd_changed(self, ignored, filename, mask):
@@ -472,9 +1093,26 @@ class System(Set):
         self.system_event.notify(filename.path)
 
 
-system = System()
+profiling.instrument(System, [
+    'add_group', 'edit_group', 'delete_group', 'add_user', 'add_users',
+    'update_user', 'user_set_gecos', 'user_set_pass_options', 'delete_user',
+    'add_user_to_groups', 'remove_user_from_groups', 'lock_user',
+    'unlock_user', 'load', 'on_system_changed', 'encrypt_many'])
+
+
+def __getattr__(name):
+    """Create libuser.system on first use, as loading the users and groups
+    and watching their files slows down the startup of every module that
+    imports libuser."""
+    if name == 'system':
+        global system
+        system = System()
+        return system
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
 
 if __name__ == '__main__':
+    system = System()
     print("System users:", ', '.join(system.users))
     print("\nSystem groups:", ', '.join(system.groups))
 
@@ -489,3 +1127,43 @@ if __name__ == '__main__':
             print("   ", ", ".join(group.members.keys()))
 
     analytical()
+
+    # Benchmark: construct 50000 users with their private groups in a Set,
+    # then resolve their primary groups and find free IDs
+    import time
+    import tracemalloc
+
+    def construct(count):
+        set_ = Set()
+        for i in range(count):
+            user = User(name='user%d' % i, uid=FIRST_UID + i,
+                        gid=FIRST_GID + i, rname='User %d' % i,
+                        directory='/home/user%d' % i, groups=['user%d' % i],
+                        lstchg=19000)
+            set_.users[user.name] = user
+            set_.groups[user.name] = Group(user.name, user.gid,
+                                           {user.name: user})
+        return set_
+
+    count = 50000
+    start = time.time()
+    users = construct(count)
+    print("\n%d users and groups constructed in %.3fs"
+          % (count, time.time() - start))
+    del users
+    # tracemalloc slows construction down, so it's measured separately
+    tracemalloc.start()
+    users = construct(count)
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    print("%.1f MB, %d bytes per user and group"
+          % (memory / 2**20, memory // count))
+    start = time.time()
+    resolved = sum(1 for user in users.users.values()
+                   if user.primary_group == user.name)
+    print("%d primary groups resolved in %.3fs"
+          % (resolved, time.time() - start))
+    start = time.time()
+    for i in range(1000):
+        users.users.indexes['uid'].find_free(FIRST_UID, LAST_UID)
+    print("1000 free UIDs found in %.3fs" % (time.time() - start))
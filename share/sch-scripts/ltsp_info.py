@@ -10,7 +10,7 @@ from gi.repository import Gtk
 import re
 import textwrap
 
-import common
+import executor
 
 class LtspInfo:
     def __init__(self, main_window):
@@ -27,6 +27,16 @@ class LtspInfo:
         self.dialog.destroy()
 
     def Fill(self):
-        success, response = common.run_command(['ltsp', 'info'])
-        self.buffer.set_text(response)
+        self.buffer.set_text("Παρακαλώ περιμένετε...")
         self.dialog.show()
+        d = executor.executor.run_async(['ltsp', 'info'], timeout=120)
+        d.addCallback(self.on_ltsp_info)
+
+    def on_ltsp_info(self, result):
+        if result.timed_out:
+            self.buffer.set_text("Η εντολή `ltsp info` δεν ολοκληρώθηκε "
+                                 "μέσα σε %d δευτερόλεπτα." % result.duration)
+        elif result.ok:
+            self.buffer.set_text(result.stdout)
+        else:
+            self.buffer.set_text(result.stderr or result.stdout)
@@ -4,157 +4,418 @@
 """
 Parsers.
 """
+import contextlib
 import csv
+import gzip
+import io
+import lzma
 import libuser
+import usernames
 import os
+import sys
 import configparser
 from io import StringIO, BytesIO
 
 FIELDS_MAP = {'Όνομα χρήστη': 'name', 'Τελευταία αλλαγή κωδικού': 'lstchg', 'Κύρια ομάδα': 'gid', 'Όνομα κύριας ομάδας' : 'primary_group', 'Κέλυφος': 'shell', 'UID': 'uid', 'Γραφείο': 'office', 'Κρυπτογραφημένος κωδικός': 'password', 'Κωδικός': 'plainpw', 'Λήξη': 'expire', 'Μέγιστη διάρκεια': 'max', 'Προειδοποίηση': 'warn', 'Κατάλογος': 'directory', 'Ελάχιστη διάρκεια': 'min', 'Άλλο': 'other', 'Ομάδες': 'groups', 'Τηλ. γραφείου': 'wphone', 'Ανενεργός': 'inact', 'Ονοματεπώνυμο': 'rname', 'Τηλ. οικίας': 'hphone'}
 
+def _to_int(value):
+    try:
+        return int(value)
+    except ValueError:
+        return None
+
+
 class CSV:
     def __init__(self):
         self.fields_map = FIELDS_MAP
+        # The usernames that were generated for the rows without one
+        self.generator = None
+        # The rows that were skipped in the last iter_parse(), as messages
+        self.warnings = []
+        # The UIDs and GIDs that the rows of the last iter_parse() give,
+        # read ahead so that free IDs given to earlier rows can't take them
+        self.uids, self.gids = set(), set()
 
     def parse(self, fname):
-        users_dict = csv.DictReader(open(fname))
-        users = {}
-        groups = {}
-        for user_d in users_dict:
-            user = libuser.User()
-
-            for key, value in user_d.items():
-                try:
-                    user.__dict__[self.fields_map[key]] = value # FIXME: Here we lose the datatype
-                except:
-                    pass
-            # Try to convert the numbers from string to int
-            int_attributes = ['lstchg', 'gid', 'uid', 'expire', 'max', 'warn', 'min', 'inact']
-            for attr in int_attributes:
-                try:
-                    user.__dict__[attr] = int(user.__dict__[attr])
-                except ValueError:
-                    user.__dict__[attr] = None
-            # If plainpw is set, override and update password
-            if user.plainpw:
-                user.password = libuser.system.encrypt(user.plainpw)
-
-            if user.name:
-                users[user.name] = user
-                user_groups_string = user.groups
-                user.groups = []
-                for g in user_groups_string.split(','):
-                    pair = g.split(':')
-                    if len(pair) == 2:
-                        gname, gid = pair
-                        try:
-                            gid = int(gid)
-                        except ValueError:
-                            gid = None
-                    else: # There is no GID specified for this group
-                        gname = g
-                        gid = None
-                    if gname != '':
-                        user.groups.append(gname)
-
-                    # Create Group instances from memberships
-                    if gname not in groups:
-                        groups[gname] = libuser.Group(gname, gid)
-                    groups[gname].members[user.name] = user
-
-                if user.groups == '':
-                    user.groups = None
-
-        return libuser.Set(users, groups)
-
-
-    def write(self, fname, system, users):
-        f = open(fname, 'w')
-        writer = csv.DictWriter(f, fieldnames=libuser.CSV_USER_FIELDS)
-        writer.writerow(dict((n,n) for n in libuser.CSV_USER_FIELDS))
-        for user in users:
-            u_dict = dict( (key, user.__dict__[o_key] if user.__dict__[o_key] is not None else '') for key, o_key in self.fields_map.items())
-            u_dict['Κωδικός'] = '' # We don't have the plain password
-            u_dict['Ομάδες'] = list(u_dict['Ομάδες'])
-            # Convert the groups value to a proper gname:gid pairs formatted string
-            final_groups = u_dict['Ομάδες']
-            final_groups.remove(u_dict['Όνομα κύριας ομάδας'])
-            for i, gname in enumerate(final_groups):
-                gid = system.groups[gname].gid
-                final_groups[i] = ':'.join((final_groups[i], str(gid)))
-            u_dict['Ομάδες'] = ','.join(final_groups)
-
-            writer.writerow(u_dict)
-        f.close()
+        new_set = libuser.Set()
+        for users in self.iter_parse(fname, new_set):
+            pass
+        return new_set
+
+    def iter_parse(self, fname, new_set, chunk_size=100):
+        """Parse fname into new_set, yielding the new users in chunks.
+
+        Rows without a username get one generated from their real name.
+        Rows without either, or with a username that was already parsed,
+        are skipped and listed in self.warnings. The group memberships are
+        added to new_set.groups as they are found.
+        """
+        self.generator = usernames.Generator(libuser.system.users)
+        self.warnings = []
+        self.uids, self.gids = self.read_ids(fname)
+        with open_input(fname) as f:
+            reader = csv.reader(f)
+            header = next(reader, [])
+            # Decide the field and the type conversion once per column
+            columns = []
+            for i, key in enumerate(header):
+                if key not in self.fields_map:
+                    continue
+                field = self.fields_map[key]
+                if field in libuser.User.INT_FIELDS:
+                    columns.append((i, field, _to_int))
+                else:
+                    columns.append((i, field, None))
+
+            chunk = []
+            for row in reader:
+                user = libuser.User()
+                for i, field, convert in columns:
+                    value = row[i] if i < len(row) else ''
+                    if convert:
+                        value = convert(value)
+                    setattr(user, field, value)
+                if not user.name and user.rname:
+                    user.name = self.generator.choose(
+                        usernames.candidates(user.rname), user.rname).name
+                if not user.name:
+                    if any(row):
+                        self.warn(fname, reader.line_num, "Δεν υπάρχει όνομα "
+                                  "χρήστη ούτε ονοματεπώνυμο")
+                    continue
+                if user.name in new_set.users:
+                    self.warn(fname, reader.line_num,
+                              "Ο χρήστης %s υπάρχει σε προηγούμενη γραμμή"
+                              % user.name)
+                    continue
+                self.generator.used.add(user.name)
+                self.add_memberships(new_set, user)
+                new_set.users[user.name] = user
+                chunk.append(user)
+                if len(chunk) >= chunk_size:
+                    self.encrypt(chunk)
+                    yield chunk
+                    chunk = []
+            if chunk:
+                self.encrypt(chunk)
+                yield chunk
+
+    def warn(self, fname, lineno, message):
+        self.warnings.append("%s:%d: %s" % (os.path.basename(fname), lineno,
+                                           message))
+
+    def read_ids(self, fname):
+        """Return the sets of the UIDs and GIDs in the rows of fname,
+        without parsing the rest of the fields."""
+        uids, gids = set(), set()
+        with open_input(fname) as f:
+            reader = csv.reader(f)
+            header = next(reader, [])
+            columns = [(i, ids) for i, key in enumerate(header)
+                       for field, ids in [('uid', uids), ('gid', gids)]
+                       if self.fields_map.get(key) == field]
+            for row in reader:
+                for i, ids in columns:
+                    if i < len(row):
+                        ids.add(_to_int(row[i]))
+        uids.discard(None)
+        gids.discard(None)
+        return uids, gids
+
+    def add_memberships(self, new_set, user):
+        """Convert the user "gname:gid,..." groups string to a list, and
+        create the Group objects in new_set for these memberships."""
+        groups_string = user.groups
+        user.groups = []
+        if not isinstance(groups_string, str):
+            return
+        for g in groups_string.split(','):
+            pair = g.split(':')
+            if len(pair) == 2:
+                gname, gid = pair
+                gid = _to_int(gid)
+            else: # There is no GID specified for this group
+                gname = g
+                gid = None
+            if gname == '':
+                continue
+            user.groups.append(gname)
+
+            # Create Group instances from memberships
+            if gname not in new_set.groups:
+                new_set.groups[gname] = libuser.Group(gname, gid)
+            new_set.groups[gname].members[user.name] = user
+
+    def encrypt(self, users):
+        """If plainpw is set, override and update password."""
+        users = [user for user in users if user.plainpw]
+        hashes = libuser.system.encrypt_many([u.plainpw for u in users])
+        for user, password in zip(users, hashes):
+            user.password = password
+
+    def write(self, fname, system, users, columns=None, compression=None):
+        """Write the users to fname, or to stdout if it's '-', a row at a
+        time, so users can be any iterable, e.g. a generator.
+
+        columns is a list of libuser.CSV_USER_FIELDS, by default all of
+        them; see visible_columns(). compression is 'gz', 'xz' or None;
+        if it's not given, it's chosen from the extension of fname.
+        Return the number of users that were written.
+        """
+        if columns is None:
+            columns = libuser.CSV_USER_FIELDS
+        if compression is None:
+            compression = compression_of(fname)
+        # Decide how to get each column once, not per user
+        getters = []
+        for column in columns:
+            if column == 'Κωδικός':
+                # We don't have the plain password
+                getters.append(lambda user: '')
+            elif column == 'Ομάδες':
+                getters.append(self.groups_string)
+            else:
+                getters.append(_attrgetter(self.fields_map[column]))
+        self.gids = {g.name: g.gid for g in system.groups.values()}
+        count = 0
+        with open_output(fname, compression) as f:
+            writer = csv.writer(f)
+            writer.writerow(columns)
+            for user in users:
+                writer.writerow([get(user) for get in getters])
+                count += 1
+        return count
+
+    def groups_string(self, user):
+        """Return the "gname:gid,..." secondary groups of user; the groups
+        that don't exist in the system are written without a GID."""
+        gids = self.gids
+        return ','.join('%s:%s' % (g, gids[g]) if g in gids else g
+                        for g in user.groups if g != user.primary_group)
+
+
+def _attrgetter(name):
+    def get(user):
+        value = getattr(user, name)
+        return '' if value is None else value
+    return get
+
+
+# The CSV columns that are also user columns of the main window
+VIEW_COLUMNS = [f for f in libuser.USER_FIELDS if f != 'Ομάδες']
+
+
+def visible_columns(setting):
+    """Return the CSV columns for the visible_user_columns setting, which
+    is 'all' or the comma separated titles of the visible columns of the
+    main window. The columns that the window doesn't show, and the
+    username, which the import needs, are always included."""
+    if setting == 'all':
+        return list(libuser.CSV_USER_FIELDS)
+    visible = set(setting.split(','))
+    visible.add('Όνομα χρήστη')
+    return [f for f in libuser.CSV_USER_FIELDS
+            if f in visible or f not in VIEW_COLUMNS]
+
+
+COMPRESSIONS = {'gz': gzip.open, 'xz': lzma.open}
+
+
+def compression_of(fname):
+    """Return 'gz' or 'xz' if fname has that extension, otherwise None."""
+    for ext in COMPRESSIONS:
+        if fname.endswith('.' + ext):
+            return ext
+    return None
+
+
+def open_input(fname):
+    """Open fname for reading CSV text, decompressing it by extension."""
+    compression = compression_of(fname)
+    if compression:
+        return COMPRESSIONS[compression](fname, 'rt', newline='')
+    return open(fname, newline='')
+
+
+@contextlib.contextmanager
+def open_output(fname, compression=None):
+    """Open fname for writing CSV text, or stdout if it's '-', optionally
+    compressed; stdout is left open."""
+    if fname == '-':
+        if compression:
+            # The compressor doesn't close a file object that it was given
+            with COMPRESSIONS[compression](sys.stdout.buffer, 'wt',
+                                           encoding='utf-8', newline='') as f:
+                yield f
+        else:
+            sys.stdout.flush()
+            f = io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8',
+                                 newline='')
+            try:
+                yield f
+            finally:
+                f.flush()
+                f.detach()
+    elif compression:
+        with COMPRESSIONS[compression](fname, 'wt', encoding='utf-8',
+                                       newline='') as f:
+            yield f
+    else:
+        with open(fname, 'w', encoding='utf-8', newline='') as f:
+            yield f
+
+
+def read_colon_file(fname, fields):
+    """Yield the line number and the fields of each line of a passwd-like
+    file, which may be compressed, padded to at least fields items.
+    Empty lines, comments and NIS lines are skipped."""
+    compression = compression_of(fname)
+    if compression:
+        f = COMPRESSIONS[compression](fname, 'rt')
+    else:
+        f = open(fname)
+    with f:
+        for lineno, line in enumerate(f, 1):
+            line = line.rstrip('\n')
+            if not line or line[0] in '#+-':
+                continue
+            row = line.split(':')
+            if len(row) < fields:
+                row += [''] * (fields - len(row))
+            yield lineno, row
 
 
 class passwd():
     # passwd format: username:password (or x):UID:GID:gecos:home:shell
     # shadow format: username:password (or */!):last change:min:max:warn:inact:expire:reserved
     # group format: group_name:password (or x):GID:user_list
-    # gshadow format: Not Implemented
-    def __init__(self):
-        pass
+    # gshadow format: group_name:password:admins:user_list
+    SHADOW_FIELDS = ['lstchg', 'min', 'max', 'warn', 'inact', 'expire']
 
-    def parse(self, pwd, spwd=None, grp=None):
+    def __init__(self):
+        # The lines that were skipped or referenced unknown users or groups
+        # in the last parse(), as messages
+        self.warnings = []
+
+    @staticmethod
+    def siblings(pwd):
+        """Return the shadow, group and gshadow files next to pwd that
+        exist, or None for the missing ones. For backups like passwd- or
+        passwd.gz, the files with the same suffix are preferred."""
+        path, base = os.path.split(pwd)
+        suffix = base[len('passwd'):] if base.startswith('passwd') else ''
+        files = []
+        for name in ['shadow', 'group', 'gshadow']:
+            for fname in [name + suffix, name]:
+                fname = os.path.join(path, fname)
+                if os.path.isfile(fname):
+                    files.append(fname)
+                    break
+            else:
+                files.append(None)
+        return files
+
+    def warn(self, fname, lineno, message):
+        self.warnings.append("%s:%d: %s" % (os.path.basename(fname), lineno,
+                                           message))
+
+    def parse(self, pwd, spwd=None, grp=None, gspwd=None):
+        """Read each file once into a new Set. The lines with unknown users
+        or groups, or with invalid IDs, are skipped or partially applied
+        and listed in self.warnings, instead of failing the whole parse."""
         new_set = libuser.Set()
-
-        with open(pwd) as f:
-            reader = csv.reader(f, delimiter=':', quoting=csv.QUOTE_NONE)
-            for row in reader:
-                u = libuser.User()
-                u.name = row[0]
-                u.password = row[1]
-                u.uid = int(row[2])
-                u.gid = int(row[3])
-                gecos = row[4].split(',', 4)
-                gecos += [''] * (5 - len(gecos)) # Pad with empty strings so we have exactly 5 items
-                u.rname, u.office, u.wphone, u.hphone, u.other = gecos
-                u.directory = row[5]
-                u.shell = row[6]
-                new_set.add_user(u)
+        self.warnings = []
+        # Plain dicts, indexed once by Table.extend() at the end
+        users, groups = {}, {}
+
+        for lineno, row in read_colon_file(pwd, 7):
+            name = row[0]
+            uid, gid = _to_int(row[2]), _to_int(row[3])
+            if uid is None or gid is None:
+                self.warn(pwd, lineno, "Μη έγκυρο UID ή GID για τον χρήστη %s"
+                          % name)
+                continue
+            if name in users:
+                self.warn(pwd, lineno, "Ο χρήστης %s υπάρχει ήδη" % name)
+                continue
+            gecos = row[4].split(',', 4)
+            gecos += [''] * (5 - len(gecos)) # Pad with empty strings so we have exactly 5 items
+            users[name] = libuser.User(
+                name=name, uid=uid, gid=gid, rname=gecos[0], office=gecos[1],
+                wphone=gecos[2], hphone=gecos[3], other=gecos[4],
+                directory=row[5], shell=row[6], password=row[1])
 
         if spwd:
-            with open(spwd) as f:
-                reader = csv.reader(f, delimiter=':', quoting=csv.QUOTE_NONE)
-                for row in reader:
-                    name = row[0]
-                    u = new_set.users[name] # The user must exist in passwd
-                    u.password = row[1]
-                    nums = ['lstchg', 'min', 'max', 'warn', 'inact', 'expire']
-                    for i, att in enumerate(nums, 2):
-                        try:
-                            u.__dict__[att] = int(row[i])
-                        except:
-                            pass
+            fields = list(enumerate(self.SHADOW_FIELDS, 2))
+            for lineno, row in read_colon_file(spwd, 8):
+                u = users.get(row[0])
+                if u is None:
+                    self.warn(spwd, lineno, "Ο χρήστης %s δεν υπάρχει στο "
+                              "passwd" % row[0])
+                    continue
+                u.password = row[1]
+                for i, att in fields:
+                    # Most of them are usually empty
+                    if row[i]:
+                        value = _to_int(row[i])
+                        if value is not None:
+                            setattr(u, att, value)
 
         if grp:
-            with open(grp) as f:
-                reader = csv.reader(f, delimiter=':', quoting=csv.QUOTE_NONE)
-                gids_map = {} # This is only used to set the primary_group User attribute
-                for row in reader:
-                    g = libuser.Group()
-                    g.name = row[0]
-                    g.gid = int(row[2])
-                    members = row[3].split(',')
-                    if members == ['']:
-                        members = []
-                    g.members = {}
-                    for name in members:
-                        g.members[name] = new_set.users[name]
-                        new_set.users[name].groups.append(g.name)
-
-                    new_set.add_group(g)
-                    gids_map[g.gid] = g.name
-
-                for u in new_set.users.values():
-                    u.primary_group = gids_map[u.gid]
-                    if u.primary_group in u.groups:
-                        u.groups.remove(u.primary_group)
-                    #u.groups.append(u.primary_group)
-
+            gids_map = {} # This is only used to set the primary_group User attribute
+            for lineno, row in read_colon_file(grp, 4):
+                name, gid = row[0], _to_int(row[2])
+                if gid is None:
+                    self.warn(grp, lineno, "Μη έγκυρο GID για την ομάδα %s"
+                              % name)
+                    continue
+                if name in groups:
+                    self.warn(grp, lineno, "Η ομάδα %s υπάρχει ήδη" % name)
+                    continue
+                g = libuser.Group(name, gid)
+                self.add_members(g, row[3], users, grp, lineno)
+                groups[name] = g
+                gids_map.setdefault(gid, name)
+
+            if gspwd:
+                for lineno, row in read_colon_file(gspwd, 4):
+                    g = groups.get(row[0])
+                    if g is None:
+                        self.warn(gspwd, lineno, "Η ομάδα %s δεν υπάρχει στο "
+                                  "group" % row[0])
+                        continue
+                    g.password = row[1]
+                    self.add_members(g, row[3], users, gspwd, lineno)
+
+            for u in users.values():
+                primary = gids_map.get(u.gid)
+                if primary is None:
+                    self.warnings.append(
+                        "%s: Η κύρια ομάδα %d του χρήστη %s δεν υπάρχει"
+                        % (os.path.basename(grp), u.gid, u.name))
+                    continue
+                u.primary_group = primary
+                if primary in u.groups:
+                    u.groups = [g for g in u.groups if g != primary]
+
+        new_set.users.extend(users)
+        new_set.groups.extend(groups)
         return new_set
 
+    def add_members(self, group, members, users, fname, lineno):
+        """Add the comma separated members to group and the group to their
+        User.groups."""
+        for name in members.split(','):
+            if not name or name in group.members:
+                continue
+            u = users.get(name)
+            if u is None:
+                self.warn(fname, lineno, "Ο χρήστης %s της ομάδας %s δεν "
+                          "υπάρχει" % (name, group.name))
+                continue
+            group.members[name] = u
+            u.groups.append(group.name)
+
 
 class DHCP():
     def __init__(self):
@@ -203,3 +464,67 @@ class DHCP():
         self.dhcp_info.update(ip=ip,mask=mask,route=route,dnss=dnss)
 
         return self.dhcp_info
+
+
+if __name__ == '__main__':
+    # Benchmark: export 50000 users, generated one at a time
+    import time
+    import tracemalloc
+
+    system = libuser.Set()
+    for i in range(100):
+        system.groups['class%d' % i] = libuser.Group('class%d' % i, 2000 + i)
+
+    def users(count):
+        for i in range(count):
+            user = libuser.User(
+                name='user%d' % i, uid=10000 + i, gid=10000 + i,
+                rname='User %d' % i, directory='/home/user%d' % i,
+                groups=['user%d' % i, 'class%d' % (i % 100), 'missing'])
+            user.primary_group = user.name
+            yield user
+
+    for count in (5000, 50000):
+        tracemalloc.start()
+        start = time.time()
+        CSV().write(os.devnull, system, users(count))
+        duration = time.time() - start
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        print("%d users in %.3fs, peak memory %d KB"
+              % (count, duration, peak // 1024))
+
+    # Benchmark: parse 100000 line passwd, shadow, group and gshadow files,
+    # with the classes in group and a few dangling references
+    import tempfile
+
+    count = 100000
+    with tempfile.TemporaryDirectory() as tmp:
+        with open(os.path.join(tmp, 'passwd'), 'w') as f:
+            for i in range(count):
+                f.write('user%d:x:%d:%d:User %d,,,:/home/user%d:/bin/bash\n'
+                        % (i, 10000 + i, 10000 + i, i, i))
+        with open(os.path.join(tmp, 'shadow'), 'w') as f:
+            for i in range(count):
+                f.write('user%d:$6$salt$hash:19000:0:99999:7:::\n' % i)
+        classes = {}
+        for i in range(count):
+            classes.setdefault(i % 100, []).append('user%d' % i)
+        for name in ['group', 'gshadow']:
+            with open(os.path.join(tmp, name), 'w') as f:
+                for i in range(count - 100):
+                    f.write('user%d:x:%d:\n' % (i, 10000 + i)
+                            if name == 'group' else 'user%d:!::\n' % i)
+                for c, members in classes.items():
+                    members = ','.join(members + ['ghost'])
+                    f.write('class%d:x:%d:%s\n' % (c, 2000 + c, members)
+                            if name == 'group'
+                            else 'class%d:!::%s\n' % (c, members))
+        parser = passwd()
+        start = time.time()
+        new_set = parser.parse(*[os.path.join(tmp, name) for name in
+                                 ['passwd', 'shadow', 'group', 'gshadow']])
+        duration = time.time() - start
+        print("%d users and %d groups in %.3fs, %d warnings"
+              % (len(new_set.users), len(new_set.groups), duration,
+                 len(parser.warnings)))
@@ -0,0 +1,119 @@
+# This file is part of sch-scripts, https://sch-scripts.gitlab.io
+# Copyright 2009-2022 the sch-scripts team, see AUTHORS
+# SPDX-License-Identifier: GPL-3.0-or-later
+"""
+Opt-in timings of the administrative operations.
+
+When enabled, either by `sch-scripts --profile` or by setting the
+SCH_SCRIPTS_PROFILE environment variable to a log file path, each recorded
+operation is appended to the log as a JSON line, and the counts, timings
+and failures per operation are kept for summary().
+"""
+import functools
+import json
+import os
+import sys
+import threading
+import time
+
+LOG_PATH = os.path.expanduser('~/.cache/sch-scripts/profile.jsonl')
+
+enabled = False
+stats = {}
+_log = None
+# record() is also called from worker threads, e.g. by executor.run_many
+_lock = threading.Lock()
+
+
+def enable(path=None):
+    """Start recording; also log each operation to path, if it's set."""
+    global enabled, _log
+    enabled = True
+    if path and _log is None:
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        _log = open(path, 'a', buffering=1)
+
+
+def record(op, duration, ok=True, **details):
+    """Record that op took duration seconds."""
+    if not enabled:
+        return
+    line = None
+    if _log is not None:
+        entry = {'time': round(time.time(), 3), 'op': op,
+                 'duration': round(duration, 6), 'ok': ok}
+        entry.update(details)
+        line = json.dumps(entry, ensure_ascii=False, default=str) + '\n'
+    with _lock:
+        st = stats.get(op)
+        if st is None:
+            st = stats[op] = {'count': 0, 'failures': 0, 'total': 0.0,
+                              'max': 0.0}
+        st['count'] += 1
+        st['total'] += duration
+        st['max'] = max(st['max'], duration)
+        if not ok:
+            st['failures'] += 1
+        if line is not None:
+            _log.write(line)
+
+
+def _succeeded(result):
+    """Tell failures from the usual return values: executor.Result objects
+    and the (success, output) tuples of common.run_command."""
+    if hasattr(result, 'ok'):
+        return bool(result.ok)
+    if isinstance(result, tuple) and result and isinstance(result[0], bool):
+        return result[0]
+    return True
+
+
+def timed(op):
+    """Decorator that records the calls of a function as op."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return func(*args, **kwargs)
+            start = time.monotonic()
+            try:
+                result = func(*args, **kwargs)
+            except Exception as e:
+                record(op, time.monotonic() - start, False, error=repr(e))
+                raise
+            record(op, time.monotonic() - start, _succeeded(result))
+            return result
+        return wrapper
+    return decorator
+
+
+def instrument(cls, names, prefix=None):
+    """Record the calls of the cls methods in names as prefix.name."""
+    if prefix is None:
+        prefix = cls.__name__
+    for name in names:
+        setattr(cls, name, timed('%s.%s' % (prefix, name))(
+            cls.__dict__[name]))
+
+
+def summary(out=None):
+    """Print a table of the recorded operations, slowest total first."""
+    if out is None:
+        out = sys.stderr
+    with _lock:
+        items = [(op, dict(st)) for op, st in stats.items()]
+    if not items:
+        out.write("Δεν καταγράφηκαν χρονομετρήσεις.\n")
+        return
+    width = max(len(op) for op, st in items)
+    out.write("%-*s %7s %9s %9s %9s %8s\n" % (
+        width, "Λειτουργία", "Πλήθος", "Σύνολο", "Μέσος", "Μέγιστος",
+        "Σφάλματα"))
+    for op, st in sorted(items, key=lambda i: -i[1]['total']):
+        out.write("%-*s %7d %8.3fs %8.3fs %8.3fs %8d\n" % (
+            width, op, st['count'], st['total'], st['total'] / st['count'],
+            st['max'], st['failures']))
+
+
+if os.environ.get('SCH_SCRIPTS_PROFILE'):
+    enable(os.environ['SCH_SCRIPTS_PROFILE'])
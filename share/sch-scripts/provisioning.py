@@ -0,0 +1,208 @@
+# This file is part of sch-scripts, https://sch-scripts.gitlab.io
+# Copyright 2009-2022 the sch-scripts team, see AUTHORS
+# SPDX-License-Identifier: GPL-3.0-or-later
+"""
+Create the accounts of classes in a single transaction.
+"""
+import os
+import shutil
+
+import common
+import libuser
+import profiling
+import shadow
+import usernames
+
+
+class ClassAccounts:
+    """The groups and users for a number of computers in each class.
+
+    plan() only assigns the names and the IDs, so it's fast enough for the
+    GUI thread. apply() hashes the passwords in parallel, writes all the
+    account files under a single lock and creates the home directories,
+    so it should run in a worker thread. Either all the accounts are
+    created, or, if something fails, the ones that were created are
+    removed again.
+
+    The templates may contain {c} for the class, {i} for the computer
+    number and {0i} for the zero padded computer number.
+    """
+
+    def __init__(self, system, classes, computers, username_tmpl,
+                 name_tmpl='', password_tmpl='', groups_tmpl='{c}',
+                 add_teachers=False):
+        self.system = system
+        self.classes = [c.strip() for c in classes] or ['']
+        self.computers = computers
+        self.username_tmpl = username_tmpl
+        self.name_tmpl = name_tmpl
+        self.password_tmpl = password_tmpl
+        self.groups_tmpl = groups_tmpl
+        self.add_teachers = add_teachers
+        # The new class groups and user private groups
+        self.groups = []
+        self.users = []
+        self.plainpws = []
+        # The (group, username) pairs of teachers added to class groups
+        self.memberships = []
+        self.errors = []
+        # The home directories that apply() created
+        self.homes = []
+
+    @profiling.timed('provisioning.plan')
+    def plan(self):
+        """Choose the names and IDs of all the groups and users; return
+        the list of errors, which is empty if the plan can be applied."""
+        system = self.system
+        self.groups, self.users, self.plainpws, self.memberships = [], [], [], []
+        self.errors = []
+        classes = [c for c in self.classes if c]
+        for classn in classes:
+            if not system.name_is_valid(classn):
+                self.errors.append("Μη έγκυρο όνομα τμήματος: %s" % classn)
+        if self.errors:
+            return self.errors
+
+        # A username also names its private group, so it can't be taken
+        # by a group either. Taken names aren't suffixed, as e.g. a1-01
+        # would become a1-012; running create class twice is refused.
+        taken = set(system.users)
+        taken.update(system.groups)
+        taken.update(classes)
+        pairs = [(classn, compn) for classn in self.classes
+                 for compn in range(1, self.computers+1)]
+        names = [usernames.expand(self.username_tmpl, classn, compn)
+                 for classn, compn in pairs]
+        existing = {}
+        seen, repeated = set(), []
+        for (classn, compn), name in zip(pairs, names):
+            if name in seen:
+                if name not in repeated:
+                    repeated.append(name)
+            elif name in taken:
+                existing.setdefault(classn, []).append(name)
+            elif not system.name_is_valid(name) \
+                    or len(name) > usernames.MAX_LENGTH:
+                self.errors.append("Μη έγκυρο όνομα χρήστη: %s" % name)
+            seen.add(name)
+        if repeated:
+            self.errors.append(
+                "Το πρότυπο δίνει τα ίδια ονόματα σε περισσότερους χρήστες: "
+                "%s" % ', '.join(repeated))
+        for classn, taken_names in existing.items():
+            if classn in system.groups:
+                self.errors.append(
+                    "Το τμήμα %s υπάρχει ήδη και έχει τους χρήστες: %s"
+                    % (classn, ', '.join(taken_names)))
+            else:
+                self.errors.append("Υπάρχουν ήδη οι χρήστες ή οι ομάδες: %s"
+                                   % ', '.join(taken_names))
+        if self.errors:
+            return self.errors
+        uids, gids = set(), set()
+
+        def free_gid():
+            gid = system.get_free_gid(exclude=gids)
+            if gid is None:
+                self.errors.append("Δεν υπάρχουν διαθέσιμα GID.")
+            gids.add(gid)
+            return gid
+
+        new_groups = set()
+        for classn in classes:
+            if classn not in system.groups and classn not in new_groups:
+                self.groups.append(libuser.Group(classn, free_gid()))
+                new_groups.add(classn)
+        if self.add_teachers:
+            teachers = [u for u in system.users.values()
+                        if system.teachers in u.groups]
+            for classn in classes:
+                for teacher in teachers:
+                    if classn not in teacher.groups:
+                        self.memberships.append((classn, teacher.name))
+
+        lstchg = common.days_since_epoch()
+        for (classn, compn), name in zip(pairs, names):
+            ev = lambda x: usernames.expand(x, classn, compn)
+            uid = system.get_free_uid(exclude=uids)
+            if uid is None:
+                self.errors.append("Δεν υπάρχουν διαθέσιμα UID.")
+                break
+            uids.add(uid)
+            gid = free_gid()
+            if gid is None:
+                break
+            groups = []
+            for group in ev(self.groups_tmpl).split():
+                if group not in groups and (group in system.groups
+                                            or group in new_groups):
+                    groups.append(group)
+            self.groups.append(libuser.Group(name, gid))
+            self.users.append(libuser.User(
+                name=name, uid=uid, gid=gid, rname=ev(self.name_tmpl),
+                directory=os.path.join(libuser.HOME_PREFIX, name),
+                lstchg=lstchg, groups=groups))
+            self.plainpws.append(ev(self.password_tmpl))
+        return self.errors
+
+    @profiling.timed('provisioning.apply')
+    def apply(self, progress=None):
+        """Create the planned accounts; return the list of errors, which is
+        empty on success. progress(message, done, total) is called from the
+        calling thread."""
+        if progress is None:
+            progress = lambda message, done, total: None
+        total = len(self.users)
+
+        def hash_progress(done, total):
+            progress("Κρυπτογράφηση κωδικού %d από %d..." % (done, total),
+                     done, total)
+
+        hashes = self.system.encrypt_many(self.plainpws, hash_progress)
+        for user, password in zip(self.users, hashes):
+            user.password = password
+
+        progress("Αποθήκευση των λογαριασμών...", 0, total)
+        try:
+            with shadow.Transaction() as tr:
+                for group in self.groups:
+                    tr.add_group(group)
+                for user in self.users:
+                    tr.add_user(user)
+                for group, username in self.memberships:
+                    tr.add_member(group, username)
+        except (shadow.LockError, OSError, ValueError) as e:
+            # Nothing was written
+            self.errors.append(str(e))
+            return self.errors
+
+        for done, user in enumerate(self.users, 1):
+            existed = os.path.exists(user.directory)
+            try:
+                shadow.create_home(user)
+            except OSError as e:
+                self.errors.append("%s: %s" % (user.name, e))
+            if not existed and os.path.exists(user.directory):
+                self.homes.append(user.directory)
+            if self.errors:
+                break
+            progress("Δημιουργία χρήστη %d από %d..." % (done, total),
+                     done, total)
+        if self.errors:
+            self.rollback()
+        return self.errors
+
+    def rollback(self):
+        """Remove the accounts and the home directories that apply()
+        created."""
+        try:
+            with shadow.Transaction() as tr:
+                tr.remove_users(u.name for u in self.users)
+                tr.remove_groups(g.name for g in self.groups)
+                for group, username in self.memberships:
+                    tr.remove_member(group, username)
+        except (shadow.LockError, OSError) as e:
+            self.errors.append("Αποτυχία αναίρεσης των αλλαγών: %s" % e)
+        for home in self.homes:
+            shutil.rmtree(home, ignore_errors=True)
+        self.homes = []
@@ -5,7 +5,11 @@
 """
 Sch-scripts form.
 """
+import time
+# Before the slow imports, for --startup-time
+STARTED = time.monotonic()
 from _gi import Gtk
+from gi.repository import GLib
 import os
 import subprocess
 import sys
@@ -13,28 +17,30 @@ from dbus.mainloop.glib import DBusGMainLoop
 DBusGMainLoop(set_as_default=True)
 from twisted.internet import gtk3reactor
 gtk3reactor.install()
-from twisted.internet import reactor, defer
-
-import about_dialog
+from twisted.internet import reactor
+import profiling
+# Enable profiling before libuser loads the system users
+if '--profile' in sys.argv[1:]:
+    profiling.enable(profiling.LOG_PATH)
+
+# Time the startup until the users are shown, then quit
+STARTUP_TIME = '--startup-time' in sys.argv[1:]
+if STARTUP_TIME:
+    profiling.enable()
+
+# The dialogs are imported on first use, to start faster
 import config
-import create_users
 import dialogs
-import export_dialog
-import group_form
-import import_dialog
-import ip_dialog
 import libuser
-import ltsp_info
-import parsers
-import run_users
 import shared_folders
-import user_form
+import treemodels
 import version
 
 class Gui:
     def __init__(self):
-        self.system = libuser.system
-        self.sf=shared_folders.SharedFolders(self.system)
+        # The users are loaded after the window is shown, see load_system()
+        self.system = None
+        self.sf = None
         self.conf = config.parser
 
         self.builder = Gtk.Builder()
@@ -50,6 +56,12 @@ class Gui:
         self.groups_filter = self.builder.get_object('groups_filter')
         self.users_model = self.builder.get_object('users_store')
         self.groups_model = self.builder.get_object('groups_store')
+        self.users_rows = treemodels.ObjectRows(self.users_model,
+            self.user_row, lambda u: self.system.users.get(u.name) is u)
+        self.groups_rows = treemodels.ObjectRows(self.groups_model,
+            self.group_row, lambda g: self.system.groups.get(g.name) is g)
+        # The members of the selected groups, computed once per filtering
+        self.selected_members = None
 
         # Show the tooltips in the statusbar
         self.statusbar = self.builder.get_object('statusbar')
@@ -83,16 +95,39 @@ class Gui:
             menuitem.connect('toggled', self.on_mi_view_column_toggled, column)
             menuitem.set_active(title in visible)
             mn_view_columns.append(menuitem)
-        self.populate_treeviews()
 
         # Disable some menus
         self.on_groups_selection_changed(None)
         self.on_users_selection_changed(None)
 
-        self.queue = []
-        self.system.connect_event(self.on_libuser_changed)
+        # Until the users are loaded, nothing can be managed
+        self.main_window.set_sensitive(False)
+        self.statusbar.push(0, "Φόρτωση χρηστών και ομάδων...")
+        self.draw_id = self.main_window.connect(
+            'draw', self.on_main_window_first_draw)
         self.main_window.show_all()
 
+    def on_main_window_first_draw(self, widget, cr):
+        self.main_window.disconnect(self.draw_id)
+        profiling.record('startup.first_window', time.monotonic() - STARTED)
+        # After the window is painted
+        GLib.idle_add(self.load_system)
+
+    @profiling.timed('startup.load_system')
+    def load_system(self):
+        """Load the users and groups and fill the treeviews."""
+        self.system = libuser.system
+        self.sf = shared_folders.SharedFolders(self.system)
+        self.populate_treeviews()
+        self.system.connect_event(self.on_libuser_changed)
+        self.main_window.set_sensitive(True)
+        self.statusbar.push(0, "")
+        if STARTUP_TIME:
+            profiling.record('startup.users_loaded',
+                             time.monotonic() - STARTED)
+            reactor.stop()
+        return False
+
 # General helper functions
 
     def edit_file(self, filename):
@@ -123,60 +158,55 @@ class Gui:
 
 # INotify
 
-    def on_libuser_changed(self, event):
-        self.queue.append(event)
-        d = defer.Deferred()
-        reactor.callLater(1, d.callback, len(self.queue))
-        d.addCallback(self.check_libuser_events)
-
-    def check_libuser_events(self, len_queue):
-        if len_queue == len(self.queue):
-            self.queue = []
-            self.repopulate_treeviews()
+    def on_libuser_changed(self, changes):
+        # The group members may have changed
+        self.selected_members = None
+        self.users_rows.queue(changes.added_users + changes.changed_users
+                              + changes.removed_users)
+        self.groups_rows.queue(changes.added_groups + changes.changed_groups
+                               + changes.removed_groups)
 
 # Groups and users treeviews
 
+    def user_row(self, user):
+        return [user, user.uid, user.name, user.primary_group, user.rname,
+                user.office, user.wphone, user.hphone, user.other,
+                user.directory, user.shell, user.lstchg, user.min, user.max,
+                user.warn, user.inact, user.expire]
+
+    def group_row(self, group):
+        return [group, group.gid, group.name]
+
     def populate_treeviews(self):
         """Fill the users and groups treeviews from the system"""
-        for user in self.system.users.values():
-            self.users_model.append([user, user.uid, user.name, user.primary_group, user.rname, user.office, user.wphone, user.hphone, user.other, user.directory, user.shell, user.lstchg, user.min, user.max, user.warn, user.inact, user.expire])
-        for group in self.system.groups.values():
-            self.groups_model.append([group, group.gid, group.name])
+        self.users_rows.fill(self.system.users.values())
+        self.groups_rows.fill(self.system.groups.values())
 
     def repopulate_treeviews(self):
-        # Preserve the selected groups and users
-        groups_selection = self.groups_tree.get_selection()
-        users_selection = self.users_tree.get_selection()
-        selected_groups = [i.name for i in self.get_selected_groups()]
-        selected_users = [i.name for i in self.get_selected_users()]
-
-        # Clear and refill the treeviews
-        self.users_model.clear()
-        self.groups_model.clear()
-        self.populate_treeviews()
-
-        # Reselect the previously selected groups and users, if possible
-        groups_iters = dict((row[0].name, row.iter) for row in self.groups_sort)
-        for gname in selected_groups:
-            if gname in groups_iters:
-                groups_selection.select_iter(groups_iters[gname])
-        users_iters = dict((row[0].name, row.iter) for row in self.users_sort)
-        for uname in selected_users:
-            if uname in users_iters:
-                users_selection.select_iter(users_iters[uname])
+        """Update all the rows; the selection is preserved."""
+        self.selected_members = None
+        self.users_rows.sync(self.system.users.values())
+        self.groups_rows.sync(self.system.groups.values())
 
     def set_user_visibility(self, model, rowiter, options):
         user = model[rowiter][0]
-        selected = self.get_selected_groups()
-        # FIXME: The list comprehension here costs
-        return (len(selected) == 0 and (self.show_system_groups or not user.is_system_user())) \
-                or user in [u for g in selected for u in g.members.values()]
+        if self.selected_members is None:
+            selected = self.get_selected_groups()
+            if selected:
+                self.selected_members = set(u for g in selected
+                                            for u in g.members.values())
+            else:
+                self.selected_members = False
+        if self.selected_members is False:
+            return self.show_system_groups or not user.is_system_user()
+        return user in self.selected_members
 
     def set_group_visibility(self, model, rowiter, options):
         group = model[rowiter][0]
         return (self.show_private_groups or not group.is_private()) and (self.show_system_groups or group.is_user_group())
 
     def on_groups_selection_changed(self, selection):
+        self.selected_members = None
         self.users_filter.refilter()
         mi_edit_group = self.builder.get_object('mi_edit_group')
         mi_delete_group = self.builder.get_object('mi_delete_group')
@@ -262,9 +292,11 @@ class Gui:
             return True
 
     def on_users_treeview_row_activated(self, widget, path, column):
+        import user_form
         user_form.EditUserDialog(self.system, widget.get_model()[path][0])
 
     def on_groups_treeview_row_activated(self, widget, path, column):
+        import group_form
         group_form.EditGroupDialog(self.system, self.sf, widget.get_model()[path][0])
 
     def on_unselect_all_groups_clicked(self, widget):
@@ -276,7 +308,8 @@ class Gui:
         visible_cols = [col.get_title() for col in self.users_tree.get_columns() if col.get_visible()]
         self.conf.set('GUI', 'visible_user_columns', ','.join(visible_cols))
         config.save()
-        exit()
+        # Return from reactor.run(), so that e.g. the --profile summary runs
+        reactor.stop()
 
 # File menu
     def on_menubar_set_focus_child(self, widget):
@@ -298,6 +331,7 @@ class Gui:
     #FIXME: Maybe use notify /etc/group then self.populate_treeviews not need to
     #update user groups for shared folder library
     def on_mi_new_users_activate(self, widget):
+        import create_users
         create_users.NewUsersDialog(self.system, self.sf)
 
     def on_mi_import_passwd_activate(self, widget):
@@ -313,19 +347,21 @@ class Gui:
         resp = chooser.run()
         if resp == Gtk.ResponseType.OK:
             passwd = chooser.get_filename()
-            path = os.path.dirname(passwd)
-            shadow = os.path.join(path, 'shadow')
-            group = os.path.join(path, 'group')
-            if not os.path.isfile(shadow):
-                shadow = None
-            if not os.path.isfile(group):
-                group = None
-            new_users = parsers.passwd().parse(passwd, shadow, group)
+            import parsers
+            parser = parsers.passwd()
+            new_users = parser.parse(passwd, *parser.siblings(passwd))
             if len(new_users.users) == 0:
                 text = "Το αρχείο '%s' δεν περιέχει δεδομένα." % passwd
                 dialogs.ErrorDialog(text, "Σφάλμα").showup()
                 return False
             chooser.destroy()
+            if parser.warnings:
+                text = "Παραλείφθηκαν οι παρακάτω αναφορές:\n\n%s" % \
+                    '\n'.join(parser.warnings[:20])
+                if len(parser.warnings) > 20:
+                    text += "\n...και άλλες %d." % (len(parser.warnings) - 20)
+                dialogs.WarningDialog(text, "Προειδοποίηση").showup()
+            import import_dialog
             import_dialog.ImportDialog(new_users)
         else:
             chooser.destroy()
@@ -343,13 +379,19 @@ class Gui:
         resp = chooser.run()
         if resp == Gtk.ResponseType.OK:
             fname = chooser.get_filename()
-            new_users = parsers.CSV().parse(fname)
-            if len(new_users.users) == 0:
+            new_users = libuser.Set()
+            # Parse the first rows now and the rest while the dialog is shown
+            import parsers
+            parser = parsers.CSV()
+            chunks = parser.iter_parse(fname, new_users)
+            if next(chunks, None) is None:
                 text = "Το αρχείο '%s' δεν περιέχει δεδομένα." % fname
                 dialogs.ErrorDialog(text, "Σφάλμα").showup()
                 return False
             chooser.destroy()
-            import_dialog.ImportDialog(new_users)
+            import import_dialog
+            import_dialog.ImportDialog(new_users, chunks, parser.warnings,
+                                       (parser.uids, parser.gids))
         else:
             chooser.destroy()
 
@@ -360,6 +402,7 @@ class Gui:
                 users = self.system.users.values()
             else:
                 users = [u for u in self.system.users.values() if not u.is_system_user()]
+        import export_dialog
         export_dialog.ExportDialog(self.system, users)
 
 # Server menu
@@ -370,6 +413,7 @@ class Gui:
         self.run_term('./scripts/initial-setup.sh')
 
     def on_mi_configuration_network_activate(self, widget):
+        import ip_dialog
         ip_dialog.Ip_Dialog(self.main_window)
 
     def on_mi_updates_activate(self, widget):
@@ -487,9 +531,11 @@ class Gui:
 # Users menu
 
     def on_mi_new_user_activate(self, widget):
+        import user_form
         user_form.NewUserDialog(self.system)
 
     def on_mi_edit_user_activate(self, widget):
+        import user_form
         user_form.EditUserDialog(self.system, self.get_selected_users()[0])
 
     def on_mi_delete_user_activate(self, widget):
@@ -515,8 +561,16 @@ class Gui:
         response = dlg.showup()
         if response == Gtk.ResponseType.YES:
             rm_homes = rm_homes_check.get_active()
-            for user in self.get_selected_users():
-                self.system.delete_user(user, rm_homes)
+            # Removing the homes may take minutes; the window is updated
+            # by the inotify events while the users are deleted
+            self.main_window.set_sensitive(False)
+            d = self.system.delete_users_async(self.get_selected_users(),
+                                               rm_homes)
+            d.addBoth(self.on_users_deleted)
+
+    def on_users_deleted(self, results):
+        self.main_window.set_sensitive(True)
+        return results
 
     def on_mi_remove_user_activate(self, widget):
         users = self.get_selected_users()
@@ -537,14 +591,17 @@ class Gui:
     def on_mi_run_users_activate(self, widget):
         users = self.get_selected_users()
         users_n = len(users)
+        import run_users
         run_users.RunUsers(self.main_window, [user.name for user in users], self)
 
 # Groups menu
 
     def on_mi_new_group_activate(self, widget):
+        import group_form
         group_form.NewGroupDialog(self.system, self.sf)
 
     def on_mi_edit_group_activate(self, widget):
+        import group_form
         group_form.EditGroupDialog(self.system, self.sf, self.get_selected_groups()[0])
 
     def on_mi_delete_group_activate(self, widget):
@@ -580,6 +637,7 @@ class Gui:
         self.open_link('https://ts.sch.gr/wiki/linux/ltsp/map')
 
     def on_mi_about_activate(self, widget):
+        import about_dialog
         about_dialog.AboutDialog(self.main_window)
 
 
@@ -600,8 +658,13 @@ def usage():
 Επιλογές:
     -h, --help     Σελίδα βοήθειας της εφαρμογής.
     -v, --version  Προβολή έκδοσης των sch-scripts.
+    --profile      Χρονομέτρηση των εντολών και των λειτουργιών διαχείρισης,
+                   με καταγραφή στο %s
+                   και εμφάνιση σύνοψης κατά την έξοδο.
+    --startup-time Χρονομέτρηση της εκκίνησης μέχρι την εμφάνιση του
+                   παραθύρου και των χρηστών, και έξοδος.
 
-Αναφορά σφαλμάτων στο https://gitlab.com/sch-scripts/sch-scripts/issues.""")
+Αναφορά σφαλμάτων στο https://gitlab.com/sch-scripts/sch-scripts/issues.""" % profiling.LOG_PATH)
 
 
 def print_version():
@@ -618,8 +681,11 @@ if __name__ == '__main__':
     elif len(sys.argv) == 2 and (sys.argv[1] == '-h' or sys.argv[1] == '--help'):
         usage()
         sys.exit(0)
-    elif len(sys.argv) >= 2:
+    elif len(sys.argv) >= 2 and sys.argv[1:] not in (['--profile'],
+                                                     ['--startup-time']):
         usage()
         sys.exit(1)
     Gui()
     reactor.run()
+    if profiling.enabled:
+        profiling.summary()
@@ -0,0 +1,398 @@
+# This file is part of sch-scripts, https://sch-scripts.gitlab.io
+# Copyright 2009-2022 the sch-scripts team, see AUTHORS
+# SPDX-License-Identifier: GPL-3.0-or-later
+"""
+Direct, locked access to the passwd, shadow, group and gshadow files.
+"""
+import ctypes
+import ctypes.util
+import os
+import shutil
+
+import common
+import executor
+
+PASSWD = '/etc/passwd'
+SHADOW = '/etc/shadow'
+GROUP = '/etc/group'
+GSHADOW = '/etc/gshadow'
+SKEL = '/etc/skel'
+# The name service caches that shadow-utils flushes after its changes
+NSCD = '/usr/sbin/nscd'
+SSS_CACHE = '/usr/sbin/sss_cache'
+CACHE_TIMEOUT = 30
+
+_libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+
+
+class LockError(Exception):
+    pass
+
+
+class File:
+    """The rows of a colon separated file, split into fields."""
+
+    def __init__(self, path):
+        self.path = path
+        self.rows = []
+        self.index = {}
+        self.changed = False
+        if not os.path.isfile(path):
+            self.exists = False
+            return
+        self.exists = True
+        with open(path) as f:
+            for line in f:
+                row = line.rstrip('\n').split(':')
+                self.index.setdefault(row[0], len(self.rows))
+                self.rows.append(row)
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def get(self, name):
+        if name in self.index:
+            return self.rows[self.index[name]]
+        return None
+
+    def append(self, row):
+        self.index[row[0]] = len(self.rows)
+        self.rows.append([str(field) for field in row])
+        self.changed = True
+
+    def add_member(self, name, member, field=3):
+        """Append member to the comma separated list in the row field."""
+        row = self.get(name)
+        if row is None:
+            return
+        members = [m for m in row[field].split(',') if m]
+        if member not in members:
+            members.append(member)
+            row[field] = ','.join(members)
+            self.changed = True
+
+    def remove_member(self, name, member, field=3):
+        """Remove member from the comma separated list in the row field."""
+        row = self.get(name)
+        if row is None:
+            return
+        members = [m for m in row[field].split(',') if m]
+        if member in members:
+            members.remove(member)
+            row[field] = ','.join(members)
+            self.changed = True
+
+    def remove(self, names, field=3):
+        """Remove the rows of names, and names from the member lists in the
+        row field of the other rows unless field is None, in a single pass.
+        """
+        names = set(names)
+        rows = []
+        for row in self.rows:
+            if row[0] in names:
+                self.changed = True
+                continue
+            if field is not None and len(row) > field and row[field]:
+                members = [m for m in row[field].split(',') if m]
+                kept = [m for m in members if m not in names]
+                if len(kept) != len(members):
+                    row[field] = ','.join(kept)
+                    self.changed = True
+            rows.append(row)
+        self.rows = rows
+        self.index = {}
+        for i, row in enumerate(rows):
+            self.index.setdefault(row[0], i)
+
+    def write(self):
+        """Atomically replace the file, keeping a backup like shadow-utils."""
+        if not self.exists or not self.changed:
+            return
+        st = os.stat(self.path)
+        shutil.copy2(self.path, self.path + '-')
+        tmp = self.path + '+'
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            for row in self.rows:
+                f.write(':'.join(row) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.chown(tmp, st.st_uid, st.st_gid)
+        os.chmod(tmp, st.st_mode & 0o7777)
+        os.rename(tmp, self.path)
+        self.changed = False
+
+
+class Transaction:
+    """Add or remove users and groups in the account files under a single
+    lock.
+
+    The lock is the same one used by shadow-utils: lckpwdf(3) plus a
+    <file>.lock link for each file. The files are only written when the
+    with block exits without an exception:
+
+        with shadow.Transaction() as tr:
+            tr.add_group(group)
+            tr.add_user(user)
+    """
+
+    def __init__(self):
+        self.paths = [PASSWD, SHADOW, GROUP, GSHADOW]
+        self.locks = []
+        self.passwd = self.shadow = self.group = self.gshadow = None
+        self.uids = set()
+        self.gids = {}
+
+    def __enter__(self):
+        self.lock()
+        try:
+            self.passwd, self.shadow, self.group, self.gshadow = \
+                [File(path) for path in self.paths]
+        except Exception:
+            self.unlock()
+            raise
+        self.uids = set(int(row[2]) for row in self.passwd.rows
+                        if len(row) > 2 and row[2].isdigit())
+        self.gids = dict((int(row[2]), row[0]) for row in self.group.rows
+                         if len(row) > 2 and row[2].isdigit())
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None:
+                self.commit()
+        finally:
+            self.unlock()
+
+    def lock(self):
+        if _libc.lckpwdf() != 0:
+            raise LockError("Cannot lock the password files: %s"
+                            % os.strerror(ctypes.get_errno()))
+        try:
+            for path in self.paths:
+                if os.path.isfile(path):
+                    self.lock_file(path)
+        except LockError:
+            self.unlock()
+            raise
+
+    def lock_file(self, path):
+        """Lock path the way shadow-utils does, with a link to path.lock."""
+        pidfile = '%s.%d' % (path, os.getpid())
+        lockfile = path + '.lock'
+        with open(pidfile, 'w') as f:
+            f.write('%d' % os.getpid())
+        try:
+            try:
+                os.link(pidfile, lockfile)
+            except FileExistsError:
+                # Remove stale locks left behind by dead processes
+                try:
+                    with open(lockfile) as f:
+                        pid = int(f.read().strip() or 0)
+                    os.kill(pid, 0)
+                except (ValueError, ProcessLookupError):
+                    os.unlink(lockfile)
+                    os.link(pidfile, lockfile)
+                except (FileNotFoundError, PermissionError):
+                    raise LockError("%s is locked" % path)
+                else:
+                    raise LockError("%s is locked" % path)
+        finally:
+            os.unlink(pidfile)
+        self.locks.append(lockfile)
+
+    def unlock(self):
+        while self.locks:
+            try:
+                os.unlink(self.locks.pop())
+            except OSError:
+                pass
+        _libc.ulckpwdf()
+
+    def add_group(self, group):
+        """Add a Group object; raise ValueError if it conflicts."""
+        if group.name in self.group:
+            raise ValueError("Group '%s' exists" % group.name)
+        if group.gid in self.gids:
+            raise ValueError("GID %s is used by group '%s'"
+                             % (group.gid, self.gids[group.gid]))
+        members = ','.join(group.members)
+        self.group.append([group.name, 'x', group.gid, members])
+        if self.gshadow.exists:
+            self.gshadow.append([group.name, '!', '', members])
+        self.gids[group.gid] = group.name
+
+    def add_user(self, user):
+        """Add a User object; raise ValueError if it conflicts."""
+        if user.name in self.passwd:
+            raise ValueError("User '%s' exists" % user.name)
+        if user.uid in self.uids:
+            raise ValueError("UID %s is already used" % user.uid)
+        if user.gid not in self.gids:
+            raise ValueError("GID %s does not exist" % user.gid)
+        for group in user.groups:
+            if group not in self.group:
+                raise ValueError("Group '%s' does not exist" % group)
+
+        gecos = ','.join([user.rname, user.office, user.wphone, user.hphone,
+                          user.other]).rstrip(',')
+        self.passwd.append([user.name, 'x', user.uid, user.gid, gecos,
+                            user.directory, user.shell])
+        lstchg = user.lstchg
+        if lstchg is None:
+            lstchg = common.days_since_epoch()
+        password = user.password if user.password is not None else '!'
+        self.shadow.append([user.name, password] + [
+            '' if v is None or v == -1 else v for v in
+            [lstchg, user.min, user.max, user.warn, user.inact, user.expire]]
+            + [''])
+        for group in user.groups:
+            if self.gids.get(user.gid) == group:
+                continue
+            self.group.add_member(group, user.name)
+            self.gshadow.add_member(group, user.name)
+        self.uids.add(user.uid)
+
+    def add_member(self, group, username):
+        """Add username to the members of the existing group."""
+        if group not in self.group:
+            raise ValueError("Group '%s' does not exist" % group)
+        self.group.add_member(group, username)
+        self.gshadow.add_member(group, username)
+
+    def remove_member(self, group, username):
+        self.group.remove_member(group, username)
+        self.gshadow.remove_member(group, username)
+
+    def remove_users(self, names):
+        """Remove the users and their group memberships."""
+        names = set(names)
+        for name in names:
+            row = self.passwd.get(name)
+            if row is not None and len(row) > 2 and row[2].isdigit():
+                self.uids.discard(int(row[2]))
+        # Only the group files have member lists
+        self.passwd.remove(names, field=None)
+        self.shadow.remove(names, field=None)
+        self.group.remove(names)
+        self.gshadow.remove(names)
+
+    def remove_groups(self, names):
+        names = set(names)
+        self.group.remove(names, field=None)
+        self.gshadow.remove(names, field=None)
+        self.gids = dict((gid, name) for gid, name in self.gids.items()
+                         if name not in names)
+
+    def commit(self):
+        # Write the shadow files first, like shadow-utils, so that a new
+        # passwd entry never appears without its password
+        files = [self.shadow, self.gshadow, self.group, self.passwd]
+        changed = any(f.exists and f.changed for f in files)
+        for f in files:
+            f.write()
+        if changed:
+            flush_caches()
+
+
+def flush_caches():
+    """Invalidate the users and groups in the nscd and sssd caches, if
+    they're installed, so that NSS doesn't return stale entries after the
+    files were written directly."""
+    # nscd invalidates a single table per call
+    cmds = [[NSCD, '-i', 'passwd'], [NSCD, '-i', 'group'],
+            [SSS_CACHE, '-E']]
+    for cmd in cmds:
+        if os.access(cmd[0], os.X_OK):
+            # Like shadow-utils, ignore the errors, e.g. if nscd isn't running
+            executor.executor.run(cmd, timeout=CACHE_TIMEOUT)
+
+
+def create_home(user, mode=0o755, skel=SKEL):
+    """Create the user home directory from skel, unless it exists."""
+    if os.path.exists(user.directory):
+        return False
+    if os.path.isdir(skel):
+        shutil.copytree(skel, user.directory, symlinks=True)
+    else:
+        os.makedirs(user.directory)
+    for root, dirs, files in os.walk(user.directory):
+        for name in dirs + files:
+            os.lchown(os.path.join(root, name), user.uid, user.gid)
+    os.chown(user.directory, user.uid, user.gid)
+    os.chmod(user.directory, mode)
+    return True
+
+
+if __name__ == '__main__':
+    # Benchmark: create 10, 100 and 1000 users with their private groups in
+    # temporary copies of the account files, with a Transaction and with the
+    # useradd/usermod path that libuser.System.add_user used for each user.
+    # chfn and chage have no --prefix option, so the old path is timed
+    # without them and is a lower bound. Needs root for lckpwdf(3).
+    import subprocess
+    import sys
+    import tempfile
+    import time
+    import libuser
+
+    def copy_files(prefix):
+        os.makedirs(os.path.join(prefix, 'etc'))
+        paths = []
+        for path in [PASSWD, SHADOW, GROUP, GSHADOW]:
+            paths.append(prefix + path)
+            if os.path.isfile(path):
+                shutil.copy2(path, prefix + path)
+        return paths
+
+    def accounts(count):
+        users, groups = [], []
+        for i in range(count):
+            name = 'bench%d' % i
+            user = libuser.User(
+                name=name, uid=60000 + i, gid=60000 + i, rname='Bench %d' % i,
+                directory='/home/%s' % name, password='!', lstchg=19000)
+            user.groups = [name]
+            users.append(user)
+            groups.append(libuser.Group(name, 60000 + i))
+        return users, groups
+
+    def with_transaction(prefix, users, groups):
+        tr = Transaction()
+        tr.paths = copy_files(prefix)
+        with tr:
+            for group in groups:
+                tr.add_group(group)
+            for user in users:
+                tr.add_user(user)
+
+    def with_useradd(prefix, users, groups):
+        copy_files(prefix)
+        for user, group in zip(users, groups):
+            for cmd in [
+                    ['groupadd', '-P', prefix, '-g', group.gid, group.name],
+                    ['useradd', '-P', prefix, '-M', '-d', user.directory,
+                     '-g', user.gid, user.name],
+                    # usermod --prefix looks up the groups outside the
+                    # prefix, so -g and -G are left out
+                    ['usermod', '-P', prefix, '-d', user.directory,
+                     '-l', user.name, '-p', user.password, '-s', user.shell,
+                     '-u', user.uid, user.name]]:
+                subprocess.run([str(arg) for arg in cmd], check=True)
+
+    if os.geteuid() != 0:
+        sys.exit("The benchmark needs to run as root")
+    for count in [10, 100, 1000]:
+        users, groups = accounts(count)
+        times = []
+        for create in [with_transaction, with_useradd]:
+            with tempfile.TemporaryDirectory() as tmp:
+                start = time.time()
+                create(tmp, users, groups)
+                times.append(time.time() - start)
+                with open(tmp + PASSWD) as f:
+                    created = sum(1 for line in f if line.startswith('bench'))
+                assert created == count, created
+        print("%d users: Transaction %.3fs, useradd %.3fs, %.0fx faster"
+              % (count, times[0], times[1], times[1] / times[0]))
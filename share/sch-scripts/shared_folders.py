@@ -5,13 +5,92 @@
 """
 Shared folders.
 """
+import functools
 import hashlib
 import os
+import re
+import select
 import shlex
 import stat
 import sys
-import subprocess
+import executor
 import libuser
+import profiling
+
+# Seconds to wait for bindfs, umount and exportfs
+COMMAND_TIMEOUT = 60
+# The bindfs daemons that are started at the same time
+MOUNT_WORKERS = 8
+EXPORTS = "/etc/exports.d/shared-folders.exports"
+EXPORT_CLIENT = "*"
+EXPORT_OPTIONS = "rw,async,no_subtree_check,no_root_squash,insecure"
+
+class Mount(dict):
+    """A mount point; its uid and gid are only stat'ed when needed, as stat
+    on a FUSE mount is a round trip to the bindfs daemon."""
+
+    def __missing__(self, key):
+        if key not in ('uid', 'gid'):
+            raise KeyError(key)
+        st = os.stat(self['point'])
+        self['uid'] = st.st_uid
+        self['gid'] = st.st_gid
+        return self[key]
+
+
+class MountTable:
+    """The mounts of /proc/self/mountinfo, parsed again only after the
+    kernel signals a change with POLLPRI on the open file."""
+    PATH = '/proc/self/mountinfo'
+
+    def __init__(self):
+        self.file = None
+        self.poller = None
+        self.mounts = None
+
+    def get(self):
+        """Return a list of Mount dicts with point, fstype and source."""
+        if self.file is None:
+            try:
+                self.file = open(self.PATH, 'rb')
+            except OSError:
+                return self.read_proc_mounts()
+            self.poller = select.poll()
+            self.poller.register(self.file, select.POLLPRI | select.POLLERR)
+        # The kernel reports each change to a single poll() call
+        if self.mounts is None or self.poller.poll(0):
+            self.file.seek(0)
+            self.mounts = self.parse(self.file.read().decode('utf-8',
+                                                             'replace'))
+        return self.mounts
+
+    def parse(self, contents):
+        # 36 35 98:0 /mnt1 /mnt2 rw,noatime master:1 - ext3 /dev/root rw
+        mounts = []
+        for line in contents.splitlines():
+            fields = line.split()
+            sep = fields.index('-', 6)
+            mounts.append(Mount(point=unescape(fields[4]),
+                                fstype=fields[sep + 1],
+                                source=unescape(fields[sep + 2])))
+        return mounts
+
+    def read_proc_mounts(self):
+        mounts = []
+        with open("/proc/mounts") as f:
+            for line in f:
+                items = line.split()
+                mounts.append(Mount(point=unescape(items[1]), fstype=items[2],
+                                    source=unescape(items[0])))
+        return mounts
+
+
+def unescape(field):
+    """Decode the octal escapes of spaces etc. in the mount fields."""
+    if '\\' not in field:
+        return field
+    return re.sub(r'\\([0-7]{3})', lambda m: chr(int(m.group(1), 8)), field)
+
 
 # TODO: after the workshop, let's move the shared_folders ui into its own
 # dialog, and only disable editing groups that have shares in group_form.py
@@ -25,6 +104,7 @@ class SharedFolders():
             self.system=libuser.System()
         else:
             self.system=system
+        self.mount_table=MountTable()
         self.load_config()
 
     def add(self, groups):
@@ -47,7 +127,7 @@ class SharedFolders():
 
     def list_mounted(self, groups=None):
         """Return which of the specified groups are mounted."""
-        groups=self.valid(groups)
+        groups=set(self.valid(groups))
         mounted=[]
         for mount in self.parse_mounts():
             if mount['group'] in groups:
@@ -82,18 +162,24 @@ class SharedFolders():
         self.system.share_groups=self.config["SHARE_GROUPS"].split(" ")
 
     def mount(self, groups=None):
-        """Mount or remount the folders for the specified groups."""
+        """Mount or remount the folders for the specified groups.
+        Return a {group: executor.Result} dict of the bindfs commands."""
         groups=self.valid(groups)
         # Remove from groups the ones that don't need to be (re)mounted.
         # Unmount the ones that need remounting, without removing them.
+        wanted=set(groups)
+        remount=[]
         for mount in self.parse_mounts():
             group=mount["group"]
-            if group not in groups:
+            if group not in wanted:
                 continue
             if self.system.groups[group].gid == mount["gid"]:
-                groups.remove(group)
+                wanted.discard(group)
             else:
-                self.unmount(group)
+                remount.append(group)
+        if remount:
+            self.unmount(remount)
+        groups=[group for group in groups if group in wanted]
         # Then mount what's left.
         # This might actually be the first time to mount anything,
         # so ensure that all the dirs/symlinks are there.
@@ -102,29 +188,67 @@ class SharedFolders():
             adm_uid, int(self.config["ADM_GID"]))
         self.ensure_dir(self.config["SHARE_DIR/"] + ".symlinks", 0o731,
             adm_uid, self.system.groups[self.config["TEACHERS"]].gid)
+        for group in groups:
+            self.ensure_dir(self.config["SHARE_DIR/"] + group, 0o770,
+                adm_uid, self.system.groups[group].gid)
+        results=self.bindfs(groups)
+        self.nfs_exports()
+        return results
+
+    def bindfs(self, groups):
+        """Mount the folders of groups, which must exist and not be mounted.
+        Return a {group: executor.Result} dict."""
+        adm_uid=int(self.config["ADM_UID"])
+        cmds=[]
         for group in groups:
             dir=self.config["SHARE_DIR/"] + group
             group_gid=self.system.groups[group].gid
-            self.ensure_dir(dir, 0o770, adm_uid, group_gid)
-            subprocess.call(["bindfs",
+            cmds.append(["bindfs",
                 "-u", str(adm_uid),
                 "--create-for-user=%s" % adm_uid,
                 "-g", str(group_gid),
                 "--create-for-group=%s" % group_gid,
                 "-p", "770,af-x", "--chown-deny", "--chgrp-deny",
                 "--chmod-deny", dir, dir])
-        self.nfs_exports()
+        # Each bindfs waits for its FUSE daemon to start, so run them in
+        # parallel and report the errors after all of them are done
+        results=dict(zip(groups, executor.executor.run_many(cmds,
+            COMMAND_TIMEOUT, MOUNT_WORKERS)))
+        for group, result in results.items():
+            if not result.ok:
+                sys.stderr.write("Cannot mount the shared folder of %s%s:\n%s%s"
+                    % (group, " (timeout)" if result.timed_out else "",
+                    result.stdout, result.stderr))
+        return results
+
+    def run(self, cmd):
+        """Run cmd, print its errors and return the executor.Result."""
+        result = executor.executor.run(cmd, timeout=COMMAND_TIMEOUT)
+        if not result.ok:
+            sys.stderr.write("%s failed%s:\n%s%s" % (cmd[0],
+                " (timeout)" if result.timed_out else "",
+                result.stdout, result.stderr))
+        return result
 
     def nfs_exports(self):
         """Generate /etc/exports.d/shared-folders.exports for NFS.
            Called by mount() and remove();
            not by add() as NFS might not be installed yet."""
-        if self.config["DISABLE_NFS_EXPORTS"] != "false":
+        exports=self.exports()
+        if exports is None:
             return
+        fpath, oldc, newc=exports
+        if oldc != newc:
+            self.write_exports(fpath, newc, oldc)
+
+    def exports(self):
+        """Return the exports file path, its contents and the contents that
+        it should have; or None if the NFS exports are disabled."""
+        if self.config["DISABLE_NFS_EXPORTS"] != "false":
+            return None
         if not os.path.isfile("/usr/sbin/exportfs"):
-            return
-        dpath="/etc/exports.d"
-        fpath="%s/shared-folders.exports" % dpath
+            return None
+        fpath=EXPORTS
         if os.path.isfile(fpath):
             with open(fpath) as f:
                 oldc=f.read()
@@ -136,19 +260,142 @@ class SharedFolders():
             "# Documentation=man:shared-folders(8)",
             ""]
         for group in self.system.share_groups:
-            newlines.append(
-                "%s\t*(fsid=%s,rw,async,no_subtree_check,no_root_squash,insecure)" %
-                    (self.config["SHARE_DIR/"] + group,
-                    hashlib.md5((self.config["SHARE_DIR/"] + group).encode("utf-8")).hexdigest()))
+            path=self.config["SHARE_DIR/"] + group
+            newlines.append("%s\t%s(fsid=%s,%s)" %
+                (path, EXPORT_CLIENT, fsid(path), EXPORT_OPTIONS))
         if (len(newlines) > 4):
             newlines.append("")
         newc="\n".join(newlines)
-        if oldc != newc:
-            self.ensure_dir(dpath)
-            with open(fpath, "w") as f:
-                f.write(newc)
-            print("Updated %s, running `exportsfs -ra`" % fpath)
-            subprocess.call(["exportfs", "-ra"])
+        return fpath, oldc, newc
+
+    def write_exports(self, fpath, contents, oldc=None):
+        """Atomically replace the exports file, then export or unexport
+        only the entries that changed, instead of re-exporting everything
+        with `exportfs -ra`, which disturbs the NFS clients."""
+        if oldc is None:
+            oldc=""
+            if os.path.isfile(fpath):
+                with open(fpath) as f:
+                    oldc=f.read()
+        self.ensure_dir(os.path.dirname(fpath))
+        tmp=fpath + ".tmp"
+        with open(tmp, "w") as f:
+            f.write(contents)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, fpath)
+        old=parse_exports(oldc)
+        new=parse_exports(contents)
+        cmds=[]
+        for path, (client, options) in sorted(old.items()):
+            if path not in new:
+                cmds.append(["exportfs", "-u", "%s:%s" % (client, path)])
+        for path, (client, options) in sorted(new.items()):
+            if old.get(path) != (client, options):
+                if path in old and old[path][0] != client:
+                    cmds.append(["exportfs", "-u",
+                                 "%s:%s" % (old[path][0], path)])
+                cmds.append(["exportfs", "-o", options,
+                             "%s:%s" % (client, path)])
+        print("Updated %s, running %d exportfs commands" % (fpath, len(cmds)))
+        for cmd in cmds:
+            if not self.run(cmd).ok:
+                # Let exportfs sync everything with the files
+                self.run(["exportfs", "-ra"])
+                break
+
+    def plan(self):
+        """Compare the shared folders that should exist, according to
+        share_groups and the group GIDs, with the actual mounts, directories
+        and exports; return the actions that make them match, as tuples:
+            ("mkdir", dir, mode, uid, gid), ("chmod", dir, mode),
+            ("chown", dir, uid, gid), ("unmount", point),
+            ("ensure_dir", dir, mode, uid, gid), ("mount", group),
+            ("exports", path, contents)
+        ensure_dir is for dirs that are hidden under a mount to be removed.
+        """
+        actions=[]
+        share_dir=self.config["SHARE_DIR/"]
+        adm_uid=int(self.config["ADM_UID"])
+        actions += self.plan_dir(self.config["SHARE_DIR"], 0o711,
+            adm_uid, int(self.config["ADM_GID"]))
+        actions += self.plan_dir(share_dir + ".symlinks", 0o731,
+            adm_uid, self.system.groups[self.config["TEACHERS"]].gid)
+
+        groups=self.valid()
+        mounted={}
+        for mount in self.mount_table.get():
+            if mount['point'].startswith(share_dir) and \
+              mount['fstype'] in ["fuse", "fuse.bindfs"]:
+                mounted[mount['point'][len(share_dir):]]=mount
+        wanted=set(groups)
+        for group, mount in sorted(mounted.items()):
+            if group not in wanted:
+                actions.append(("unmount", mount['point']))
+        for group in groups:
+            dir=share_dir + group
+            gid=self.system.groups[group].gid
+            mount=mounted.get(group)
+            if mount is not None:
+                if mount['gid'] == gid:
+                    continue
+                actions.append(("unmount", mount['point']))
+                actions.append(("ensure_dir", dir, 0o770, adm_uid, gid))
+            else:
+                actions += self.plan_dir(dir, 0o770, adm_uid, gid)
+            actions.append(("mount", group))
+
+        exports=self.exports()
+        if exports is not None and exports[1] != exports[2]:
+            actions.append(("exports", exports[0], exports[2]))
+        return actions
+
+    def plan_dir(self, dir, mode, uid, gid):
+        """Return the actions that ensure_dir(dir, mode, uid, gid) needs."""
+        try:
+            s=os.stat(dir)
+        except FileNotFoundError:
+            return [("mkdir", dir, mode, uid, gid)]
+        actions=[]
+        if stat.S_IMODE(s.st_mode) != mode:
+            actions.append(("chmod", dir, mode))
+        if uid != s.st_uid or gid != s.st_gid:
+            actions.append(("chown", dir, uid, gid))
+        return actions
+
+    def sync(self, dry_run=False):
+        """Apply the plan(), or with dry_run only print it."""
+        actions=self.plan()
+        if dry_run or not actions:
+            for action in actions:
+                print(describe(action))
+            if not actions:
+                print("Οι κοινόχρηστοι φάκελοι είναι ενημερωμένοι.")
+            return actions
+        mounts=[]
+        exports=None
+        for action in actions:
+            print(describe(action))
+            name, args=action[0], action[1:]
+            if name in ("mkdir", "ensure_dir"):
+                self.ensure_dir(*args)
+            elif name == "chmod":
+                os.chmod(*args)
+            elif name == "chown":
+                os.chown(*args)
+            elif name == "unmount":
+                self.umount(*args)
+            elif name == "mount":
+                # All the dirs are ready before any mount starts
+                mounts.append(args[0])
+            elif name == "exports":
+                exports=args
+        if mounts:
+            self.bindfs(mounts)
+        # Export the folders after they're mounted, like mount() does
+        if exports is not None:
+            self.write_exports(*exports)
+        return actions
 
     def rename(self, src, dst):
         """Rename folder src to group dst.
@@ -156,34 +403,30 @@ class SharedFolders():
         if dst not in self.system.groups:
             sys.stderr.write("%s is not a valid group.\n" % dst)
             return
-        mounted=self.unmount(src)
+        mounted=self.unmount([src])
         # TODO: check if dst exists etc
         os.rename(src, dst)
         self.system.share_groups=list(
             (set(self.system.share_groups) - set([src])) | set([dst]))
         if mounted is not None:
-            self.mount(dst)
+            self.mount([dst])
         self.save_config()
 
     def parse_mounts(self):
-        """Return a list of all bindfs mounts unset /home/Shared."""
+        """Return a list of all bindfs mounts under /home/Shared.
+        Their uid and gid are only stat'ed when they're accessed."""
         mounts=[]
-        for line in open("/proc/mounts").readlines():
-            items=line.split()
+        share_dir=self.config["SHARE_DIR/"]
+        share_groups=set(self.system.share_groups)
+        for mount in self.mount_table.get():
             # In 12.04: bindfs /home/Shared/a1 fuse.bindfs rw,... 0 0
             # In 18.04: /home/Shared/users /home/Shared/a1 fuse rw,... 0 0
-            if not items[1].startswith(self.config["SHARE_DIR/"]) or \
-              items[2] not in ["fuse", "fuse.bindfs"]:
+            if not mount['point'].startswith(share_dir) or \
+              mount['fstype'] not in ["fuse", "fuse.bindfs"]:
                 continue
-            mount={}
-            mount['point']=items[1]
-            mount['group']=mount['point'].partition(
-                self.config["SHARE_DIR/"])[2]
-            if mount['group'] not in self.system.share_groups:
+            mount['group']=mount['point'][len(share_dir):]
+            if mount['group'] not in share_groups:
                 continue
-            stat=os.stat(mount['point'])
-            mount['uid']=stat.st_uid
-            mount['gid']=stat.st_gid
             mounts.append(mount)
         return mounts
 
@@ -209,25 +452,67 @@ SHARE_GROUPS="%s"
         """Return the folders that were actually unmounted."""
         if groups is None or groups == []:
             groups=self.system.share_groups
+        groups=set(groups)
         ret=[]
         for mount in self.parse_mounts():
             group=mount["group"]
             if group not in groups:
                 continue
             ret.append(group)
-            point=mount["point"]
-            if subprocess.call(["umount", point]) == 0:
-                continue
-            sys.stderr.write("Cannot unmount %s, forcing unmount..." % point)
-            subprocess.call(["umount", "-l", point])
+            self.umount(mount["point"])
         return ret
 
+    def umount(self, point):
+        if executor.executor.run(["umount", point],
+                                 timeout=COMMAND_TIMEOUT).ok:
+            return
+        sys.stderr.write("Cannot unmount %s, forcing unmount..." % point)
+        self.run(["umount", "-l", point])
+
     def valid(self, groups=None):
         """Return which of the specified groups are defined in /etc/group."""
         if groups is None or groups == []:
             groups=self.system.share_groups
         return sorted(list(set(self.system.groups) & set(groups)))
 
+profiling.instrument(SharedFolders, [
+    'add', 'bindfs', 'load_config', 'mount', 'nfs_exports', 'parse_mounts',
+    'plan', 'remove', 'rename', 'sync', 'unmount'])
+
+@functools.lru_cache(maxsize=None)
+def fsid(path):
+    """Return the NFS fsid of a shared folder path.
+    A different fsid per folder is needed for crossmnt to work."""
+    return hashlib.md5(path.encode("utf-8")).hexdigest()
+
+def parse_exports(contents):
+    """Return a {path: (client, options)} dict from an exports file with
+    one client per line, like the one written by SharedFolders."""
+    entries={}
+    for line in contents.splitlines():
+        line=line.strip()
+        if not line or line.startswith("#"):
+            continue
+        fields=line.split()
+        if len(fields) < 2 or not fields[1].endswith(")"):
+            continue
+        client, _, options=fields[1][:-1].partition("(")
+        entries[fields[0]]=(client, options)
+    return entries
+
+def describe(action):
+    """Return a line that describes a SharedFolders.plan() action."""
+    name, args=action[0], list(action[1:])
+    if name in ("mkdir", "ensure_dir"):
+        return "%s %s %04o %s:%s" % (name, args[0], args[1], args[2], args[3])
+    elif name == "chmod":
+        return "chmod %04o %s" % (args[1], args[0])
+    elif name == "chown":
+        return "chown %s:%s %s" % (args[1], args[2], args[0])
+    elif name == "exports":
+        return "exports %s" % args[0]
+    return "%s %s" % (name, args[0])
+
 def usage():
     return """Χρήση: shared-folders [ΕΝΤΟΛΕΣ]
 
@@ -256,10 +541,15 @@ def usage():
         Αποπροσαρτεί και αφαιρεί τη δυνατότητα κοινόχρηστων φακέλων από
         τις καθορισμένες ομάδες. Οι φάκελοι δεν διαγράφονται από το
         σύστημα αρχείων.
+    sync [--dry-run]
+        Συγκρίνει τους κοινόχρηστους φακέλους που πρέπει να υπάρχουν, με
+        βάση τις κοινόχρηστες ομάδες και τα GID τους, με τις προσαρτήσεις,
+        τους καταλόγους και τις εξαγωγές NFS του συστήματος, και εκτελεί
+        μόνο τις απαραίτητες αλλαγές. Με το --dry-run απλώς τις εμφανίζει.
     unmount <ομάδες>
         Αποπροσαρτεί τους κοινόχρηστους φακέλους των καθορισμένων ομάδων.
 
-Σε όλες τις παραπάνω περιπτώσεις εκτός από την add και τη rename, εάν δεν
+Σε όλες τις παραπάνω περιπτώσεις εκτός από τις add, rename και sync, εάν δεν
 καθοριστούν οι <ομάδες>, χρησιμοποιούνται όλες οι κοινόχρηστες ομάδες.
 """
 
@@ -289,6 +579,11 @@ if __name__ == '__main__':
         sf.rename(groups[0], groups[1])
     elif cmd == "remove":
         sf.remove(groups)
+    elif cmd == "sync":
+        if groups not in ([], ["--dry-run"]):
+            sys.stderr.write(usage() + "\n")
+            sys.exit(1)
+        sf.sync(groups == ["--dry-run"])
     elif cmd == "unmount":
         sf.unmount(groups)
     else:
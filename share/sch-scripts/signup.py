@@ -15,7 +15,8 @@ import re
 import socket
 import sys
 
-import iso843
+import bloom
+import usernames
 
 
 class Connection:
@@ -23,34 +24,83 @@ class Connection:
         # Create a new socket and connect to the server
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.sock.connect((host, port))
-
-        # 'Identify' to the server
-        host = socket.gethostname()
-        self._send('ID %s' % host)
+        self.rfile = self.sock.makefile('rb')
 
         self.p_reg = None
         self.u_reg = None
         self.n_reg = None
+        self.groups = None
+        self.roles = None
+        # The Bloom filter of the existing usernames, and the names that the
+        # server was asked about since it was downloaded
+        self.snapshot = None
+        self.snapshot_version = None
+        self.known = {}
+
+        # 'Identify' to the server; newer servers reply with their version
+        host = socket.gethostname()
+        reply = self._send('ID %s' % host).split()
+        try:
+            self.version = int(reply[1])
+        except (IndexError, ValueError):
+            self.version = 1
+        if self.version >= 2:
+            self.hello()
+        if self.version >= 3:
+            self.refresh_snapshot()
 
-    # TODO: Review the recv call, there should be a better way
     # TODO: Show exceptions in a graphical message
     def _send(self, data):
-        if not data.endswith('\r\n'):
-            data += '\r\n'
-        self.sock.send(data.encode())
-        return self.sock.recv(4096).strip().decode()
+        return self._send_many([data])[0]
+
+    def _send_many(self, lines):
+        """Send all the lines at once, then read one reply line for each."""
+        data = ''.join(l if l.endswith('\r\n') else l + '\r\n' for l in lines)
+        self.sock.sendall(data.encode())
+        return [self.rfile.readline().strip().decode() for l in lines]
+
+    def hello(self):
+        """Get the regexes, roles and groups in a single round trip."""
+        fields = dict(f.split('=', 1) for f in self._send("HELLO").split('\t') if '=' in f)
+        self.n_reg = fields.get('realname_regex')
+        self.u_reg = fields.get('user_regex')
+        self.p_reg = fields.get('pass_regex')
+        if 'roles' in fields:
+            self.roles = fields['roles'].split(',') if fields['roles'] else []
+        if 'groups' in fields:
+            self.groups = fields['groups'].split(',') if fields['groups'] else []
+
+    def refresh_snapshot(self):
+        """Download the usernames snapshot, unless the server has the same
+        version as the one we have."""
+        reply = self._send("USERS_SNAPSHOT %s" % (self.snapshot_version or ''))
+        if reply == 'SAME':
+            return
+        fields = dict(f.split('=', 1) for f in reply.split('\t') if '=' in f)
+        try:
+            self.snapshot = bloom.BloomFilter.decode(
+                int(fields['bits']), int(fields['hashes']), fields['filter'])
+            self.snapshot_version = fields['version']
+        except (KeyError, ValueError):
+            self.snapshot = self.snapshot_version = None
+        self.known = {}
 
     def close(self):
         self._send("BYE")
+        self.rfile.close()
         self.sock.close()
 
     def get_groups(self):
+        if self.groups is not None:
+            return self.groups
         groups = self._send("GET_GROUPS")
         if groups != '':
             return groups.split(',')
         return []
 
     def get_roles(self):
+        if self.roles is not None:
+            return self.roles
         roles = self._send("GET_ROLES")
         if roles != '':
             return roles.split(',')
@@ -59,6 +109,26 @@ class Connection:
     def user_exists(self, username):
         return self._send("USER_EXISTS %s" % username) == "YES"
 
+    def users_exist(self, names):
+        """Return a list of True/False, whether each of names exists.
+        The names that aren't in the snapshot are free; the server is asked
+        about the rest in a single round trip, and its answers are cached.
+        """
+        if self.snapshot is None:
+            ask = list(names)
+        else:
+            ask = [u for u in names if u in self.snapshot and u not in self.known]
+        if ask:
+            if self.version >= 2:
+                replies = self._send("USERS_EXIST %s" % ','.join(ask)).split(',')
+            else:
+                # Older servers answer pipelined USER_EXISTS commands in order
+                replies = self._send_many(["USER_EXISTS %s" % u for u in ask])
+            if self.snapshot is None:
+                return [r == "YES" for r in replies]
+            self.known.update(zip(ask, (r == "YES" for r in replies)))
+        return [self.known.get(u, False) for u in names]
+
     def realname_regex(self):
         if self.n_reg is None:
             self.n_reg = self._send("REALNAME_REGEX")
@@ -143,27 +213,8 @@ class UserForm(object):
             return Gtk.STOCK_OK
         return Gtk.STOCK_DIALOG_ERROR
 
-    def to_alpha(self, s):
-        return ''.join(c for c in s if c.isalpha())
-
     def get_suggestions(self, name):
-        tokens = []
-        for tok in name.split():
-            t = self.to_alpha(tok).lower()
-            if t:
-                tokens.append(t)
-        if len(tokens) == 0:
-            return []
-        sug = []
-        _append = lambda x: sug.append(x) if x not in sug else False # FIXME? heh
-        _append(iso843.transcript(tokens[0] + ''.join(tok[0] for tok in tokens[1:]), False))
-        _append(iso843.transcript(''.join(tok[0] for tok in tokens[:-1]) + tokens[-1], False))
-        _append(iso843.transcript(''.join(tok[0] for tok in tokens[1:]) + tokens[0], False))
-        _append(iso843.transcript(tokens[-1] + ''.join(tok[0] for tok in tokens[:-1]), False))
-        _append(iso843.transcript(tokens[-1], False))
-        _append(iso843.transcript(tokens[0], False))
-
-        return sug
+        return usernames.candidates(name)
 
     def on_realname_entry_changed(self, widget):
         name = widget.get_text()
@@ -171,7 +222,8 @@ class UserForm(object):
         self.username_combo.remove_all()
         self.username_entry.set_text('')
         sug = self.get_suggestions(name)
-        sug = [s for s in sug if re.match(self.connection.username_regex(), s, re.UNICODE) and not self.connection.user_exists(s)]
+        sug = [s for s in sug if re.match(self.connection.username_regex(), s, re.UNICODE)]
+        sug = [s for s, exists in zip(sug, self.connection.users_exist(sug)) if not exists]
         if sug:
             self.username_entry.set_text(sug[0])
             for s in sug:
@@ -199,7 +251,7 @@ class UserForm(object):
     def on_username_entry_changed(self, widget):
         username = self.username_entry.get_text()
         valid_name = re.match(self.connection.username_regex(), username, re.UNICODE)
-        free_name = not self.connection.user_exists(username)
+        free_name = not self.connection.users_exist([username])[0]
         icon = self.get_icon(valid_name and free_name)
         self.builder.get_object('username_valid').set_from_stock(icon, Gtk.IconSize.BUTTON)
         self.set_apply_sensitivity()
@@ -219,6 +271,23 @@ class UserForm(object):
     def on_apply_clicked(self, widget):
         realname = self.realname.get_text()
         username = self.username_entry.get_text()
+        # The snapshot may be outdated; confirm the final name with the server
+        if self.connection.user_exists(username):
+            if self.connection.version >= 3:
+                self.connection.refresh_snapshot()
+            self.builder.get_object('username_valid').set_from_stock(
+                self.get_icon(False), Gtk.IconSize.BUTTON)
+            self.set_apply_sensitivity()
+            msg = "Το όνομα χρήστη %s χρησιμοποιείται ήδη." % username
+            dlg = Gtk.MessageDialog(parent = self.dialog,
+                                    type = Gtk.MessageType.ERROR,
+                                    flags = Gtk.DialogFlags.MODAL,
+                                    buttons = Gtk.ButtonsType.CLOSE,
+                                    message_format = msg)
+            dlg.set_title("Σφάλμα")
+            dlg.run()
+            dlg.destroy()
+            return
         password = self.encrypt(self.password.get_text())
         role = self.role_combo.get_active_text() or ''
         groups = [g[1] for g in self.groups_store if g[0]]
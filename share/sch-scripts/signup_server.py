@@ -8,24 +8,70 @@ Signup server and form.
 import gi
 gi.require_version('Gtk', '3.0')
 from gi.repository import Gtk
+import collections
 import os
 import time
 from twisted.internet.protocol import Factory
 from twisted.internet import gtk3reactor
 gtk3reactor.install()
+from twisted.internet import defer
 from twisted.internet import reactor
 from twisted.protocols.basic import LineReceiver
 
+import bloom
 import common
 import config
 import dialogs
+import profiling
 import user_form
 
+# Sent in the reply to ID; older clients ignore it. Clients may use HELLO
+# and USERS_EXIST from version 2, and USERS_SNAPSHOT from version 3.
+PROTOCOL_VERSION = 3
+# The limits that protect the server from misbehaving or flooding clients.
+# Only the expensive commands, SEND_DATA and USERS_SNAPSHOT, are limited:
+# each connection may send REQUEST_BURST of them at once, then REQUEST_RATE
+# per second, and is answered ERROR above that. The cheap lookups aren't,
+# as protocol 1 clients send a few USER_EXISTS per keystroke.
+MAX_LINE_LENGTH = 4096
+REQUEST_RATE = 2
+REQUEST_BURST = 10
+LIMITED_COMMANDS = ('SEND_DATA', 'USERS_SNAPSHOT')
+# Stop reading from the clients while that many requests wait for the GUI,
+# until they drop to QUEUE_LOW
+QUEUE_HIGH = 500
+QUEUE_LOW = 100
+
+
+class RateLimit:
+    """A token bucket that allows burst events at once, then rate per
+    second."""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.monotonic()
+
+    def allow(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
 class Registrations(LineReceiver):
-    def __init__(self, connections, requests, gui, system, groups, roles):
+    MAX_LENGTH = MAX_LINE_LENGTH
+
+    def __init__(self, connections, requests, queue, snapshot, system, groups, roles):
         self.connections = connections
         self.requests = requests
-        self.gui = gui
+        self.queue = queue
+        self.snapshot = snapshot
         self.system = system
         self.groups = groups
         self.roles = roles
@@ -33,11 +79,14 @@ class Registrations(LineReceiver):
         self.ip = None
         self.port = None
         self.id_hostname = None
+        self.limit = RateLimit(REQUEST_RATE, REQUEST_BURST)
 
     def connectionMade(self):
         self.ip = self.transport.getPeer().host
         self.port = self.transport.getPeer().port
         self.connections.append(self)
+        if self.queue.paused:
+            self.pauseProducing()
         print("New connection from %s:%s" % (self.ip, self.port))
 
     def connectionLost(self, reason):
@@ -50,15 +99,25 @@ class Registrations(LineReceiver):
             return b'YES'
         return b'NO'
 
+    def lineLengthExceeded(self, line):
+        print("Error: Too long line from %s:%s. Closing connection" % (self.ip, self.port))
+        self.transport.loseConnection()
+
     def lineReceived(self, line):
         # print(line)  # DEBUGGING
         line = line.decode('utf-8')
         cmd = line.split(None, 1)
         if len(cmd) > 1:
             cmd, data = cmd
-        else:
+        elif cmd:
             cmd = cmd[0]
             data = None
+        else:
+            cmd = data = None
+        if cmd in LIMITED_COMMANDS and not self.limit.allow():
+            print("Error: Too many %s commands from %s:%s" % (cmd, self.ip, self.port))
+            self.sendLine(b'ERROR')
+            return
 
         if self.state == 'identify':
             if cmd == 'ID':
@@ -71,8 +130,19 @@ class Registrations(LineReceiver):
         if line == 'BYE':
             print("%s:%s sent BYE." % (self.ip, self.port))
             self.transport.loseConnection()
+        elif cmd == "HELLO":
+            self.sendLine(self.hello().encode())
         elif cmd == "USER_EXISTS":
             self.sendLine(self.booltr(data in self.system.users))
+        elif cmd == "USERS_EXIST":
+            names = data.split(',') if data else []
+            self.sendLine(b','.join(self.booltr(n in self.system.users) for n in names))
+        elif cmd == "USERS_SNAPSHOT":
+            # data is the version that the client already has, if any
+            if data == str(self.snapshot.version):
+                self.sendLine(b'SAME')
+            else:
+                self.sendLine(self.snapshot.get().encode())
         elif cmd == "REALNAME_REGEX":
             self.sendLine(b'.+')
         elif cmd == "USER_REGEX":
@@ -101,7 +171,7 @@ class Registrations(LineReceiver):
                 user = libuser.User(username, rname=realname, password=password, groups=groups)
                 #print user # DEBUGGING
                 req = Request(time.localtime(), applicant, user, role)
-                self.gui.add_request(req)
+                self.queue.put(req)
 
                 self.requests.append(req)
                 self.sendLine(b'YES')
@@ -111,24 +181,104 @@ class Registrations(LineReceiver):
                 print("Error receiving data.")
         else:
             print("Received invalid command %s from %s:%s" % (cmd, self.ip, self.port))
+            # Reply anyway, so that clients that pipeline commands stay in sync
+            self.sendLine(b'ERROR')
+
+    def hello(self):
+        """Return everything that the form needs, in a single line of
+        tab separated key=value fields."""
+        fields = [('version', str(PROTOCOL_VERSION)),
+                  ('realname_regex', '.+'),
+                  ('user_regex', libuser.NAME_REGEX),
+                  ('pass_regex', '.+'),
+                  ('roles', ','.join(self.roles)),
+                  ('groups', ','.join(self.groups))]
+        return '\t'.join('%s=%s' % field for field in fields)
 
     def identify(self, line):
         self.id_hostname = line
         self.state = 'listen'
-        self.sendLine(b'YES')
+        self.sendLine(('YES %d' % PROTOCOL_VERSION).encode())
+
+
+class RequestQueue:
+    """Buffers the received requests and hands them to the GUI in batches,
+    one batch per main loop iteration, so that many clients submitting at
+    once don't stall the window. While QUEUE_HIGH requests are waiting, the
+    clients aren't read at all."""
+    # The requests that are added to the GUI in one main loop iteration
+    BATCH = 100
+
+    def __init__(self, gui, connections):
+        self.gui = gui
+        self.connections = connections
+        self.pending = collections.deque()
+        self.paused = False
+        self.call = None
+
+    def put(self, request):
+        self.pending.append(request)
+        if not self.paused and len(self.pending) >= QUEUE_HIGH:
+            self.paused = True
+            for conn in self.connections:
+                conn.pauseProducing()
+        if self.call is None:
+            self.call = reactor.callLater(0, self.flush)
+
+    def flush(self):
+        self.call = None
+        batch = [self.pending.popleft()
+                 for i in range(min(self.BATCH, len(self.pending)))]
+        self.gui.add_requests(batch)
+        if self.paused and len(self.pending) <= QUEUE_LOW:
+            self.paused = False
+            for conn in self.connections:
+                conn.resumeProducing()
+        if self.pending:
+            self.call = reactor.callLater(0, self.flush)
+
+
+class UsernameSnapshot:
+    """A Bloom filter of the existing usernames, for the clients to check
+    most suggestions locally. It's rebuilt lazily when users are added or
+    removed, and then its version changes, so that the clients only
+    download it again when it's different."""
+
+    def __init__(self, system):
+        self.system = system
+        self.version = 1
+        self.reply = None
+        system.connect_event(self.on_libuser_changed)
+
+    def on_libuser_changed(self, changes):
+        if changes.added_users or changes.removed_users:
+            self.version += 1
+            self.reply = None
+
+    def get(self):
+        """Return the USERS_SNAPSHOT reply, in the HELLO format."""
+        if self.reply is None:
+            names = bloom.BloomFilter.for_items(self.system.users)
+            fields = [('version', str(self.version)),
+                      ('bits', str(names.bits)),
+                      ('hashes', str(names.hashes)),
+                      ('filter', names.encode())]
+            self.reply = '\t'.join('%s=%s' % field for field in fields)
+        return self.reply
 
 
 class RegistrationsFactory(Factory):
     def __init__(self, gui, system, groups, roles):
         self.connections = []
         self.requests = []
-        self.gui = gui
+        self.queue = RequestQueue(gui, self.connections)
+        self.snapshot = UsernameSnapshot(system)
         self.system = system
         self.groups = groups
         self.roles = roles
 
     def buildProtocol(self, addr):
-        return Registrations(self.connections, self.requests, self.gui, self.system, self.groups, self.roles)
+        return Registrations(self.connections, self.requests, self.queue, self.snapshot, self.system, self.groups, self.roles)
 
 
 class Applicant(object):
@@ -152,6 +302,37 @@ class Request(object):
         self.status = status
 
 
+class IdReservations:
+    """The UIDs and GIDs of the pending requests, indexed, so that a new
+    request gets free IDs without going through all the other requests."""
+
+    def __init__(self):
+        self.uids = libuser.Index()
+        self.gids = libuser.Index()
+        self.keys = {}
+
+    def reserve(self, user):
+        """Give free IDs to user, if it has none, and reserve them."""
+        if user.uid in [None, '']:
+            user.uid = libuser.system.get_free_uid(exclude=self.uids)
+        if user.gid in [None, '']:
+            user.gid = libuser.system.get_free_gid(exclude=self.gids)
+        self.update(user)
+
+    def update(self, user):
+        """Reserve the IDs of user again, after they were edited."""
+        self.release(user)
+        self.keys[user] = (user.uid, user.gid)
+        self.uids.add(user.uid, user)
+        self.gids.add(user.gid, user)
+
+    def release(self, user):
+        keys = self.keys.pop(user, None)
+        if keys is not None:
+            self.uids.discard(keys[0], user)
+            self.gids.discard(keys[1], user)
+
+
 class UI:
     def __init__(self, system):
         self.system = system
@@ -163,6 +344,7 @@ class UI:
         self.reject_tb = self.builder.get_object('reject_tb')
         self.review_tb = self.builder.get_object('review_tb')
         self.selection = self.builder.get_object('treeview-selection')
+        self.reservations = IdReservations()
         self.roles = {i : config.parser.get('Roles', i).replace('$$teachers', self.system.teachers) for i in config.parser.options('Roles')}
         self.window.show()
 
@@ -172,12 +354,7 @@ class UI:
     def user_autocomplete(self, user):
         if user.directory in [None, '']:
             user.directory = os.path.join(libuser.HOME_PREFIX, user.name)
-        if user.uid in [None, '']:
-            set_uids = [r[0].user.uid for r in self.requests_list]
-            user.uid = libuser.system.get_free_uid(exclude=set_uids)
-        if user.gid in [None, '']:
-            set_gids = [r[0].user.gid for r in self.requests_list]
-            user.gid = libuser.system.get_free_gid(exclude=set_gids)
+        self.reservations.reserve(user)
         if user.primary_group in [None, '']:
             user.primary_group = user.name
         if user.shell in [None, '']:
@@ -198,26 +375,33 @@ class UI:
             user.password = '!'
 
     def add_request(self, request):
-        #object time applicant realname username role groups
-        self.requests_list.append([request, self.strtime(request.time),
-                                   str(request.applicant), request.user.rname,
-                                   request.user.name, str(request.role),
-                                   ','.join(request.user.groups)])
-        self.user_autocomplete(request.user)
-        # Add the role groups to user.groups but don't show them in the treeview
-        if request.role in self.roles:
-            groups = self.roles[request.role].split(',')
-        else:
-            groups = []
-        for gr in groups:
-            if gr and gr not in request.user.groups and gr in libuser.system.groups:
-                request.user.groups.append(gr)
-        self.builder.get_object('apply_button').set_sensitive(True)
+        self.add_requests([request])
+
+    @profiling.timed('signup.add_requests')
+    def add_requests(self, requests):
+        for request in requests:
+            #object time applicant realname username role groups
+            self.requests_list.append([request, self.strtime(request.time),
+                                       str(request.applicant), request.user.rname,
+                                       request.user.name, str(request.role),
+                                       ','.join(request.user.groups)])
+            self.user_autocomplete(request.user)
+            # Add the role groups to user.groups but don't show them in the treeview
+            if request.role in self.roles:
+                groups = self.roles[request.role].split(',')
+            else:
+                groups = []
+            for gr in groups:
+                if gr and gr not in request.user.groups and gr in libuser.system.groups:
+                    request.user.groups.append(gr)
+        if requests:
+            self.builder.get_object('apply_button').set_sensitive(True)
 
     def update_row(self, row, role=None):
         request = row[0]
         if role is not None:
             request.role = role
+        self.reservations.update(request.user)
         data = [request, self.strtime(request.time),
                 str(request.applicant), request.user.rname,
                 request.user.name, str(request.role)]
@@ -254,6 +438,7 @@ class UI:
         r = dialogs.AskDialog(msg, "Διαγραφή αιτημάτων").showup()
         if r == Gtk.ResponseType.YES:
             for row in selected:
+                self.reservations.release(row[0].user)
                 self.requests_list.remove(row.iter)
             if len(self.requests_list) == 0:
                 self.builder.get_object('apply_button').set_sensitive(False)
@@ -270,17 +455,33 @@ class UI:
         usernames = ', '.join([u.name for u in users])
         r=dialogs.AskDialog("Θα δημιουργηθούν οι παρακάτω χρήστες:\n%s\n\nΣυνέχεια;" % usernames, "Δημιουργία χρηστών").showup()
         if r == Gtk.ResponseType.YES:
+            # Create the users one after the other without blocking the
+            # reactor, which also serves the signup clients
+            self.builder.get_object('apply_button').set_sensitive(False)
+            d = defer.succeed(None)
             for user in users:
-                if user.primary_group not in self.system.groups:
-                    self.system.add_group(libuser.Group(user.primary_group, user.gid, {}))
-                self.system.add_user(user)
-                libuser.system.reload()
-                # FIXME: sch-scripts trees won't update
-                for counter, row in enumerate(self.requests_list):
-                    if row[0].user.name == user.name:
-                        self.requests_list.remove(self.requests_list.get_iter(counter))
-            if len(self.requests_list) == 0:
-                self.builder.get_object('apply_button').set_sensitive(False)
+                d.addCallback(self.add_user, user)
+            d.addBoth(self.on_users_added)
+
+    def add_user(self, ignored, user):
+        if user.primary_group not in self.system.groups:
+            self.system.add_group(libuser.Group(user.primary_group, user.gid, {}))
+        return self.system.add_user_async(user).addCallback(
+            self.on_user_added, user)
+
+    def on_user_added(self, result, user):
+        libuser.system.reload()
+        # FIXME: sch-scripts trees won't update
+        for counter, row in enumerate(self.requests_list):
+            if row[0].user.name == user.name:
+                self.reservations.release(row[0].user)
+                self.requests_list.remove(self.requests_list.get_iter(counter))
+                break
+
+    def on_users_added(self, result):
+        self.builder.get_object('apply_button').set_sensitive(
+            len(self.requests_list) > 0)
+        return result
 
     def on_close_button_clicked(self, widget):
         if len(self.requests_list):
@@ -0,0 +1,252 @@
+# This file is part of sch-scripts, https://sch-scripts.gitlab.io
+# Copyright 2009-2022 the sch-scripts team, see AUTHORS
+# SPDX-License-Identifier: GPL-3.0-or-later
+"""
+Snapshots of the users and groups, and the differences between them.
+"""
+import gzip
+import hashlib
+import json
+import os
+import time
+
+FORMAT = 'sch-scripts-snapshot'
+VERSION = 1
+# The fields of the user records; the memberships are kept in the groups
+USER_FIELDS = ['name', 'uid', 'gid', 'primary_group', 'rname', 'office',
+               'wphone', 'hphone', 'other', 'directory', 'shell', 'lstchg',
+               'min', 'max', 'warn', 'inact', 'expire', 'password']
+GROUP_FIELDS = ['name', 'gid', 'password']
+# The names of the fields in the diff report
+FIELD_NAMES = {
+    'name': "όνομα", 'uid': "UID", 'gid': "GID",
+    'primary_group': "κύρια ομάδα", 'rname': "ονοματεπώνυμο",
+    'office': "γραφείο", 'wphone': "τηλ. γραφείου", 'hphone': "τηλ. οικίας",
+    'other': "άλλο", 'directory': "κατάλογος", 'shell': "κέλυφος",
+    'lstchg': "τελευταία αλλαγή κωδικού", 'min': "ελάχιστη διάρκεια",
+    'max': "μέγιστη διάρκεια", 'warn': "προειδοποίηση",
+    'inact': "ανενεργός", 'expire': "λήξη", 'password': "κωδικός"}
+
+
+def digest(text):
+    return hashlib.blake2b(text.encode('utf-8'), digest_size=8).hexdigest()
+
+
+def _record(obj, fields):
+    values = [getattr(obj, field) for field in fields]
+    # Only a digest of the password hash is kept, so that snapshots can be
+    # compared without exposing the hashes
+    if values[-1]:
+        values[-1] = digest(values[-1])
+    return values
+
+
+def _hash(values):
+    return digest(json.dumps(values, ensure_ascii=False))
+
+
+def user_record(user):
+    """Return the values of USER_FIELDS for user and their hash."""
+    values = _record(user, USER_FIELDS)
+    return _hash(values), values
+
+
+class Snapshot:
+    """The records of the users and groups of a libuser.Set, keyed by name.
+
+    users is {name: (hash, values)}, with the values in USER_FIELDS order.
+    groups is {name: (hash, values, members hash, members)}, with the
+    values in GROUP_FIELDS order and the member names sorted.
+    """
+
+    def __init__(self, users=None, groups=None, created=None):
+        self.users = users if users is not None else {}
+        self.groups = groups if groups is not None else {}
+        self.created = created if created is not None else time.time()
+
+    @classmethod
+    def from_set(cls, set_):
+        """Return the snapshot of a libuser.Set, e.g. libuser.system or the
+        result of parsers.CSV.parse or parsers.passwd.parse."""
+        snapshot = cls()
+        for name, user in set_.users.items():
+            snapshot.users[name] = user_record(user)
+        for name, group in set_.groups.items():
+            values = _record(group, GROUP_FIELDS)
+            members = sorted(group.members)
+            snapshot.groups[name] = (_hash(values), values,
+                                     _hash(members), members)
+        return snapshot
+
+    def save(self, path):
+        """Write the snapshot as gzipped JSON lines, readable only by the
+        owner: a header, then a line per user and per group."""
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with gzip.open(os.fdopen(fd, 'wb'), 'wt', compresslevel=6,
+                       encoding='utf-8') as f:
+            header = {'format': FORMAT, 'version': VERSION,
+                      'created': round(self.created, 3),
+                      'users': USER_FIELDS, 'groups': GROUP_FIELDS}
+            f.write(json.dumps(header, ensure_ascii=False) + '\n')
+            for h, values in self.users.values():
+                f.write(json.dumps(['u', h, values], ensure_ascii=False)
+                        + '\n')
+            for h, values, mh, members in self.groups.values():
+                f.write(json.dumps(['g', h, values, mh, members],
+                                   ensure_ascii=False) + '\n')
+
+    @classmethod
+    def load(cls, path):
+        """Read a snapshot that save() wrote; raise ValueError if path
+        isn't one."""
+        try:
+            with gzip.open(path, 'rt', encoding='utf-8') as f:
+                header = json.loads(f.readline() or '{}')
+                if header.get('format') != FORMAT \
+                        or header.get('version') != VERSION \
+                        or header.get('users') != USER_FIELDS \
+                        or header.get('groups') != GROUP_FIELDS:
+                    raise ValueError("%s: Δεν είναι στιγμιότυπο λογαριασμών"
+                                     % path)
+                snapshot = cls(created=header['created'])
+                for line in f:
+                    row = json.loads(line)
+                    if row[0] == 'u':
+                        snapshot.users[row[2][0]] = (row[1], row[2])
+                    else:
+                        snapshot.groups[row[2][0]] = tuple(row[1:])
+        except (OSError, EOFError, IndexError, KeyError) as e:
+            raise ValueError("%s: %s" % (path, e))
+        return snapshot
+
+
+class Diff:
+    """The differences from the old to the new Snapshot.
+
+    Only the records with different hashes are compared field by field,
+    so the diff takes linear time in the number of records.
+    modified_users and modified_groups are {name: {field: (old, new)}};
+    added_members and removed_members are lists of (group, user).
+    """
+
+    def __init__(self, old, new):
+        self.added_users, self.removed_users, self.modified_users = \
+            self._compare(old.users, new.users, USER_FIELDS)
+        self.added_groups, self.removed_groups, self.modified_groups = \
+            self._compare(old.groups, new.groups, GROUP_FIELDS)
+        self.added_members, self.removed_members = [], []
+        empty = (None, None, None, [])
+        for name, record in new.groups.items():
+            old_record = old.groups.get(name, empty)
+            if record[2] != old_record[2]:
+                old_members = set(old_record[3])
+                new_members = set(record[3])
+                self.added_members.extend(
+                    (name, m) for m in record[3] if m not in old_members)
+                self.removed_members.extend(
+                    (name, m) for m in old_record[3] if m not in new_members)
+        for name, record in old.groups.items():
+            if name not in new.groups:
+                self.removed_members.extend((name, m) for m in record[3])
+
+    @staticmethod
+    def _compare(old, new, fields):
+        added = [name for name in new if name not in old]
+        removed = [name for name in old if name not in new]
+        modified = {}
+        for name, record in new.items():
+            old_record = old.get(name)
+            if old_record is None or old_record[0] == record[0]:
+                continue
+            modified[name] = {
+                field: (a, b) for field, a, b
+                in zip(fields, old_record[1], record[1]) if a != b}
+        return added, removed, modified
+
+    def __bool__(self):
+        return any([self.added_users, self.removed_users,
+                    self.modified_users, self.added_groups,
+                    self.removed_groups, self.modified_groups,
+                    self.added_members, self.removed_members])
+
+    def summary(self):
+        return ("Χρήστες: %d νέοι, %d διαγραμμένοι, %d αλλαγμένοι. "
+                "Ομάδες: %d νέες, %d διαγραμμένες, %d αλλαγμένες. "
+                "Μέλη: %d προσθήκες, %d αφαιρέσεις." % (
+                    len(self.added_users), len(self.removed_users),
+                    len(self.modified_users), len(self.added_groups),
+                    len(self.removed_groups), len(self.modified_groups),
+                    len(self.added_members), len(self.removed_members)))
+
+    def report(self):
+        """Return a message for each change."""
+        lines = []
+        lines.extend("+ Χρήστης %s" % n for n in sorted(self.added_users))
+        lines.extend("- Χρήστης %s" % n for n in sorted(self.removed_users))
+        lines.extend("~ Χρήστης %s: %s" % (n, self._changes(c))
+                     for n, c in sorted(self.modified_users.items()))
+        lines.extend("+ Ομάδα %s" % n for n in sorted(self.added_groups))
+        lines.extend("- Ομάδα %s" % n for n in sorted(self.removed_groups))
+        lines.extend("~ Ομάδα %s: %s" % (n, self._changes(c))
+                     for n, c in sorted(self.modified_groups.items()))
+        lines.extend("+ Μέλος %s της ομάδας %s" % (m, g)
+                     for g, m in sorted(self.added_members))
+        lines.extend("- Μέλος %s της ομάδας %s" % (m, g)
+                     for g, m in sorted(self.removed_members))
+        return lines
+
+    @staticmethod
+    def _changes(changes):
+        parts = []
+        for field, (a, b) in changes.items():
+            if field == 'password':
+                parts.append(FIELD_NAMES[field])
+            else:
+                parts.append("%s %s → %s" % (FIELD_NAMES[field], a, b))
+        return ', '.join(parts)
+
+
+if __name__ == '__main__':
+    # Benchmark: snapshot, save, load and diff 50000 users in 100 classes,
+    # with 1% of them changed
+    import tempfile
+    import libuser
+
+    def accounts(count, changed=()):
+        set_ = libuser.Set()
+        classes = [libuser.Group('class%d' % c, 2000 + c) for c in range(100)]
+        for i in range(count):
+            user = libuser.User(
+                name='user%d' % i, uid=10000 + i, gid=10000 + i,
+                rname='User %d' % i, directory='/home/user%d' % i,
+                password='$6$salt$%d' % i, lstchg=19000)
+            if i in changed:
+                user.shell = '/bin/sh'
+            set_.users[user.name] = user
+            user.primary_group = user.name
+            set_.groups[user.name] = libuser.Group(user.name, 10000 + i)
+            if i not in changed:
+                classes[i % 100].members[user.name] = user
+        for group in classes:
+            set_.groups[group.name] = group
+        return set_
+
+    count = 50000
+    old = accounts(count)
+    new = accounts(count, range(0, count, 100))
+    start = time.time()
+    old_snapshot, new_snapshot = Snapshot.from_set(old), Snapshot.from_set(new)
+    print("2 snapshots of %d users in %.3fs" % (count, time.time() - start))
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'snapshot.gz')
+        start = time.time()
+        old_snapshot.save(path)
+        old_snapshot = Snapshot.load(path)
+        print("Saved and loaded in %.3fs, %d KB" % (
+            time.time() - start, os.path.getsize(path) // 1024))
+    start = time.time()
+    diff = Diff(old_snapshot, new_snapshot)
+    print("Diff in %.3fs" % (time.time() - start))
+    print(diff.summary())
+    for line in diff.report()[:3]:
+        print(line)
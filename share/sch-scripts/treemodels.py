@@ -0,0 +1,119 @@
+# This file is part of sch-scripts, https://sch-scripts.gitlab.io
+# Copyright 2009-2022 the sch-scripts team, see AUTHORS
+# SPDX-License-Identifier: GPL-3.0-or-later
+"""
+Keep the rows of Gtk.ListStores in sync with libuser objects.
+"""
+import gi
+gi.require_version('Gtk', '3.0')
+from gi.repository import GLib
+
+import profiling
+
+
+class ObjectRows:
+    """The rows of a Gtk.ListStore whose first column is an object.
+
+    Instead of clearing and refilling the store on every change, the
+    changed objects are queued and their rows are appended, updated or
+    removed from idle callbacks, a few at a time, so that the window stays
+    responsive and the selection is preserved.
+    """
+    # The rows that are updated in one idle callback
+    CHUNK = 200
+
+    def __init__(self, store, row_func, exists):
+        """row_func(obj) returns the values of all the columns of obj.
+        exists(obj) returns True if obj should still be in the store."""
+        self.store = store
+        self.row_func = row_func
+        self.exists = exists
+        self.columns = list(range(store.get_n_columns()))
+        self.iters = {}
+        # A dict instead of a set, to apply the changes in order
+        self.pending = {}
+        self.idle_id = None
+
+    def fill(self, objs):
+        """Append the rows of objs right away."""
+        for obj in objs:
+            self.iters[obj] = self.store.append(self.row_func(obj))
+
+    def queue(self, objs):
+        """Update the rows of objs, which were added, changed or removed,
+        in idle time."""
+        for obj in objs:
+            self.pending[obj] = None
+        if self.pending and self.idle_id is None:
+            self.idle_id = GLib.idle_add(self.on_idle)
+
+    def sync(self, objs):
+        """Queue all the rows, to make the store match objs."""
+        self.queue(list(self.iters))
+        self.queue(objs)
+
+    def flush(self):
+        """Apply all the queued changes now."""
+        if self.idle_id is not None:
+            GLib.source_remove(self.idle_id)
+            self.idle_id = None
+        self.apply(len(self.pending))
+
+    @profiling.timed('gui.apply_rows')
+    def apply(self, limit):
+        while self.pending and limit > 0:
+            obj = next(iter(self.pending))
+            del self.pending[obj]
+            limit -= 1
+            iter_ = self.iters.get(obj)
+            if not self.exists(obj):
+                if iter_ is not None:
+                    self.store.remove(iter_)
+                    del self.iters[obj]
+            elif iter_ is None:
+                self.iters[obj] = self.store.append(self.row_func(obj))
+            else:
+                self.store.set(iter_, self.columns, self.row_func(obj))
+
+    def on_idle(self):
+        self.apply(self.CHUNK)
+        if self.pending:
+            return True
+        self.idle_id = None
+        return False
+
+
+if __name__ == '__main__':
+    # Benchmark: the time to apply changes to 1% of the rows of a sorted,
+    # filtered store, compared to clearing and refilling it
+    import time
+    from gi.repository import Gtk
+
+    class Obj:
+        def __init__(self, n):
+            self.n = n
+            self.name = 'user%d' % n
+
+    for size in [1000, 10000, 50000]:
+        objs = [Obj(n) for n in range(size)]
+        store = Gtk.ListStore(object, int, str)
+        sort = Gtk.TreeModelSort(model=store.filter_new())
+        sort.set_sort_column_id(2, Gtk.SortType.ASCENDING)
+        rows = ObjectRows(store, lambda o: [o, o.n, o.name], lambda o: True)
+        rows.fill(objs)
+
+        start = time.time()
+        store.clear()
+        rows.iters = {}
+        rows.fill(objs)
+        refill = time.time() - start
+
+        changed = objs[::100]
+        for obj in changed:
+            obj.name += 'x'
+        start = time.time()
+        rows.queue(changed)
+        rows.flush()
+        diff = time.time() - start
+        print("%6d rows: refill %.3fs, %d changed rows %.4fs"
+              % (size, refill, len(changed), diff))
@@ -351,8 +351,18 @@ class NewUserDialog(UserForm):
         if self.system.gid_is_free(user.gid):
             self.system.add_group(libuser.Group(user.primary_group, user.gid, {}))
 
-        self.system.add_user(user)
-        if self.builder.get_object('locked_account_check').get_active():
+        # useradd copies /etc/skel, so it runs without blocking the GUI
+        locked = self.builder.get_object('locked_account_check').get_active()
+        self.dialog.set_sensitive(False)
+        d = self.system.add_user_async(user)
+        d.addCallback(self.on_user_added, user, locked)
+
+    def on_user_added(self, result, user, locked):
+        if not result.ok:
+            dialogs.ErrorDialog("Αποτυχία δημιουργίας του χρήστη %s:\n%s"
+                                % (user.name, result.stderr.strip()),
+                                "Σφάλμα").showup()
+        elif locked:
             self.system.lock_user(user)
         self.dialog.destroy()
 
@@ -0,0 +1,173 @@
+# This file is part of sch-scripts, https://sch-scripts.gitlab.io
+# Copyright 2009-2022 the sch-scripts team, see AUTHORS
+# SPDX-License-Identifier: GPL-3.0-or-later
+"""
+Generate unique, valid usernames for many users at once.
+"""
+import re
+
+import iso843
+
+# The maximum username length of useradd
+MAX_LENGTH = 32
+# The username when nothing usable is left of a real name
+FALLBACK = 'user'
+
+EXACT = 'exact'
+ALTERNATIVE = 'alternative'
+SUFFIX = 'suffix'
+
+
+def normalize(text):
+    """Return text transcripted, lowercase and without the characters that
+    aren't allowed in usernames, or '' if nothing is left."""
+    name = iso843.transcript(text, False).lower()
+    name = re.sub('[^-a-z0-9_]', '', name)
+    name = re.sub('^[^a-z]+', '', name)
+    return name[:MAX_LENGTH]
+
+
+def to_alpha(s):
+    return ''.join(c for c in s if c.isalpha())
+
+
+def candidates(realname):
+    """Return the usernames for realname, in order of preference:
+    first name and initials, initials and last name, and so on."""
+    tokens = []
+    for tok in realname.split():
+        t = to_alpha(tok).lower()
+        if t:
+            tokens.append(t)
+    if len(tokens) == 0:
+        return []
+    sug = []
+    for s in [tokens[0] + ''.join(tok[0] for tok in tokens[1:]),
+              ''.join(tok[0] for tok in tokens[:-1]) + tokens[-1],
+              ''.join(tok[0] for tok in tokens[1:]) + tokens[0],
+              tokens[-1] + ''.join(tok[0] for tok in tokens[:-1]),
+              tokens[-1],
+              tokens[0]]:
+        s = normalize(s)
+        if s and s not in sug:
+            sug.append(s)
+    return sug
+
+
+def expand(template, classn, compn):
+    """Replace {c}, {i} and {0i} in template, like in NewUsersDialog."""
+    return template.replace('{c}', classn.strip()).replace(
+        '{i}', str(compn)).replace('{0i}', '%02d' % compn)
+
+
+class Choice:
+    """The username that was chosen for source, a real name or a template,
+    and how: EXACT if it's the preferred one, ALTERNATIVE if it's another
+    candidate, or SUFFIX if a number was appended to the preferred one."""
+
+    def __init__(self, source, wanted, name, strategy):
+        self.source = source
+        self.wanted = wanted
+        self.name = name
+        self.strategy = strategy
+
+    def __str__(self):
+        if self.strategy == EXACT:
+            return "'%s': %s" % (self.source, self.name)
+        return "'%s': %s αντί για %s" % (self.source, self.name, self.wanted)
+
+
+class Generator:
+    """Chooses usernames that aren't in taken, or chosen before, in a
+    single pass. The choices are deterministic: the first free candidate,
+    or else the first candidate with the smallest free number appended,
+    starting from 2.
+
+    taken can be any container of names, e.g. system.users.
+    """
+
+    def __init__(self, taken=(), regex=None):
+        if regex is None:
+            # Imported here as the signup client doesn't have a libuser
+            import libuser
+            regex = libuser.NAME_REGEX
+        self.taken = taken
+        self.regex = re.compile(regex)
+        self.used = set()
+        # The next number to try for each suffixed name
+        self.suffixes = {}
+        self.choices = []
+
+    def is_free(self, name):
+        return (name not in self.used and name not in self.taken
+                and len(name) <= MAX_LENGTH
+                and self.regex.match(name) is not None)
+
+    def choose(self, wanted, source=None):
+        """Choose one of the wanted usernames, in order of preference, or
+        the first one suffixed; return the Choice."""
+        wanted = [w for w in wanted if w] or [FALLBACK]
+        for i, name in enumerate(wanted):
+            if self.is_free(name):
+                return self._chosen(source, wanted[0], name,
+                                    EXACT if i == 0 else ALTERNATIVE)
+        base = wanted[0]
+        if self.regex.match(base) is None:
+            # No number would make it valid, e.g. it starts with a digit
+            base = FALLBACK
+        n = self.suffixes.get(base, 2)
+        while True:
+            suffix = str(n)
+            name = base[:MAX_LENGTH - len(suffix)] + suffix
+            n += 1
+            if self.is_free(name):
+                break
+        self.suffixes[base] = n
+        return self._chosen(source, wanted[0], name, SUFFIX)
+
+    def _chosen(self, source, wanted, name, strategy):
+        self.used.add(name)
+        choice = Choice(source if source is not None else wanted, wanted,
+                        name, strategy)
+        self.choices.append(choice)
+        return choice
+
+    def from_realnames(self, realnames):
+        """Return the Choices for a list of real names."""
+        return [self.choose(candidates(r), r) for r in realnames]
+
+    def from_template(self, template, classes, computers):
+        """Return the Choices for the template usernames of each class and
+        computer, in the order of NewUsersDialog."""
+        return [self.choose([expand(template, classn, compn)])
+                for classn in classes for compn in range(1, computers+1)]
+
+    def report(self):
+        """Return a message for each username that wasn't the preferred."""
+        return ["Ο χρήστης %s" % c for c in self.choices
+                if c.strategy != EXACT]
+
+
+if __name__ == '__main__':
+    # Benchmark: usernames for a roster of 2000 pupils with many common
+    # names, against 2000 existing users
+    import random
+    import time
+
+    first = ['Γιώργος', 'Μαρία', 'Νίκος', 'Ελένη', 'Γιάννης', 'Κατερίνα',
+             'Δημήτρης', 'Σοφία', 'Κώστας', 'Ευαγγελία']
+    last = ['Παπαδόπουλος', 'Νικολάου', 'Γεωργίου', 'Ιωάννου', 'Οικονόμου',
+            'Μπουρνάζος', 'Αυγερινός', 'Χατζής']
+    random.seed(0)
+    roster = ['%s %s' % (random.choice(first), random.choice(last))
+              for i in range(2000)]
+    taken = set('user%d' % i for i in range(2000))
+    start = time.time()
+    generator = Generator(taken, '^[a-z][-a-z0-9_]*$')
+    choices = generator.from_realnames(roster)
+    duration = time.time() - start
+    assert len(set(c.name for c in choices)) == len(roster)
+    print("%d usernames in %.3fs, %d not the preferred one"
+          % (len(choices), duration, len(generator.report())))
+    for line in generator.report()[:5]:
+        print(line)
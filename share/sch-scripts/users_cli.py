@@ -0,0 +1,488 @@
+#!/usr/bin/env python3
+# This file is part of sch-scripts, https://sch-scripts.gitlab.io
+# Copyright 2009-2022 the sch-scripts team, see AUTHORS
+# SPDX-License-Identifier: GPL-3.0-or-later
+"""
+Bulk account operations from the command line, without Gtk.
+"""
+import os
+import shutil
+import sys
+
+# The exit codes
+EXIT_OK = 0
+EXIT_USAGE = 1
+EXIT_FAILED = 2
+EXIT_CONFLICTS = 3
+EXIT_PERMISSION = 4
+
+# Print a progress line every that many items
+PROGRESS_STEP = 100
+
+PROBLEMS = {
+    'char': "μη έγκυροι χαρακτήρες",
+    'dup': "διπλότυπο",
+    'con': "υπάρχει ήδη στο σύστημα",
+    'hijack': "ο κατάλογος ανήκει σε άλλον χρήστη",
+}
+
+
+def usage():
+    return """Χρήση: sch-scripts users <ΕΝΤΟΛΗ> [ΕΠΙΛΟΓΕΣ]
+
+Μαζικές λειτουργίες σε λογαριασμούς χρηστών, χωρίς γραφικό περιβάλλον.
+
+Εντολές:
+    import-csv <αρχείο> [--dry-run] [--skip-conflicts]
+        Εισάγει τους χρήστες ενός αρχείου CSV, όπως αυτό που παράγει η
+        εξαγωγή. Όσοι δεν έχουν όνομα χρήστη παίρνουν ένα από το
+        ονοματεπώνυμό τους.
+    import-passwd <passwd> [--shadow <αρχείο>] [--group <αρχείο>]
+                  [--gshadow <αρχείο>] [--dry-run] [--skip-conflicts]
+        Εισάγει τους χρήστες αρχείων passwd, shadow, group και gshadow,
+        που μπορεί να είναι και συμπιεσμένα αντίγραφα, π.χ. passwd.gz. Εάν
+        δεν καθοριστούν, χρησιμοποιούνται τα αρχεία του ίδιου καταλόγου με
+        την ίδια κατάληξη, εφόσον υπάρχουν. Οι γραμμές με άγνωστους
+        χρήστες ή ομάδες παραλείπονται με προειδοποίηση.
+    export-csv <αρχείο|-> [ομάδες] [--columns <στήλες|visible>]
+               [--compress <gz|xz>]
+        Εξάγει σε αρχείο CSV, ή στην έξοδο με το -, τα μέλη των
+        καθορισμένων ομάδων, ή όλους τους λογαριασμούς χρηστών. Το
+        --columns δέχεται τις στήλες χωρισμένες με κόμμα, ή το visible για
+        τις στήλες που εμφανίζει το γραφικό περιβάλλον. Τα αρχεία .gz και
+        .xz συμπιέζονται, όπως και η έξοδος με το --compress.
+    create-class <τμήματα> [--computers <πλήθος>] [--username <πρότυπο>]
+                 [--name <πρότυπο>] [--password <πρότυπο>]
+                 [--groups <πρότυπο>] [--teachers] [--shared] [--dry-run]
+        Δημιουργεί τις ομάδες των τμημάτων και έναν λογαριασμό για κάθε
+        υπολογιστή κάθε τμήματος. Στα πρότυπα, το {c} αντικαθίσταται από
+        το τμήμα, το {i} από τον αριθμό του υπολογιστή και το {0i} από τον
+        διψήφιο αριθμό του. Με το --teachers οι καθηγητές γίνονται μέλη των
+        τμημάτων και με το --shared τα τμήματα αποκτούν κοινόχρηστους
+        φακέλους.
+    delete-class <τμήματα> [--remove-home] [--dry-run]
+        Διαγράφει τους λογαριασμούς των τμημάτων, δηλαδή τα μέλη τους που
+        δεν είναι καθηγητές, και τις ομάδες τους.
+    snapshot <αρχείο> [--csv <αρχείο> | --passwd <αρχείο>]
+        Αποθηκεύει ένα στιγμιότυπο των λογαριασμών του συστήματος, ή ενός
+        αρχείου CSV ή passwd, για σύγκριση με το diff.
+    diff <παλιό στιγμιότυπο> [νέο στιγμιότυπο] [--csv <αρχείο> |
+         --passwd <αρχείο>] [--summary]
+        Εμφανίζει τους νέους, διαγραμμένους και αλλαγμένους χρήστες και
+        ομάδες και τις αλλαγές στα μέλη των ομάδων, από το παλιό
+        στιγμιότυπο στο νέο, ή στο σύστημα, ή σε ένα αρχείο CSV ή passwd.
+
+Με το --dry-run εμφανίζονται οι αλλαγές χωρίς να εκτελεστούν. Οι εισαγωγές
+σταματούν χωρίς αλλαγές εάν υπάρχουν συγκρούσεις με το σύστημα, εκτός αν
+δοθεί το --skip-conflicts, οπότε παραλείπονται οι χρήστες με συγκρούσεις.
+
+Κωδικοί εξόδου:
+    0  Επιτυχία.
+    1  Λάθος σύνταξη της εντολής.
+    2  Αποτυχία κάποιων ή όλων των αλλαγών.
+    3  Συγκρούσεις με το σύστημα, δεν έγινε καμία αλλαγή.
+    4  Απαιτούνται δικαιώματα διαχειριστή.
+"""
+
+
+class UsageError(Exception):
+    pass
+
+
+def getopts(args, flags=(), options=()):
+    """Split args into the positional arguments and a dict of the flags,
+    which take no value, and the options, which take one."""
+    positional, opts = [], {}
+    args = list(args)
+    while args:
+        arg = args.pop(0)
+        if arg in flags:
+            opts[arg] = True
+        elif arg in options:
+            if not args:
+                raise UsageError("Η επιλογή %s χρειάζεται τιμή" % arg)
+            opts[arg] = args.pop(0)
+        elif arg.startswith('--'):
+            raise UsageError("Άγνωστη επιλογή %s" % arg)
+        else:
+            positional.append(arg)
+    return positional, opts
+
+
+class Progress:
+    """Prints "message done/total" lines to stdout, or "message done" if
+    the total isn't known, every PROGRESS_STEP items and at the end, so
+    that the output is usable from cron."""
+
+    def __init__(self, message):
+        self.message = message
+        self.last = None
+
+    def __call__(self, done, total=None):
+        if done == total or self.last is None \
+                or done - self.last >= PROGRESS_STEP:
+            self.last = done
+            if total is None:
+                print("%s %d" % (self.message, done), flush=True)
+            else:
+                print("%s %d/%d" % (self.message, done, total), flush=True)
+
+
+def error(msg):
+    sys.stderr.write(msg + "\n")
+
+
+def describe_problem(problem):
+    """Return a message for a ConflictDetector problem."""
+    kind, _sep, value = problem.partition(' ')
+    if kind == 'mismatch':
+        return "διαφέρει από το σύστημα, θα έπρεπε να είναι %s" % value
+    return PROBLEMS.get(kind, problem)
+
+
+def import_set(new_set, opts):
+    """Import the users of new_set into the system."""
+    import conflicts
+    import libuser
+
+    system = libuser.system
+    new_gids = set()
+    users = []
+    for user in list(new_set.users.values()):
+        # Skip the system users, like the import dialog
+        if user.uid is not None and user.is_system_user():
+            new_set.remove_user(user)
+            continue
+        system.autocomplete_user(user, new_set, new_gids)
+        users.append(user)
+
+    detector = conflicts.ConflictDetector(system)
+    detector.add(users)
+    if detector.errors:
+        for user in users:
+            if user in detector.errors:
+                problems = ', '.join(
+                    '%s: %s' % (libuser.CSV_USER_FIELDS[cell],
+                                describe_problem(problem))
+                    for cell, problem in sorted(detector.problems[user].items()))
+                error("Σύγκρουση στον χρήστη %s: %s" % (user.name, problems))
+        if '--skip-conflicts' not in opts:
+            error("Δεν έγινε καμία αλλαγή λόγω %d συγκρούσεων."
+                  % len(detector.errors))
+            return EXIT_CONFLICTS
+        for user in detector.errors:
+            del new_set.users[user.name]
+        users = [u for u in users if u not in detector.errors]
+
+    groups = system.groups_to_create(new_set)
+    print("Θα δημιουργηθούν %d χρήστες και %d ομάδες."
+          % (len(users), len(groups)))
+    if '--dry-run' in opts:
+        for user in users:
+            print("%s\t%s\t%s" % (user.name, user.uid, user.rname))
+        return EXIT_OK
+    results = system.add_users(
+        users, [libuser.Group(g.name, g.gid) for g in groups.values()],
+        progress=Progress("Δημιουργία χρηστών"))
+    for name, (ok, msg) in results['groups'].items():
+        if not ok:
+            error("Αποτυχία δημιουργίας της ομάδας %s: %s" % (name, msg))
+    failed = [(name, msg) for name, (ok, msg)
+              in results['users'].items() if not ok]
+    for name, msg in failed:
+        error("Αποτυχία δημιουργίας του χρήστη %s: %s" % (name, msg))
+    print("Δημιουργήθηκαν %d χρήστες."
+          % (len(results['users']) - len(failed)))
+    return EXIT_FAILED if failed else EXIT_OK
+
+
+def cmd_import_csv(args):
+    positional, opts = getopts(args, ['--dry-run', '--skip-conflicts'])
+    if len(positional) != 1:
+        raise UsageError("Χρειάζεται ένα αρχείο CSV")
+    import libuser
+    import parsers
+
+    new_set = libuser.Set()
+    progress = Progress("Ανάγνωση χρηστών")
+    parser = parsers.CSV()
+    for chunk in parser.iter_parse(positional[0], new_set):
+        progress(len(new_set.users))
+    for warning in parser.warnings:
+        error(warning)
+    print("Διαβάστηκαν %d χρήστες." % len(new_set.users))
+    return import_set(new_set, opts)
+
+
+def cmd_import_passwd(args):
+    positional, opts = getopts(args, ['--dry-run', '--skip-conflicts'],
+                               ['--shadow', '--group', '--gshadow'])
+    if len(positional) != 1:
+        raise UsageError("Χρειάζεται ένα αρχείο passwd")
+    import parsers
+
+    passwd = positional[0]
+    parser = parsers.passwd()
+    files = parser.siblings(passwd)
+    for i, name in enumerate(['shadow', 'group', 'gshadow']):
+        files[i] = opts.get('--' + name, files[i])
+    new_set = parser.parse(passwd, *files)
+    for warning in parser.warnings:
+        error(warning)
+    print("Διαβάστηκαν %d χρήστες." % len(new_set.users))
+    return import_set(new_set, opts)
+
+
+def cmd_export_csv(args):
+    positional, opts = getopts(args, options=['--columns', '--compress'])
+    if len(positional) < 1:
+        raise UsageError("Χρειάζεται ένα αρχείο ή το -")
+    import libuser
+    import parsers
+
+    compression = opts.get('--compress')
+    if compression is not None and compression not in parsers.COMPRESSIONS:
+        raise UsageError("Άγνωστη συμπίεση %s" % compression)
+    columns = opts.get('--columns')
+    if columns == 'visible':
+        import config
+        columns = parsers.visible_columns(
+            config.parser.get('GUI', 'visible_user_columns'))
+    elif columns is not None:
+        columns = columns.split(',')
+        for column in columns:
+            if column not in libuser.CSV_USER_FIELDS:
+                raise UsageError("Άγνωστη στήλη %s" % column)
+    system = libuser.system
+    fname, groups = positional[0], positional[1:]
+    for group in groups:
+        if group not in system.groups:
+            error("Η ομάδα %s δεν υπάρχει." % group)
+            return EXIT_FAILED
+    if groups:
+        names = set()
+        for group in groups:
+            names.update(system.groups[group].members)
+            names.update(u.name for u in system.users.values()
+                         if u.gid == system.groups[group].gid)
+        users = (system.users[n] for n in sorted(names) if n in system.users)
+    else:
+        users = (u for u in system.users.values() if not u.is_system_user())
+    count = parsers.CSV().write(fname, system, users, columns, compression)
+    if fname != '-':
+        print("Εξήχθησαν %d χρήστες." % count)
+    return EXIT_OK
+
+
+def cmd_create_class(args):
+    positional, opts = getopts(
+        args, ['--teachers', '--shared', '--dry-run'],
+        ['--computers', '--username', '--name', '--password', '--groups'])
+    if not positional:
+        raise UsageError("Χρειάζεται τουλάχιστον ένα τμήμα")
+    try:
+        computers = int(opts.get('--computers', 12))
+    except ValueError:
+        raise UsageError("Το πλήθος των υπολογιστών πρέπει να είναι αριθμός")
+    import config
+    import libuser
+    import provisioning
+
+    system = libuser.system
+    if '--groups' in opts:
+        groups_tmpl = opts['--groups']
+    else:
+        # The default of NewUsersDialog
+        groups = [g for g in config.parser.get('Roles', 'μαθητής').split(',')
+                  if g in system.groups]
+        groups_tmpl = ' '.join(['{c}'] + groups)
+    accounts = provisioning.ClassAccounts(
+        system, positional, computers, opts.get('--username', '{c}-{0i}'),
+        opts.get('--name', 'Χρήστης {c}-{0i}'),
+        opts.get('--password', '{c}-{0i}'), groups_tmpl,
+        '--teachers' in opts)
+    errors = accounts.plan()
+    for line in errors:
+        error(line)
+    if errors:
+        return EXIT_FAILED
+    print("Θα δημιουργηθούν %d χρήστες και %d ομάδες."
+          % (len(accounts.users), len(accounts.groups)))
+    if '--dry-run' in opts:
+        for user in accounts.users:
+            print("%s\t%s\t%s" % (user.name, user.uid, ','.join(user.groups)))
+        return EXIT_OK
+
+    last = [None]
+
+    def progress(message, done, total):
+        # The messages contain the counts; print only some of them
+        if done == total or last[0] is None or done - last[0] >= PROGRESS_STEP:
+            last[0] = done
+            print(message, flush=True)
+
+    errors = accounts.apply(progress)
+    for line in errors:
+        error(line)
+    if errors:
+        return EXIT_FAILED
+    if '--shared' in opts:
+        import shared_folders
+        system.reload()
+        shared_folders.SharedFolders(system).add(positional)
+    print("Δημιουργήθηκαν %d χρήστες." % len(accounts.users))
+    return EXIT_OK
+
+
+def cmd_delete_class(args):
+    positional, opts = getopts(args, ['--remove-home', '--dry-run'])
+    if not positional:
+        raise UsageError("Χρειάζεται τουλάχιστον ένα τμήμα")
+    import libuser
+    import shadow
+
+    system = libuser.system
+    users, groups = [], []
+    for classn in positional:
+        if classn not in system.groups:
+            error("Η ομάδα %s δεν υπάρχει." % classn)
+            return EXIT_FAILED
+        groups.append(classn)
+        for name in system.groups[classn].members:
+            user = system.users.get(name)
+            if user is None or system.teachers in user.groups \
+                    or user.is_system_user() or user in users:
+                continue
+            users.append(user)
+            # Their private groups
+            group = system.get_group_by_gid(user.gid)
+            if group is not None and group.name == user.name:
+                groups.append(group.name)
+    print("Θα διαγραφούν %d χρήστες και %d ομάδες." % (len(users), len(groups)))
+    if '--dry-run' in opts:
+        for user in users:
+            print("%s\t%s\t%s" % (user.name, user.uid, user.directory))
+        return EXIT_OK
+
+    shared = [c for c in positional if c in system.share_groups]
+    if shared:
+        import shared_folders
+        shared_folders.SharedFolders(system).remove(shared)
+    try:
+        with shadow.Transaction() as tr:
+            tr.remove_users(u.name for u in users)
+            tr.remove_groups(groups)
+    except (shadow.LockError, OSError) as e:
+        error("Αποτυχία διαγραφής: %s" % e)
+        return EXIT_FAILED
+    failed = False
+    if '--remove-home' in opts:
+        progress = Progress("Διαγραφή καταλόγων")
+        for done, user in enumerate(users, 1):
+            if user.directory and os.path.isdir(user.directory) \
+                    and os.stat(user.directory).st_uid == user.uid:
+                try:
+                    shutil.rmtree(user.directory)
+                except OSError as e:
+                    error("Αποτυχία διαγραφής του %s: %s" % (user.directory, e))
+                    failed = True
+            progress(done, len(users))
+    print("Διαγράφηκαν %d χρήστες." % len(users))
+    return EXIT_FAILED if failed else EXIT_OK
+
+
+def load_set(opts):
+    """Return the accounts of the --csv or --passwd file, or the system."""
+    import libuser
+    import parsers
+
+    if '--csv' in opts and '--passwd' in opts:
+        raise UsageError("Δώστε ένα από τα --csv και --passwd")
+    if '--csv' in opts:
+        parser = parsers.CSV()
+        set_ = parser.parse(opts['--csv'])
+        for warning in parser.warnings:
+            error(warning)
+        return set_
+    if '--passwd' in opts:
+        parser = parsers.passwd()
+        passwd = opts['--passwd']
+        set_ = parser.parse(passwd, *parser.siblings(passwd))
+        for warning in parser.warnings:
+            error(warning)
+        return set_
+    return libuser.system
+
+
+def cmd_snapshot(args):
+    positional, opts = getopts(args, options=['--csv', '--passwd'])
+    if len(positional) != 1:
+        raise UsageError("Χρειάζεται ένα αρχείο")
+    import snapshots
+
+    snapshot = snapshots.Snapshot.from_set(load_set(opts))
+    try:
+        snapshot.save(positional[0])
+    except OSError as e:
+        error(str(e))
+        return EXIT_FAILED
+    print("Αποθηκεύτηκαν %d χρήστες και %d ομάδες."
+          % (len(snapshot.users), len(snapshot.groups)))
+    return EXIT_OK
+
+
+def cmd_diff(args):
+    positional, opts = getopts(args, ['--summary'], ['--csv', '--passwd'])
+    if len(positional) not in (1, 2) \
+            or (len(positional) == 2 and ('--csv' in opts
+                                          or '--passwd' in opts)):
+        raise UsageError("Χρειάζονται ένα ή δύο στιγμιότυπα")
+    import snapshots
+
+    try:
+        old = snapshots.Snapshot.load(positional[0])
+        if len(positional) == 2:
+            new = snapshots.Snapshot.load(positional[1])
+        else:
+            new = snapshots.Snapshot.from_set(load_set(opts))
+    except ValueError as e:
+        error(str(e))
+        return EXIT_FAILED
+    diff = snapshots.Diff(old, new)
+    if '--summary' not in opts:
+        for line in diff.report():
+            print(line)
+    print(diff.summary())
+    return EXIT_OK
+
+
+COMMANDS = {
+    'import-csv': cmd_import_csv,
+    'import-passwd': cmd_import_passwd,
+    'export-csv': cmd_export_csv,
+    'create-class': cmd_create_class,
+    'delete-class': cmd_delete_class,
+    'snapshot': cmd_snapshot,
+    'diff': cmd_diff,
+}
+
+
+def main(argv):
+    if len(argv) < 1 or argv[0] in ['-h', '--help']:
+        print(usage())
+        return EXIT_OK if argv else EXIT_USAGE
+    if argv[0] not in COMMANDS:
+        sys.stderr.write(usage() + "\n")
+        return EXIT_USAGE
+    if os.geteuid() != 0:
+        error("Απαιτούνται δικαιώματα διαχειριστή.")
+        return EXIT_PERMISSION
+    try:
+        return COMMANDS[argv[0]](argv[1:])
+    except UsageError as e:
+        error("%s\n\n%s" % (e, usage()))
+        return EXIT_USAGE
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))